@@ -0,0 +1,21 @@
+import pytest
+
+# These test_*.py files are scripts for trying things out on the Pi (they wait for a signal), not pytest tests
+collect_ignore = ["test_photocell.py", "utils/test_transition.py"]
+
+
+class FakeClock(object):
+    """ A monotonic clock the test sets by hand (clock.now = ...), 'step' moves it forward on every read """
+
+    def __init__(self, now: float = 0.0, step: float = 0.0):
+        self.now = now
+        self.step = step
+
+    def __call__(self) -> float:
+        self.now += self.step
+        return self.now
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
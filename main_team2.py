@@ -2,12 +2,11 @@ from signal import pause
 
 from utils.FSM import GameLogic
 from utils.constants import BadEvent, Language, DoubleRoomStatus
+from utils.VoicePool import Voice, VoicePriority
 
 from gpiozero import DigitalInputDevice
 from settings import PINS, GameSettings as GS, Team, Audio
 
-from threading import Timer
-
 # The library called 'pigpio' can handle software debouncing and other features a lot better than the standard library
 # hence we set it here so that any further handling of pins through the library 'gpiozero' is handled by 'pigpio'
 # Device.pin_factory = PiGPIOFactory()
@@ -21,7 +20,7 @@ class TheGame():
         self.sudden_death = False
         self.scores = [0, 0] # Team 1 at pos 0, team 2 at pos 1
         self.devs = []
-        self.intro_timer: Timer = None
+        self.intro: Voice = None
 
         for setup_list in PINS.photocells_list:
             dev = DigitalInputDevice(setup_list['pin'], pull_up=True, bounce_time=0.01)
@@ -33,6 +32,9 @@ class TheGame():
         
         self.logic.auto_play_background_music = False
         self.logic.audio_handler.change_ending_volume(0.7)
+        # Decode every sound up front, a goal should never wait for the disk
+        self.logic.audio_handler.preload_sounds([Audio.ready_go, Audio.team1_score, Audio.team2_score, Audio.sudden_death,
+                                                 Audio.team1_won, Audio.team2_won], Audio.path)
         self.logic.handle_max_time_reached(self.max_time_reached)
         self.logic.set_double_room_event_listener(self.on_other_room_reported)
         self.logic.start(debug_mode=GS.debug_mode)
@@ -59,6 +61,7 @@ class TheGame():
 
         
     def max_time_reached(self):
+        self.cancel_intro()
         if self.scores[0] > self.scores[1]:
             self.logic.room_lost()
             self.logic.audio_handler.stop_all_music_and_sound()
@@ -79,6 +82,8 @@ class TheGame():
     def on_game_idle(self):
         """ Is triggered when game is idle """
         print("GAME: Now in idle mode")
+        if GS.debug_mode:
+            print(f"GAME: Sound cache - {self.logic.audio_handler.get_cache_stats()}")
 
     def on_game_starting(self, members: int, lang: Language):
         """ Is triggered when the game is about to start, also sends the number of people in the group """
@@ -88,24 +93,35 @@ class TheGame():
     def on_game_started(self):
         """ Is triggered when game has started """
         print("GAME: Game is now ready")
-        intro_time = self.logic.audio_handler.play_custom_sound_now(Audio.ready_go, Audio.path, 1, 1)
-        self.intro_timer = Timer(intro_time, self.intro_time_finished)
-        self.intro_timer.start() 
+        # Goals are accepted the moment the mixer is done with "ready, go". Also when it didn't play to the end (a voice
+        # stole it, no voice was free), only cancel_intro keeps the goals closed
+        try:
+            self.intro = self.logic.audio_handler.play_sound(Audio.ready_go, Audio.path, VoicePriority.ANNOUNCEMENT, 1)
+        except Exception as e:
+            print(f"GAME: Couldn't play the intro ({e}), the game starts without it")
+            self.intro_time_finished(False)
+            return
+        self.intro.add_done_callback(self.intro_time_finished)
     
-    def intro_time_finished(self):
+    def intro_time_finished(self, played_to_end: bool):
+        self.intro = None
         self.scores = [0, 0]
         self.sudden_death = False
         self.accept_goal = True
-        self.intro_timer = None
+
+    def cancel_intro(self):
+        if self.intro is not None:
+            self.intro.finished.cancel()
+            self.intro = None
 
     def on_something_went_wrong(self, event: BadEvent):
         """ Is triggered when something bad has happened as described by the parameter 'BadEvent' """
+        # Before the sounds are stopped, the stopped intro must not open the goals
+        self.cancel_intro()
+
         if event != BadEvent.THROW_OUT_GROUP:
             # We want them to hear the resetting room sound
             self.logic.audio_handler.stop_all_music_and_sound()
-        
-        if self.intro_timer is not None:
-            self.intro_timer.cancel()
 
         if event == BadEvent.GAME_ENDED:
             self.max_time_reached()
@@ -118,8 +134,7 @@ class TheGame():
 
     def on_other_room_reported(self, event: DoubleRoomStatus):
         """ Triggered when other room has reported the 'event', we have to act on this!"""
-        if self.intro_timer is not None:
-            self.intro_timer.cancel()
+        self.cancel_intro()
 
         if event == DoubleRoomStatus.TEAM_WON:
             self.logic.room_won()
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+from typing import List
+from threading import Lock
+
+import hashlib
+import os
+import sys
+import wave
+
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+
+from .lazy import lazy_import
+mixer = lazy_import("pygame.mixer")
+
+from .storage import data_path, read_json, write_json
+
+
+class AssetCache(object):
+    """ PCM copies of the audio assets in the mixer's own format, so nothing has to be decoded (e.g. mp3) on the Pi at runtime.
+
+    The copies are stored on disk by content hash and format, run the build step once after the assets change:
+
+    `python3 -m utils.AssetCache [directories ...]`
+    """
+
+    extensions = (".wav", ".mp3", ".ogg")
+
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.dirname(data_path("pcm", "manifest.json"))
+        self.__manifest_path = os.path.join(self.cache_dir, "manifest.json")
+        self.__manifest = read_json(self.__manifest_path, {})
+        self.__lock = Lock()
+
+    def resolve(self, path: str) -> str:
+        """Returns the cached PCM copy of the asset, or the asset itself if there isn't an up to date copy
+
+        Args:
+            path (str): Absolute path to the asset
+
+        Returns:
+            str: The path that should be loaded
+        """
+        entry = self.__manifest.get(os.path.abspath(path))
+        if entry is None or mixer.get_init() is None:
+            return path
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path
+
+        # Comparing size and modification time is enough to know the hash is still valid, no need to read the file
+        if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            return path
+
+        cached = os.path.join(self.cache_dir, AssetCache.cache_name(entry["hash"]))
+        return cached if os.path.exists(cached) else path
+
+    def build(self, directories: List[str]) -> dict:
+        """Transcodes every asset in the directories to the mixer format, assets already in the cache are skipped
+
+        Args:
+            directories (List[str]): Directories that are searched recursively
+
+        Returns:
+            dict: Number of assets that were 'transcoded', 'cached' already and 'failed'
+        """
+        result = {"transcoded": 0, "cached": 0, "failed": 0}
+
+        for directory in directories:
+            for root, _, files in os.walk(directory):
+                for filename in sorted(files):
+                    if not filename.lower().endswith(AssetCache.extensions):
+                        continue
+                    path = os.path.abspath(os.path.join(root, filename))
+                    try:
+                        result["transcoded" if self.__transcode(path) else "cached"] += 1
+                    except Exception as e:
+                        print(f"ASSETS: Failed to transcode {path}: {e}")
+                        result["failed"] += 1
+
+        with self.__lock:
+            write_json(self.__manifest_path, self.__manifest)
+        return result
+
+    def __transcode(self, path: str) -> bool:
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+
+        with self.__lock:
+            self.__manifest[path] = {"hash": digest, "size": stat.st_size, "mtime": stat.st_mtime}
+
+        cached = os.path.join(self.cache_dir, AssetCache.cache_name(digest))
+        if os.path.exists(cached):
+            return False
+
+        # The mixer decodes and converts to its own format, the raw samples are then written as they are
+        frequency, size, channels = mixer.get_init()
+        raw = mixer.Sound(path).get_raw()
+
+        tmp = cached + ".tmp"
+        with wave.open(tmp, "wb") as w:
+            w.setnchannels(channels)
+            w.setsampwidth(abs(size) // 8)
+            w.setframerate(frequency)
+            w.writeframes(raw)
+        os.replace(tmp, cached)
+        return True
+
+    @staticmethod
+    def cache_name(digest: str) -> str:
+        """ The file name of the cached copy, the mixer format is part of it since the copy is only valid for that format """
+        frequency, size, channels = mixer.get_init()
+        return f"{digest}-{frequency}-{abs(size)}-{channels}.wav"
+
+
+if __name__ == "__main__":
+    # Same format as the AudioHandler uses
+    mixer.pre_init(44100, -16, 5)
+    mixer.init()
+
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    directories = sys.argv[1:] or [os.path.join(root, "utils", "sounds"), os.path.join(root, "extras")]
+
+    cache = AssetCache()
+    print(f"ASSETS: Transcoding {directories} into {cache.cache_dir}")
+    print(f"ASSETS: Done - {cache.build(directories)}")
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+from array import array
+from statistics import median
+from threading import Thread
+from time import perf_counter, sleep, time
+from typing import List
+
+import math
+import os
+import sys
+
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+
+from .lazy import lazy_import
+mixer = lazy_import("pygame.mixer")
+
+from .storage import data_path, read_json, write_json
+
+FREQUENCY = 44100
+""" Same format as the AudioHandler opens the mixer with """
+DEFAULT_BUFFER = 4096
+BUFFER_SIZES = [256, 512, 1024, 2048, 4096]
+PROFILE = "audio_profile.json"
+
+
+class AudioCalibration(object):
+    """ Finds the smallest mixer buffer that plays without underruns on this device, run it once on the Pi:
+
+    `python3 -m utils.AudioCalibration`
+
+    For every buffer size a short click is played a number of times. The time from play() until the mixer is done with
+    the click, minus the click's own length, is the trigger to output latency. A trial that takes more than one buffer
+    period longer than the median means the mixer callback ran late, it's counted as an underrun. The result is stored
+    in the local profile and picked up by GameLogic on the next boot. Works with the SDL dummy driver as well
+    """
+
+    def __init__(self, buffer_sizes: List[int] = None, trials: int = 20, max_underruns: int = 0, load_threads: int = 0):
+        """Creates the calibration
+
+        Args:
+            buffer_sizes (List[int], optional): Candidates, smallest first. Defaults to BUFFER_SIZES.
+            trials (int, optional): Clicks played per buffer size. Defaults to 20.
+            max_underruns (int, optional): Underruns a buffer size may have and still count as stable. Defaults to 0.
+            load_threads (int, optional): Busy threads running during the measurement to mimic the game's load. Defaults to 0.
+        """
+        self.buffer_sizes = sorted(buffer_sizes if buffer_sizes is not None else BUFFER_SIZES)
+        self.trials = trials
+        self.max_underruns = max_underruns
+        self.load_threads = load_threads
+        self.__loaded = False
+
+    def measure(self, buffer: int) -> dict:
+        """Opens the mixer with the buffer size and plays the clicks, the mixer is closed again afterwards
+
+        Returns:
+            dict: 'buffer', 'latency_ms' (median), 'worst_ms', 'underruns' and 'stable'
+        """
+        mixer.quit()
+        mixer.pre_init(FREQUENCY, -16, 5, buffer)
+        mixer.init()
+        try:
+            frequency, _, channels = mixer.get_init()
+            period = buffer / frequency
+            click = AudioCalibration.click(frequency, channels)
+            channel = mixer.Channel(0)
+
+            overheads = []
+            for _ in range(self.trials):
+                start = perf_counter()
+                channel.play(click)
+                while channel.get_busy():
+                    sleep(0.0005)
+                overheads.append(perf_counter() - start - click.get_length())
+                # Let the device drain before the next click
+                sleep(period * 2)
+        finally:
+            mixer.quit()
+
+        # The dummy driver can report the end slightly before the length, it has no device behind it
+        typical = max(0.0, median(overheads))
+        underruns = len([o for o in overheads if o - typical > period])
+        return {"buffer": buffer, "latency_ms": round((typical + period) * 1000, 1), "worst_ms": round((max(overheads) + period) * 1000, 1),
+                "underruns": underruns, "stable": underruns <= self.max_underruns}
+
+    def run(self) -> dict:
+        """Measures every buffer size and picks the smallest stable one
+
+        Returns:
+            dict: The profile, 'buffer' is DEFAULT_BUFFER if no candidate was stable
+        """
+        results = []
+        self.__loaded = self.load_threads > 0
+        for _ in range(self.load_threads):
+            Thread(target=self.__load, daemon=True).start()
+        try:
+            for buffer in self.buffer_sizes:
+                result = self.measure(buffer)
+                print(f"AUDIO: Buffer {buffer:5}: latency {result['latency_ms']} ms (worst {result['worst_ms']} ms), "
+                      f"{result['underruns']} underruns")
+                results.append(result)
+        finally:
+            self.__loaded = False
+
+        stable = [r["buffer"] for r in results if r["stable"]]
+        return {"buffer": stable[0] if stable else DEFAULT_BUFFER, "driver": AudioCalibration.driver(),
+                "frequency": FREQUENCY, "calibrated": int(time()), "results": results}
+
+    def __load(self):
+        while self.__loaded:
+            sum(i * i for i in range(1000))
+
+    @staticmethod
+    def click(frequency: int, channels: int, seconds: float = 0.05) -> mixer.Sound:
+        """ A short 1 kHz tone in the mixer's format (16 bit), made without numpy """
+        samples = array("h")
+        for i in range(int(frequency * seconds)):
+            value = int(8000 * math.sin(2 * math.pi * 1000 * i / frequency))
+            samples.extend([value] * channels)
+        return mixer.Sound(buffer=samples.tobytes())
+
+    @staticmethod
+    def driver() -> str:
+        """ The SDL audio driver the profile is valid for, a profile made with the dummy driver doesn't apply to the Pi's output """
+        return os.environ.get("SDL_AUDIODRIVER", "default")
+
+
+def save_profile(profile: dict):
+    write_json(data_path(PROFILE), profile)
+
+
+def saved_buffer(default: int = DEFAULT_BUFFER) -> int:
+    """ The buffer size from the calibration profile, 'default' if the device hasn't been calibrated for this driver """
+    profile = read_json(data_path(PROFILE), {})
+    if profile.get("driver") != AudioCalibration.driver() or not isinstance(profile.get("buffer"), int):
+        return default
+    return profile["buffer"]
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or None
+    profile = AudioCalibration(sizes).run()
+    save_profile(profile)
+    print(f"AUDIO: Using a buffer of {profile['buffer']} samples for driver '{profile['driver']}', saved to {data_path(PROFILE)}")
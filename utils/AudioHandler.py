@@ -1,13 +1,31 @@
-from typing import Callable
-from threading import Thread, Condition
+from __future__ import annotations
+
+from typing import Callable, Hashable, List, Tuple
+from threading import Lock, Event
+from importlib.util import find_spec
+from collections import OrderedDict
 from random import choice
 from enum import Enum
+from time import perf_counter
 
 import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 
-# Hide prompt first then import mixer
-from pygame import mixer
+# Hide prompt first then import mixer, pygame is only imported once the mixer is used
+from .lazy import lazy_import
+mixer = lazy_import("pygame.mixer")
+
+from .AssetCache import AssetCache
+from .AudioScheduler import AudioScheduler
+from .MusicDucker import MusicDucker, DuckEnvelope
+from .VoicePool import VoicePool, Voice, VoicePriority
+from .Telemetry import telemetry
+from .constants import Language
+
+# sndarray needs numpy, without it we join the raw buffers instead
+has_numpy = find_spec("numpy") is not None
+numpy = lazy_import("numpy")
+sndarray = lazy_import("pygame.sndarray")
 
 class AudioType(Enum):
     POSITIVE = 1
@@ -15,76 +33,283 @@ class AudioType(Enum):
     MAX_REACHED = 3
     CLOSE_WIN = 4
 
+class SoundCache():
+    """ Keeps decoded sounds in memory so that a file is only read and decoded once.
+
+    The cache is bounded by a byte budget, when it's full the least recently used sound is evicted.
+    Counters for hits, misses and evictions are kept so you can verify that nothing is read from disk after warm-up
+    """
+
+    def __init__(self, budget_bytes: int = 32 * 1024 * 1024, assets: AssetCache = None):
+        self.budget_bytes = budget_bytes
+        self.assets = assets
+        """ Pre-transcoded PCM copies are loaded instead of the original files when there are any """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.__sounds = OrderedDict()
+        self.__used_bytes = 0
+        self.__lock = Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.__lock:
+            return key in self.__sounds
+
+    def __len__(self) -> int:
+        return len(self.__sounds)
+
+    def get(self, path: str) -> mixer.Sound:
+        """Returns the decoded sound for the file, decodes it from disk only if it isn't cached already
+
+        Args:
+            path (str): The absolute path to the sound file (also used as the key)
+
+        Returns:
+            mixer.Sound: The decoded sound
+        """
+        sound = self.lookup(path)
+        if sound is not None:
+            return sound
+
+        self.misses += 1
+        return self.put(path, mixer.Sound(self.assets.resolve(path) if self.assets is not None else path))
+
+    def lookup(self, key: Hashable) -> mixer.Sound:
+        """ Returns the cached sound or None, never touches the disk """
+        with self.__lock:
+            entry = self.__sounds.get(key)
+            if entry is None:
+                return None
+            self.__sounds.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, sound: mixer.Sound) -> mixer.Sound:
+        """ Stores a sound under the key, evicting the least recently used sounds until it fits the budget """
+        size = SoundCache.sound_size(sound)
+
+        with self.__lock:
+            if key in self.__sounds:
+                self.__used_bytes -= self.__sounds.pop(key)[1]
+
+            if size > self.budget_bytes:
+                # Won't ever fit, hand it back without caching it
+                return sound
+
+            while self.__sounds and self.__used_bytes + size > self.budget_bytes:
+                _, (_, evicted_size) = self.__sounds.popitem(last=False)
+                self.__used_bytes -= evicted_size
+                self.evictions += 1
+
+            self.__sounds[key] = (sound, size)
+            self.__used_bytes += size
+        return sound
+
+    def remove(self, key: Hashable):
+        with self.__lock:
+            entry = self.__sounds.pop(key, None)
+            if entry is not None:
+                self.__used_bytes -= entry[1]
+
+    def clear(self):
+        with self.__lock:
+            self.__sounds.clear()
+            self.__used_bytes = 0
+
+    def used_bytes(self) -> int:
+        return self.__used_bytes
+
+    def stats(self) -> dict:
+        """ Returns the counters of the cache, a goal sound served after warm-up should only increase 'hits' """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.__sounds), "used_bytes": self.__used_bytes, "budget_bytes": self.budget_bytes}
+
+    @staticmethod
+    def sound_size(sound: mixer.Sound) -> int:
+        """ Estimated size in bytes of the decoded sound, based on the mixer format """
+        init = mixer.get_init()
+        if init is None:
+            return 0
+        frequency, size, channels = init
+        return int(sound.get_length() * frequency) * channels * (abs(size) // 8)
+
+
+class EndingRenderer():
+    """ Joins the clips of an ending (fanfare, feedback, points) into one sound, so it plays without gaps or threads.
+
+    Rendered endings are memoised per combination of clips in the sound cache
+    """
+
+    def __init__(self, sound_cache: SoundCache):
+        self.__sound_cache = sound_cache
+        self.renders = 0
+        self.last_render_seconds = 0.0
+
+    def render(self, files: Tuple[str, ...]) -> mixer.Sound:
+        """Returns one sound with all the clips played in order
+
+        Args:
+            files (Tuple[str, ...]): Absolute paths of the clips, in the order they should be played
+
+        Returns:
+            mixer.Sound: The joined sound
+        """
+        key = ("ending",) + tuple(files)
+        sound = self.__sound_cache.lookup(key)
+        if sound is not None:
+            return sound
+
+        started = perf_counter()
+        clips = [self.__sound_cache.get(f) for f in files]
+
+        # Every clip is decoded to the mixer format, so the PCM data can simply be put back to back
+        if has_numpy:
+            sound = sndarray.make_sound(numpy.concatenate([sndarray.array(c) for c in clips]))
+        else:
+            sound = mixer.Sound(buffer=b"".join(c.get_raw() for c in clips))
+
+        self.renders += 1
+        self.last_render_seconds = perf_counter() - started
+        return self.__sound_cache.put(key, sound)
+
+
 class AudioHandler():
-    """ Handles all the audio for the Game, you can change the different sounds/music and play too """
+    """ Handles all the audio for the Game, you can change the different sounds/music and play too
+
+    Every channel and music call is run on one scheduler thread, the public methods only queue the work. Decoding a
+    sound and rendering an ending run there too, a caller that needs the sound waits for it.
+    With 'lazy_init' the mixer is started on that thread in the background, the constructor returns right away
+    """
     __custom_sound = None
-    __voice_thread = None
-    __stop_condition = Condition()
-    __stop_custom_condition = Condition()
 
     __music_paused = False
 
     __background_music_level: float = 1.0
 
-    def __init__(self, root_path_to_audio: str, buffer=4096):
-        mixer.pre_init(44100, -16, 5, buffer)
-        mixer.init()
+    def __init__(self, root_path_to_audio: str, buffer=4096, cache_budget_bytes: int = 32 * 1024 * 1024, voices: int = 8,
+                 asset_cache: AssetCache = None, lazy_init: bool = False, duck_envelope: DuckEnvelope = None):
+        self.asset_cache = asset_cache if asset_cache is not None else AssetCache()
+        """ PCM copies made by the asset build step (python3 -m utils.AssetCache), picked up automatically """
+        self.sound_cache = SoundCache(cache_budget_bytes, self.asset_cache)
+        """ Decoded sounds, every sound played through the handler is served from here """
+        self.__ending_renderer = EndingRenderer(self.sound_cache)
+        self.__next_endings = {}
+        self.__last_ending_latency = 0.0
+        self.__ending_ms = telemetry().histogram("audio.ending_ms")
 
-        mixer.music.load(f"{root_path_to_audio}/music/bgsong_reduced.mp3")
         self.__losing = f"{root_path_to_audio}/effects/negative/loss.wav"
         self.__winning = f"{root_path_to_audio}/effects/positive/win.wav"
 
-        self.__channel_logic = mixer.Channel(1)
-        self.__channel_custom = mixer.Channel(2)
-        self.__channel_voice = mixer.Channel(3)
-        self.__channel_custom_now1 = mixer.Channel(4)
-        self.__channel_custom_now2 = mixer.Channel(5)
-
-        self.__channel_voice.set_volume(0.3)
-
         self.path_to_audio = root_path_to_audio
+        self.__language_path: str = None
         self.__custom_sound_callback = None
-        self.__custom_sound_thread = None
+        self.__custom_voice: Voice = None
+        self.__custom_duck: int = None
+
+        # A stop bumps the epoch, commands queued before it are dropped instead of playing after the stop
+        self.__epoch = 0
+        self.__scheduler = AudioScheduler()
+        self.__scheduler.start()
+
+        # Sounds are tagged with what they are used for, the tag decides the default volume and what is stopped together
+        self.__pool = VoicePool(voices, self.__scheduler.call)
+        self.__tag_volumes = {"logic": 1.0, "custom": 1.0, "voice": 0.3}
+        # End of playback is taken from the mixer's channel state on every tick, not from the clip length
+        self.__scheduler.add_tick_handler(self.__pool.check_finished)
+        # The music is ducked under other sounds, the volume ramps run on the same tick
+        self.__ducker = MusicDucker(duck_envelope)
+        self.__scheduler.add_tick_handler(self.__ducker.tick)
+
+        self.__mixer_ready = Event()
+        if lazy_init:
+            self.__scheduler.submit(self.__open_mixer, buffer).add_done_callback(AudioHandler.__report_failure)
+        else:
+            self.__open_mixer(buffer)
+
+    def is_ready(self) -> bool:
+        """ False while the mixer is still starting in the background (lazy_init) """
+        return self.__mixer_ready.is_set()
+
+    def wait_until_ready(self, timeout: float = None) -> bool:
+        """ Blocks until the mixer has started, returns False on timeout """
+        return self.__mixer_ready.wait(timeout)
 
     def __del__(self):
-        mixer.quit()
         self.stop_end_voice()
         self.stop_custom_sound()
+        self.__scheduler.stop()
+        self.__scheduler.join(1.0)
+        if self.__mixer_ready.is_set():
+            mixer.quit()
 
     def play_custom_sound(self, music_sound_level=0.5):
-        """ Play the custom sound you set using set_custom_sound, you can set the number of loops if you wish """
+        """ Play the custom sound you set using set_custom_sound, the music is ducked to 'music_sound_level' of its volume
+        while it plays """
         if self.__custom_sound is not None:
-            
-            if self.__channel_custom.get_busy():
-                self.stop_custom_sound()
-
-            self.__custom_sound_thread = Thread(
-                target=self.__custom_sound_event, args=(self.__stop_custom_condition, music_sound_level))
-            self.__custom_sound_thread.start()
+            self.__post(self.__start_custom_sound, self.__custom_sound, self.__custom_sound_callback, music_sound_level)
         else:
             raise Exception(
                 "Custom sound not set, please use set_custom_sound first before playing!")
     
-    def play_custom_sound_now(self, filename: str, directory: str, channel: int, volume=1.0) -> float:
+    def play_custom_sound_now(self, filename: str, directory: str, channel: int, volume=1.0,
+                              ended_callback: Callable[[None], None] = None) -> float:
         """Play a custom sound right now without the overhead, just play it!
 
         Args:
             filename (str): The file name with ending
             directory (str): An absolute directory path without the ending slash
             channel (int): 1 or 2 depending which one you want to play
+            ended_callback (Callable[[None], None], optional): Called when the sound has played to the end. Defaults to None.
         Returns:
             The audio clip length in seconds
         """
         if not (channel == 1 or channel == 2):
             print(f"Choose 1 or 2 for the channel! cannot play {filename}")
             return
-        ch = self.__channel_custom_now1 if channel == 1 else self.__channel_custom_now2
-        sound = mixer.Sound(f"{directory}/{filename}")
-        ch.stop()
-        ch.set_volume(volume)
-        ch.play(sound)
+        sound = self.__sound(f"{directory}/{filename}")
+        self.__play(sound, VoicePriority.ANNOUNCEMENT, f"now{channel}", volume, ended_callback=ended_callback)
         return sound.get_length()
 
+    def play_sound(self, filename: str, directory: str, priority: VoicePriority = VoicePriority.EFFECT, volume=1.0,
+                   ended_callback: Callable[[None], None] = None) -> Voice:
+        """Play a sound on a free voice, it mixes with whatever else is playing. If every voice is busy it steals the
+        oldest voice with the lowest priority, as long as that priority isn't higher than this one
+
+        Args:
+            filename (str): The file name with ending
+            directory (str): An absolute directory path without the ending slash
+            priority (VoicePriority, optional): Announcements beat effects, effects beat ambience. Defaults to VoicePriority.EFFECT.
+            ended_callback (Callable[[None], None], optional): Called when the sound has played to the end. Defaults to None.
+        Returns:
+            Voice: Handle to stop the sound, query if it's playing or wait for it with the 'finished' future
+        """
+        sound = self.__sound(f"{directory}/{filename}")
+        return self.__play(sound, priority, None, volume, ended_callback=ended_callback)
+
+    def get_voice_stats(self) -> dict:
+        """ Returns the size of the voice pool, how many voices are playing, the peak and how many voices were stolen """
+        return self.__scheduler.call(self.__pool.stats)
+
+    def play_sequence(self, filenames: List[str], directory: str, channel: int, volume=1.0,
+                      ended_callback: Callable[[None], None] = None) -> float:
+        """Play the sounds one after the other on one of the custom now channels
+
+        Args:
+            filenames (List[str]): The file names with ending, in the order they should be played
+            directory (str): An absolute directory path without the ending slash
+            channel (int): 1 or 2 depending which one you want to play
+            ended_callback (Callable[[None], None], optional): Called when the last sound has played to the end. Defaults to None.
+        Returns:
+            The length of the whole sequence in seconds
+        """
+        if not (channel == 1 or channel == 2):
+            print(f"Choose 1 or 2 for the channel! cannot play {filenames}")
+            return
+        sounds = [self.__sound(f"{directory}/{filename}") for filename in filenames]
+        self.__post(self.__run_sequence, sounds, f"now{channel}", volume, ended_callback)
+        return sum(sound.get_length() for sound in sounds)
+
     def set_custom_sound(self, filename: str, ended_callback: Callable[[None], None] = None, directory: str = None):
         """ Sets the custom sound, if a new one is set the old one will be stopped.
         
@@ -93,19 +318,31 @@ class AudioHandler():
         self.stop_custom_sound()
 
         if directory is not None:
-            self.__custom_sound = mixer.Sound(f"{directory}/{filename}")
+            self.__custom_sound = self.__sound(f"{directory}/{filename}")
         else:
-            self.__custom_sound = mixer.Sound(f"{self.path_to_audio}/effects/extras/{filename}")
+            self.__custom_sound = self.__sound(f"{self.path_to_audio}/effects/extras/{filename}")
         self.__custom_sound_callback = ended_callback
 
+    def preload_sounds(self, filenames: List[str], directory: str):
+        """Decode the sounds up front so that playing them later never touches the disk, e.g. goal sounds
+
+        Args:
+            filenames (List[str]): The file names with ending
+            directory (str): An absolute directory path without the ending slash
+        """
+        for filename in filenames:
+            self.__sound(f"{directory}/{filename}")
+
+    def get_cache_stats(self) -> dict:
+        """ Returns the hit/miss/eviction counters of the sound cache """
+        return self.sound_cache.stats()
+
     def play_winning_sound(self, run_end_voice: bool = False, points: int = None, feedback_type: AudioType = AudioType.POSITIVE, intro_volume=1.0):
         """ Play the winning fanfare, you can run the optional end voice aftter the winning sound has been played! """
-        if mixer.music.get_busy:
-            mixer.music.fadeout(500)
+        self.__post(mixer.music.fadeout, 500)
         if not run_end_voice:
-            sound = mixer.Sound(self.__winning)
-            self.__channel_logic.set_volume(intro_volume)
-            self.__channel_logic.play(sound)
+            sound = self.__sound(self.__winning)
+            self.__play(sound, VoicePriority.EFFECT, "logic", intro_volume, exclusive=True)
         else:
             if points is None:
                 raise Exception(
@@ -115,68 +352,63 @@ class AudioHandler():
     
     def change_winning_sound(self, filename: str, directory: str = None):
         """ Sets the new winning sound, if the new sound is located in another directory than the default one, you set the second parameter """
-        self.__channel_logic.stop()
+        self.__post(self.__pool.stop_tag, "logic")
 
         if directory is not None:
             self.__winning = f"{directory}/{filename}"
         else:
             self.__winning = f"{self.path_to_audio}/{filename}"
+        self.__next_endings.clear()
 
     def play_losing_sound(self, run_end_voice: bool = True, close_call: bool = False, intro_volume=1.0):
         """ Play the losing trudelutt, it will give a motivational feedback if you were close to winning etc """
-        if mixer.music.get_busy:
-            mixer.music.fadeout(500)
+        self.__post(mixer.music.fadeout, 500)
         
         if not run_end_voice:
-            sound = mixer.Sound(self.__losing)
-            self.__channel_logic.set_volume(intro_volume)
-            self.__channel_logic.play(sound)
+            sound = self.__sound(self.__losing)
+            self.__play(sound, VoicePriority.EFFECT, "logic", intro_volume, exclusive=True)
         else:
             self.__play_losing_ending(close_call)
 
     def change_losing_sound(self, filename: str, directory=None):
         """ Change the losing trudelutt, a new directory can be specified if the sound is located somewhere else"""
-        self.__channel_logic.stop()
+        self.__post(self.__pool.stop_tag, "logic")
         
         if directory is None:
             self.__losing = f"{self.path_to_audio}/{filename}"
         else:
             self.__losing = f"{directory}/{filename}"
+        self.__next_endings.clear()
 
     def play_background_music(self, restart=False, loops=-1):
         """ Starts playing the background music, if its running already it will restart"""
-        if restart:
-            mixer.music.stop()
-            self.__music_paused = False
-        if self.__music_paused:
-            mixer.music.unpause()
-            self.__music_paused = False
-        else:
-            mixer.music.play(loops=loops, fade_ms=200)
+        self.__post(self.__play_background_music, restart, loops)
 
     def change_background_music_volume(self, level: float):
         """ The volume that the background music will play at, its a relative value, 1.0 being the normal """
-        mixer.music.set_volume(level)
         self.__background_music_level = level
+        self.__post(self.__ducker.set_base_level, level)
+
+    def get_ducking_stats(self) -> dict:
+        """ The music level, active duck requests and what the volume ramps cost on the scheduler tick """
+        return self.__scheduler.call(self.__ducker.stats)
 
     def change_ending_volume(self, level: float):
-        self.__channel_voice.set_volume(level)
+        self.__post(self.__set_tag_volume, "voice", level)
     
     def change_custom_volume(self, level:float):
-        self.__channel_custom.set_volume(level)
+        self.__post(self.__set_tag_volume, "custom", level)
 
     def pause_background_music(self):
-        mixer.music.pause()
         self.__music_paused = True
+        self.__post(mixer.music.pause)
 
     def stop_background_music(self):
         """ Stop playing the background music, no fadeout here"""
-        if mixer.music.get_busy() or self.__music_paused:
-            mixer.music.stop()
-            self.__music_paused = False
+        self.__post_stop(self.__stop_background_music)
     
     def background_music_is_playing(self):
-        return mixer.music.get_busy()
+        return self.__scheduler.call(mixer.music.get_busy)
 
     def logic_sound_playing(self) -> bool:
         """Return if the logic channel is playing. Would be points, feedback, losing and winning sounds
@@ -184,7 +416,7 @@ class AudioHandler():
         Returns:
             bool: If its playing
         """
-        return self.__channel_logic.get_busy()
+        return self.__scheduler.call(self.__tag_playing, "logic")
     
     def custom_sound_playing(self) -> bool:
         """Return if the default custom sound is playing
@@ -192,7 +424,7 @@ class AudioHandler():
         Returns:
             bool: If its playing
         """
-        return self.__channel_custom.get_busy()
+        return self.__scheduler.call(self.__tag_playing, "custom")
     
     def custom_now_sound_playing(self, channel: int) -> bool:
         """Returns if the extra custom channels are currently playing or not
@@ -206,14 +438,10 @@ class AudioHandler():
         if not (channel == 1 or channel == 2):
             print(f"Choose 1 or 2 for the channel!")
             return False
-        return self.__channel_custom_now1.get_busy() if channel == 1 else self.__channel_custom_now2.get_busy()
+        return self.__scheduler.call(self.__tag_playing, f"now{channel}")
 
     def change_background_music(self, filename: str, new_directory_path=None):
         """ Change the background music! Can be an mp3-file as well"""
-        if mixer.music.get_busy():
-            mixer.music.stop()
-
-        mixer.music.unload()
         path = ""
 
         if new_directory_path is not None:
@@ -221,29 +449,81 @@ class AudioHandler():
         else:
             path += self.path_to_audio
         
-        mixer.music.load(f"{path}/{filename}")
-        mixer.music.set_volume(self.__background_music_level)
+        self.__post(self.__change_background_music, f"{path}/{filename}")
 
     def stop_end_voice(self):
         """ Stops the end voice if its running """
-        if self.__voice_thread is not None and self.__voice_thread.is_alive():
-            self.__stop_condition.acquire()
-            self.__stop_condition.notify()
-            self.__stop_condition.release()
-            self.__voice_thread.join()
+        self.__post_stop(self.__pool.stop_tag, "voice")
+
+    def prerender_endings(self, points: List[int], budget_bytes: int = None, wanted: Callable[[], bool] = None) -> int:
+        """Pick the feedback for the next endings and render them now, so that the end of the game only has to play them
+
+        Args:
+            points (List[int]): The points for each level, the last level gives the max points feedback
+            budget_bytes (int, optional): Endings that would take the rendered total above it are left to be rendered
+                when they are played. Defaults to no limit.
+            wanted (Callable[[], bool], optional): Asked on the scheduler thread right before each ending is kept, the
+                rendering stops once it returns False. Defaults to always.
+
+        Returns:
+            int: Bytes of the endings rendered, the clips they were rendered from not included
+        """
+        endings = [(("lost", close_call), self.__losing_ending_files(close_call)) for close_call in (False, True)]
+        endings += [(("won", int(level_points), level == len(points)), self.__winning_ending_files(int(level_points), level == len(points)))
+                    for level, level_points in enumerate(points, start=1)]
+
+        used = 0
+        for key, files in endings:
+            # One ending per command, so sounds that are played in the meantime don't wait for all of them
+            size = self.__scheduler.call(self.__prerender_ending, key, files,
+                                         None if budget_bytes is None else budget_bytes - used, wanted)
+            if size is None:
+                break
+            used += size
+        return used
+
+    def preload_sound(self, path: str) -> int:
+        """ Decodes one sound into the cache, returns its size in bytes """
+        return self.__scheduler.call(self.__decoded_size, (path,))
+
+    def forget_endings(self):
+        """ Drops the pre-picked endings and their rendered sounds from the cache, e.g. when the room goes back to idle.
+        Runs after an ending that is being rendered right now, so that one is dropped too """
+        self.__scheduler.submit(self.__forget_endings).add_done_callback(AudioHandler.__report_failure)
+
+    def set_language(self, language: Language):
+        """Spoken clips (feedback, points, leave the room) are taken from the language pack when it has them
+
+        A pack mirrors the effects folder under a folder named after the language, e.g. 'sounds/english/effects/you_got.wav'.
+        Clips the pack doesn't have fall back to the default recordings. None goes back to the default recordings
+
+        Args:
+            language (Language): The team's language
+        """
+        path = f"{self.path_to_audio}/{language.value.lower()}" if language is not None else None
+        if path is not None and not os.path.isdir(path):
+            path = None
+        if path != self.__language_path:
+            self.__language_path = path
+            self.forget_endings()
+
+    def ending_clips(self, points: List[int]) -> List[str]:
+        """ Every clip an ending can be made of for the points, most needed first, in the current language """
+        clips = [self.__losing, self.__winning, self.__clip("you_reached.wav"), self.__clip("you_got.wav"),
+                 self.__clip("points/points.wav")]
+        clips += [self.__clip(f"points/{int(p)}.wav") for p in points]
+        clips += [self.__clip(f"negative/{f}") for f in AudioHandler.FeedbackFinder.feedback(False)]
+        clips += [self.__clip(f"positive/{f}") for f in AudioHandler.FeedbackFinder.feedback(True)]
+        return list(dict.fromkeys(clips))
+
+    def get_ending_stats(self) -> dict:
+        """ Returns how many endings have been rendered and the latency from request to playback of the last ending """
+        return {"renders": self.__ending_renderer.renders, "last_render_seconds": self.__ending_renderer.last_render_seconds,
+                "last_ending_latency": self.__last_ending_latency}
 
     def stop_custom_sound(self):
-        """ Stops the custom sound """
-        if self.__custom_sound_thread is not None and self.__custom_sound_thread.is_alive():
-            self.__stop_custom_condition.acquire()
-            self.__stop_custom_condition.notify()
-            self.__stop_custom_condition.release()
-            
-            # Joins on itself sometimes, depending if you have a long callback, should fix this later
-            #self.__custom_sound_thread.join()
-        # Also stop the custom now sounds
-        self.__channel_custom_now2.stop()
-        self.__channel_custom_now1.stop()
+        """ Stops the custom sound and the custom now sounds """
+        self.__post_stop(self.__stop_custom_sound)
 
     def play_please_leave_room(self, last_statement=False, volume=1.0):
         """Notify the team that they should leave the room!
@@ -251,107 +531,213 @@ class AudioHandler():
         Args:
             last_statement (bool, optional): Tell them for the last time or not. Defaults to False.
         """
-        self.__channel_logic.stop()
-        path = f"{self.path_to_audio}/effects/"
-        path += "leave_the_room.wav" if not last_statement else "please_exit.wav"
-        sound = mixer.Sound(path)
-        self.__channel_logic.set_volume(volume)
-        self.__channel_logic.play(sound)
+        sound = self.__sound(self.__clip("leave_the_room.wav" if not last_statement else "please_exit.wav"))
+        self.__play(sound, VoicePriority.ANNOUNCEMENT, "logic", volume, exclusive=True)
 
     def stop_all_music_and_sound(self):
         """ Stop all sounds and music"""
-        self.stop_end_voice()
-        self.stop_custom_sound()
+        self.__post_stop(self.__stop_all)
+
+    def __sound(self, path: str) -> mixer.Sound:
+        """ The decoded sound from the cache, decoded on the scheduler thread after the mixer has started """
+        return self.__scheduler.call(self.sound_cache.get, path)
+
+    def __play(self, sound: mixer.Sound, priority: VoicePriority, tag: str, volume: float = None, exclusive: bool = False,
+               ended_callback: Callable[[None], None] = None) -> Voice:
+        """ Queue the sound on a voice from the pool, exclusive stops the other voices with the same tag first """
+        voice = self.__pool.create(sound, priority, tag)
+        self.__post(self.__start_voice, voice, volume, exclusive, ended_callback)
+        return voice
+
+    def __post(self, fn: Callable, *args):
+        """ Queue a command on the audio scheduler, it's dropped if a stop is requested before it runs """
+        self.__scheduler.submit(self.__run_in_epoch, self.__epoch, fn, args).add_done_callback(AudioHandler.__report_failure)
+
+    def __post_stop(self, fn: Callable, *args):
+        """ Queue a stop, it runs before any queued play commands and cancels them """
+        self.__epoch += 1
+        self.__scheduler.submit(fn, *args, priority=AudioScheduler.PRIORITY_STOP).add_done_callback(AudioHandler.__report_failure)
+
+    def __run_in_epoch(self, epoch: int, fn: Callable, args: tuple):
+        if epoch == self.__epoch:
+            fn(*args)
+
+    @staticmethod
+    def __report_failure(future):
+        if future.exception() is not None:
+            print(f"AUDIO: Command failed: {future.exception()}")
+
+    # Everything below runs on the scheduler thread
+
+    def __open_mixer(self, buffer: int):
+        try:
+            mixer.pre_init(44100, -16, 5, buffer)
+            mixer.init()
+            mixer.music.load(self.asset_cache.resolve(f"{self.path_to_audio}/music/bgsong_reduced.mp3"))
+            self.__ducker.apply()
+            self.__pool.open()
+        finally:
+            # Callers waiting for the mixer get the error from the mixer itself if it failed
+            self.__mixer_ready.set()
+
+    def __start_voice(self, voice: Voice, volume: float, exclusive: bool, callback: Callable[[None], None]):
+        if exclusive:
+            self.__pool.stop_tag(voice.tag)
+        if volume is None:
+            volume = self.__tag_volumes.get(voice.tag, 1.0)
+        if callback is not None:
+            voice.add_done_callback(lambda played_to_end: callback() if played_to_end else None)
+        self.__pool.start(voice, volume)
+
+    def __run_sequence(self, sounds: list, tag: str, volume: float, callback: Callable[[None], None]):
+        """ Plays the first sound and the rest when it has ended, stopping or stealing a voice aborts the sequence """
+        if not sounds:
+            if callback is not None:
+                callback()
+            return
+
+        voice = self.__pool.create(sounds[0], VoicePriority.ANNOUNCEMENT, tag)
+        self.__start_voice(voice, volume, False, lambda: self.__run_sequence(sounds[1:], tag, volume, callback))
+
+    def __tag_playing(self, tag: str) -> bool:
+        return len(self.__pool.playing(tag)) > 0
+
+    def __set_tag_volume(self, tag: str, level: float):
+        self.__tag_volumes[tag] = level
+        for voice in self.__pool.playing(tag):
+            voice.channel.set_volume(level)
+
+    def __start_custom_sound(self, sound: mixer.Sound, callback: Callable[[None], None], music_level: float):
+        self.__finish_custom_sound(None, False)
+
+        self.__custom_duck = self.__ducker.duck(music_level)
+        voice = self.__pool.create(sound, VoicePriority.EFFECT, "custom")
+        self.__custom_voice = voice
+        voice.add_done_callback(lambda played_to_end: self.__finish_custom_sound(voice, played_to_end, callback))
+        self.__pool.start(voice, self.__tag_volumes["custom"])
+
+    def __finish_custom_sound(self, voice: Voice, reached_end: bool, callback: Callable[[None], None] = None):
+        """ Restores the music and runs the callback, 'voice' None finishes whichever custom sound is playing """
+        if self.__custom_voice is None or (voice is not None and voice is not self.__custom_voice):
+            return
+        current = self.__custom_voice
+        self.__custom_voice = None
+
+        self.__ducker.release(self.__custom_duck)
+        self.__custom_duck = None
+        if not reached_end:
+            self.__pool.stop(current)
+        elif callback is not None:
+            callback()
+
+    def __stop_custom_sound(self):
+        self.__finish_custom_sound(None, False)
+        self.__pool.stop_tag("now2")
+        self.__pool.stop_tag("now1")
+
+    def __stop_all(self):
+        self.__pool.stop_tag("voice")
+        self.__stop_custom_sound()
         # Stop the mixer.music module and then stop all playback on all channels
-        self.stop_background_music()
+        self.__stop_background_music()
+        self.__pool.stop_all()
         mixer.stop()
+
+    def __play_background_music(self, restart: bool, loops: int):
+        if restart:
+            mixer.music.stop()
+            self.__music_paused = False
+        if self.__music_paused:
+            mixer.music.unpause()
+            self.__music_paused = False
+        else:
+            mixer.music.play(loops=loops, fade_ms=200)
+
+    def __stop_background_music(self):
+        if mixer.music.get_busy() or self.__music_paused:
+            mixer.music.stop()
+            self.__music_paused = False
+
+    def __change_background_music(self, path: str):
+        if mixer.music.get_busy():
+            mixer.music.stop()
+
+        mixer.music.unload()
+        mixer.music.load(self.asset_cache.resolve(path))
+        self.__ducker.apply()
     
     def __play_losing_ending(self, close_call: bool):
-        sound_list = []
+        files = self.__next_endings.pop(("lost", close_call), None)
+        if files is None:
+            files = self.__losing_ending_files(close_call)
+        self.__play_ending(files)
+
+    def __play_winning_ending(self, points: int, max_points: bool):
+        files = self.__next_endings.pop(("won", points, max_points), None)
+        if files is None:
+            files = self.__winning_ending_files(points, max_points)
+        self.__play_ending(files)
+
+    def __play_ending(self, files: Tuple[str, ...]):
+        """ Plays the ending as one sound on the voice channel, stop_end_voice cancels it """
+        self.__post(self.__play_ending_sound, files, perf_counter())
+
+    def __decoded_size(self, files: Tuple[str, ...]) -> int:
+        return sum(SoundCache.sound_size(self.sound_cache.get(f)) for f in files)
+
+    def __prerender_ending(self, key: tuple, files: Tuple[str, ...], budget_bytes: int, wanted: Callable[[], bool]) -> int:
+        """ Renders and keeps the ending if it fits the budget, None once the endings aren't wanted anymore """
+        if budget_bytes is not None and self.__decoded_size(files) > budget_bytes:
+            return 0
+        if wanted is not None and not wanted():
+            return None
+        sound = self.__ending_renderer.render(files)
+        self.__next_endings[key] = files
+        return SoundCache.sound_size(sound)
+
+    def __forget_endings(self):
+        endings, self.__next_endings = self.__next_endings, {}
+        for files in endings.values():
+            self.sound_cache.remove(("ending",) + files)
+
+    def __play_ending_sound(self, files: Tuple[str, ...], requested: float):
+        sound = self.__ending_renderer.render(files)
+        self.__start_voice(self.__pool.create(sound, VoicePriority.ANNOUNCEMENT, "voice"), None, True, None)
+        self.__last_ending_latency = perf_counter() - requested
+        self.__ending_ms.observe(self.__last_ending_latency * 1000)
+
+    def __losing_ending_files(self, close_call: bool) -> Tuple[str, ...]:
         feedback_finder = self.FeedbackFinder()
 
         if close_call:
-            sound_list.append(mixer.Sound(
-                f"{self.path_to_audio}/effects/negative/{feedback_finder.get_close_call_feedback()}"))
+            feedback = feedback_finder.get_close_call_feedback()
         else:
-            sound_list.append(mixer.Sound(
-                f"{self.path_to_audio}/effects/negative/{feedback_finder.get_random_feedback(False)}"))
+            feedback = feedback_finder.get_random_feedback(False)
 
-        sound_list.append(mixer.Sound(self.__losing))
+        return (self.__losing, self.__clip(f"negative/{feedback}"))
 
-        self.__voice_thread = Thread(target=self.__end_voice_task, args=(
-            sound_list, self.__stop_condition))
-        self.__voice_thread.start()
-
-    def __play_winning_ending(self, points: int, max_points: bool):
-        sound_list = []
+    def __winning_ending_files(self, points: int, max_points: bool) -> Tuple[str, ...]:
         point_alternatives = [50, 100, 200, 300, 400, 500]
         feedback_finder = self.FeedbackFinder()
 
-        # We pop from last position, so when we append, we append from backwards
-        sound_list.append(mixer.Sound(
-            f"{self.path_to_audio}/effects/points/points.wav"))
-
-        if points in point_alternatives:
-            sound_list.append(mixer.Sound(
-                f"{self.path_to_audio}/effects/points/{points}.wav"))
-        else:
+        if points not in point_alternatives:
             raise Exception(f"The parameter {points} points does not exist")
-        
+
+        # Fanfare first, then e.g. "Nailed it! You got 300 points"
         if max_points:
-            sound_list.append(mixer.Sound(
-                f"{self.path_to_audio}/effects/you_got.wav"))
-            sound_list.append(mixer.Sound(
-                f"{self.path_to_audio}/effects/positive/{feedback_finder.get_max_points_feedback()}"))
+            feedback = (self.__clip(f"positive/{feedback_finder.get_max_points_feedback()}"), self.__clip("you_got.wav"))
         else:
-            sound_list.append(mixer.Sound(
-                f"{self.path_to_audio}/effects/you_reached.wav"))
-            sound_list.append(mixer.Sound(
-                f"{self.path_to_audio}/effects/positive/{feedback_finder.get_random_feedback(True)}"))
+            feedback = (self.__clip(f"positive/{feedback_finder.get_random_feedback(True)}"), self.__clip("you_reached.wav"))
 
-        
-        sound_list.append(mixer.Sound(self.__winning))
-        
-        self.__voice_thread = Thread(target=self.__end_voice_task, args=(
-            sound_list, self.__stop_condition))
-        self.__voice_thread.start()
-
-    def __end_voice_task(self, slist: list, cond: Condition):
-        """ Task for the thread to run a list with sounds (like a queue) """
-        cond.acquire()
-        keep_running = True
-        # Check if we should run the winning fanfare first!
-        # if fanfare:
-        #     self.__channel_logic.play(self.__winning)
-        #     exit_early = cond.wait(self.__winning.get_length())
-        #     if exit_early:
-        #         keep_running = False
-        #         self.__channel_logic.stop()
-
-        # Next we play the voice with all the clips
-        while len(slist) != 0 and keep_running:
-            s = slist.pop()
-            self.__channel_voice.queue(s)
-            exit_early = cond.wait(s.get_length())
-            if exit_early:
-                keep_running = False
-                self.__channel_voice.stop()
-
-        cond.release()
-
-    def __custom_sound_event(self, cond: Condition, music_level: float):
-        cond.acquire()
-        old_music_level = mixer.music.get_volume()
-        mixer.music.set_volume(music_level)
-        self.__channel_custom.play(self.__custom_sound)
-        exit_early = cond.wait(self.__custom_sound.get_length())
-        mixer.music.set_volume(old_music_level)
-        if exit_early:
-            self.__channel_custom.stop()
-        elif self.__custom_sound_callback is not None:
-            self.__custom_sound_callback()
-
-        cond.release()
+        return (self.__winning,) + feedback + (self.__clip(f"points/{points}.wav"), self.__clip("points/points.wav"))
+
+    def __clip(self, name: str) -> str:
+        """ Path of a spoken clip in effects/, taken from the language pack if it has its own recording """
+        if self.__language_path is not None:
+            path = f"{self.__language_path}/effects/{name}"
+            if os.path.exists(path):
+                return path
+        return f"{self.path_to_audio}/effects/{name}"
 
     class FeedbackFinder:
 
@@ -372,4 +758,12 @@ class AudioHandler():
         def get_max_points_feedback(self):
             return choice(self.__max_points_list)
 
+        @staticmethod
+        def feedback(positive: bool) -> List[str]:
+            """ Every feedback clip that can be picked, including close call and max points """
+            finder = AudioHandler.FeedbackFinder
+            if positive:
+                return finder.__positive_list + finder.__max_points_list
+            return finder.__negative_list + finder.__close_list
+
     
\ No newline at end of file
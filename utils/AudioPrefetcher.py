@@ -0,0 +1,135 @@
+from queue import Queue
+from threading import Lock, Thread
+from time import perf_counter
+from typing import List
+
+from .AudioHandler import AudioHandler
+from .constants import Language
+
+
+class AudioPrefetcher(object):
+    """ Loads the ending clips while the team walks in, and frees them again when the room goes back to idle.
+
+    GameLogic starts it when a tag has been scanned (the language is known from then on) and again when the door opens,
+    the second call is a no-op if it's for the same team. One background thread does the loading: the endings are rendered
+    first, then the single clips are kept (most needed first) as long as they fit in what is left of the budget.
+    Each rendered ending and each clip counts once against the budget. A release stops the loading, what was loaded
+    before it is freed and what would have been kept after it is dropped
+    """
+
+    def __init__(self, audio_handler: AudioHandler, budget_bytes: int = 16 * 1024 * 1024):
+        """Creates the prefetcher
+
+        Args:
+            audio_handler (AudioHandler): The handler whose sound cache the clips are loaded into
+            budget_bytes (int, optional): Memory the prefetched clips and endings may take. Defaults to 16 MB.
+        """
+        self.audio_handler = audio_handler
+        self.budget_bytes = budget_bytes
+
+        self.__lock = Lock()
+        self.__generation = 0
+        self.__request = None
+        self.__loaded: List[str] = []
+        self.__used_bytes = 0
+        self.__last_seconds = 0.0
+        self.__skipped = 0
+
+        # Started with the first prefetch, a room that never has a team doesn't need it
+        self.__requests = Queue()
+        self.__worker: Thread = None
+
+    def prefetch(self, points: List[int], language: Language):
+        """Starts loading the clips for the language and points in the background
+
+        Args:
+            points (List[int]): Points per level from the config, None loads the clips without rendering endings
+            language (Language): The team's language
+        """
+        request = (tuple(points) if points is not None else None, language)
+        with self.__lock:
+            if request == self.__request:
+                return
+            self.__request = request
+            self.__generation += 1
+            self.__requests.put((self.__generation, points, language))
+            if self.__worker is None:
+                self.__worker = Thread(target=self.__work, name="AudioPrefetcher", daemon=True)
+                self.__worker.start()
+
+    def release(self):
+        """ Stops a prefetch that is still running and frees what it loaded, sounds that were cached before are kept """
+        with self.__lock:
+            self.__generation += 1
+            self.__request = None
+            loaded, self.__loaded = self.__loaded, []
+            self.__used_bytes = 0
+
+        for path in loaded:
+            self.audio_handler.sound_cache.remove(path)
+        self.audio_handler.forget_endings()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"clips": len(self.__loaded), "used_bytes": self.__used_bytes, "budget_bytes": self.budget_bytes,
+                    "skipped": self.__skipped, "last_seconds": round(self.__last_seconds, 3)}
+
+    def __wanted(self, generation: int) -> bool:
+        with self.__lock:
+            return generation == self.__generation
+
+    def __work(self):
+        while True:
+            generation, points, language = self.__requests.get()
+            # A newer request or a release came in while this one was waiting
+            if not self.__wanted(generation):
+                continue
+            try:
+                self.__run(generation, points, language)
+            except Exception as e:
+                print(f"AUDIO: Prefetch failed: {e}")
+
+    def __run(self, generation: int, points: List[int], language: Language):
+        started = perf_counter()
+        handler = self.audio_handler
+        handler.wait_until_ready()
+        handler.set_language(language)
+
+        clips = handler.ending_clips(points or [])
+        cached_before = {path for path in clips if path in handler.sound_cache}
+
+        # The rendered endings are what the end of the game plays, they get the budget first. The handler asks right
+        # before it keeps each ending, one that is rendered during a release is dropped with the others
+        rendered = handler.prerender_endings(points, self.budget_bytes, lambda: self.__wanted(generation)) if points else 0
+        with self.__lock:
+            if generation != self.__generation:
+                self.__drop(clips, cached_before)
+                return
+            self.__used_bytes += rendered
+
+        # Then the single clips, in case the feedback that is picked at the end differs from the rendered one. The
+        # clips the endings were rendered from are in the cache already and are counted here, once
+        for path in clips:
+            if path in cached_before:
+                continue
+            size = handler.preload_sound(path)
+            with self.__lock:
+                if generation != self.__generation:
+                    self.__drop(clips, cached_before)
+                    return
+                if self.__used_bytes + size > self.budget_bytes:
+                    handler.sound_cache.remove(path)
+                    self.__skipped += 1
+                    continue
+                self.__loaded.append(path)
+                self.__used_bytes += size
+
+        self.__last_seconds = perf_counter() - started
+        print(f"AUDIO: Prefetched {len(self.__loaded)} clips and the endings for {getattr(language, 'value', language)}, "
+              f"{self.__used_bytes // 1024} kB in {self.__last_seconds:.2f} s")
+
+    def __drop(self, clips: List[str], cached_before: set):
+        """ Frees the clips this run decoded but didn't get to keep, called with the lock held after a release """
+        for path in clips:
+            if path not in cached_before and path not in self.__loaded:
+                self.audio_handler.sound_cache.remove(path)
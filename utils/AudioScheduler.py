@@ -0,0 +1,137 @@
+from concurrent.futures import Future
+from queue import PriorityQueue, Empty
+from threading import Thread, current_thread
+from itertools import count
+from time import monotonic
+from typing import Callable
+
+import heapq
+
+
+class ScheduledCall(object):
+    """ Handle for a call scheduled with AudioScheduler.call_later, cancel it if it shouldn't run anymore """
+    __slots__ = ("due", "fn", "args", "cancelled")
+
+    def __init__(self, due: float, fn: Callable, args: tuple):
+        self.due = due
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class AudioScheduler(Thread):
+    """ One long lived thread that every mixer call is serialised on.
+
+    Commands are put on a queue and run in order, stop commands jump the queue so they take effect within one tick.
+    Delayed calls and tick handlers (e.g. watching for the end of a sound) run from the same thread, so no threads are
+    created per sound. The thread only ticks while a tick handler has work, otherwise it sleeps until the next command
+    """
+
+    PRIORITY_STOP = 0
+    PRIORITY_NORMAL = 1
+
+    def __init__(self, tick_seconds: float = 0.002, idle_seconds: float = 0.5):
+        Thread.__init__(self, name="AudioScheduler", daemon=True)
+        self.tick_seconds = tick_seconds
+        self.idle_seconds = idle_seconds
+
+        self.__commands = PriorityQueue()
+        self.__order = count()
+        self.__timers = []
+        self.__tick_handlers = []
+        self.__running = True
+
+    def submit(self, fn: Callable, *args, priority: int = PRIORITY_NORMAL) -> Future:
+        """Queue a command to run on the scheduler thread
+
+        Args:
+            fn (Callable): The command
+            priority (int, optional): PRIORITY_STOP runs before any queued normal commands. Defaults to PRIORITY_NORMAL.
+
+        Returns:
+            Future: Resolved with the return value of the command
+        """
+        future = Future()
+        self.__commands.put((priority, next(self.__order), fn, args, future))
+        return future
+
+    def call(self, fn: Callable, *args, timeout: float = None):
+        """ Run the command on the scheduler thread and wait for the result, runs directly if we already are on it.
+
+        Waits as long as the commands queued before it take (e.g. the mixer starting) unless a timeout is given, then
+        concurrent.futures.TimeoutError is raised and the command still runs when its turn comes
+        """
+        if current_thread() is self or not self.is_alive():
+            return fn(*args)
+        return self.submit(fn, *args).result(timeout)
+
+    def call_later(self, delay: float, fn: Callable, *args) -> ScheduledCall:
+        """ Run the command on the scheduler thread after 'delay' seconds, returns a handle that can be cancelled """
+        handle = ScheduledCall(monotonic() + delay, fn, args)
+        if current_thread() is self:
+            self.__push_timer(handle)
+        else:
+            self.submit(self.__push_timer, handle)
+        return handle
+
+    def add_tick_handler(self, handler: Callable[[], bool]):
+        """ The handler is called on every tick of the scheduler thread, keep it cheap.
+
+        It returns True while it has work, the thread keeps ticking as long as any handler does
+        """
+        self.submit(self.__tick_handlers.append, handler)
+
+    def stop(self):
+        """ Stops the thread, queued commands that haven't run yet are dropped """
+        self.__running = False
+        self.submit(lambda: None, priority=AudioScheduler.PRIORITY_STOP)
+
+    def pending_calls(self) -> int:
+        """ Number of delayed calls that are waiting to run """
+        return len(self.__timers)
+
+    def run(self):
+        busy = False
+        while self.__running:
+            timeout = self.tick_seconds if busy else self.idle_seconds
+            if self.__timers:
+                timeout = max(0.0, min(timeout, self.__timers[0][0] - monotonic()))
+
+            try:
+                _, _, fn, args, future = self.__commands.get(timeout=timeout)
+                self.__execute(fn, args, future)
+            except Empty:
+                pass
+
+            self.__run_due_timers()
+            busy = False
+            for handler in self.__tick_handlers:
+                busy = self.__execute(handler, (), None) or busy
+
+    def __push_timer(self, handle: ScheduledCall):
+        heapq.heappush(self.__timers, (handle.due, next(self.__order), handle))
+
+    def __run_due_timers(self):
+        now = monotonic()
+        while self.__timers and self.__timers[0][0] <= now:
+            _, _, handle = heapq.heappop(self.__timers)
+            if not handle.cancelled:
+                self.__execute(handle.fn, handle.args, None)
+
+    def __execute(self, fn: Callable, args: tuple, future: Future):
+        if future is not None and not future.set_running_or_notify_cancel():
+            return None
+        try:
+            result = fn(*args)
+        except Exception as e:
+            if future is not None:
+                future.set_exception(e)
+            else:
+                print(f"AUDIO: Scheduled call {fn} failed: {e}")
+            return None
+        if future is not None:
+            future.set_result(result)
+        return result
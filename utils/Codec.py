@@ -0,0 +1,84 @@
+from importlib.util import find_spec
+from typing import List
+
+import json
+
+from .lazy import lazy_import
+
+# The fast backends are optional, json from the standard library always works
+orjson = lazy_import("orjson")
+msgpack = lazy_import("msgpack")
+
+
+class JsonCodec(object):
+    """ Payloads as json with the standard library, what every room and the server understand """
+    content_type = "application/json"
+
+    def encode(self, message: dict) -> bytes:
+        return json.dumps(message).encode()
+
+    def decode(self, payload: bytes) -> dict:
+        return json.loads(payload)
+
+
+class OrjsonCodec(JsonCodec):
+    """ The same json, encoded and decoded by orjson which is several times faster """
+
+    def __init__(self):
+        # Bound once, looking them up through the lazy module on every message would cost more than the decoding
+        self.encode = orjson.dumps
+        self.decode = orjson.loads
+
+
+class MsgpackCodec(object):
+    """ Binary payloads, smaller and cheaper to decode than json """
+    content_type = "application/msgpack"
+
+    def __init__(self, fallback: JsonCodec = None):
+        self.__fallback = fallback if fallback is not None else best_json_codec()
+        self.encode = msgpack.packb
+        self.__unpackb = msgpack.unpackb
+
+    def decode(self, payload: bytes) -> dict:
+        # A json object starts with '{', in msgpack that's the number 123 on its own which is never a message. The config
+        # and anything sent before the negotiation is json, so both can arrive
+        if payload[:1] == b"{":
+            return self.__fallback.decode(payload)
+        return self.__unpackb(payload)
+
+
+def best_json_codec() -> JsonCodec:
+    return OrjsonCodec() if find_spec("orjson") is not None else JsonCodec()
+
+
+def supported_content_types() -> List[str]:
+    """ The content types this room can handle, preferred first. Sent to the server with the config request """
+    types = [MsgpackCodec.content_type] if find_spec("msgpack") is not None else []
+    return types + [JsonCodec.content_type]
+
+
+def codec_for(content_type: str):
+    """ The codec for the content type the server picked, json if it didn't pick one or picked one we don't have """
+    if content_type == MsgpackCodec.content_type and find_spec("msgpack") is not None:
+        return MsgpackCodec()
+    return best_json_codec()
+
+
+if __name__ == "__main__":
+    # Cost per message of each available codec on a typical room status and config
+    from timeit import timeit
+
+    messages = [{"status": "won", "mac": "b8:27:eb:00:00:01", "room": "3", "level": 2},
+                {"room": "3", "points": [100, 200, 300], "roomType": "competitive", "otherRoomNbr": "4", "isRoomSpy": False}]
+    codecs = [JsonCodec()]
+    codecs += [OrjsonCodec()] if find_spec("orjson") is not None else []
+    codecs += [MsgpackCodec()] if find_spec("msgpack") is not None else []
+
+    runs = 20000
+    for codec in codecs:
+        payloads = [codec.encode(m) for m in messages]
+        encode = timeit(lambda: [codec.encode(m) for m in messages], number=runs) / (runs * len(messages)) * 1e9
+        decode = timeit(lambda: [codec.decode(p) for p in payloads], number=runs) / (runs * len(messages)) * 1e9
+        print(f"CODEC: {type(codec).__name__:13} encode {encode:6.0f} ns, decode {decode:6.0f} ns, "
+              f"{sum(len(p) for p in payloads) // len(payloads)} bytes per message")
+    print(f"CODEC: Supported content types {supported_content_types()}")
@@ -0,0 +1,52 @@
+from hashlib import sha1
+from time import time
+from typing import Tuple
+
+import json
+
+from .Messages import ConfigMessage, MessageError
+from .storage import data_path, read_json, write_json
+
+
+class ConfigCache(object):
+    """ The last config the server sent, per MAC, so a room that boots or reconnects can use it right away.
+
+    Every config has an etag (a hash of its content), the server's copy is compared against it when it arrives and
+    only a config that has changed is applied again
+    """
+
+    def __init__(self, path: str = None):
+        """
+        Args:
+            path (str, optional): The cache file. Defaults to 'config_cache.json' in the data directory.
+        """
+        self.path = path if path is not None else data_path("config_cache.json")
+
+    @staticmethod
+    def etag(config: ConfigMessage) -> str:
+        return sha1(json.dumps(config.to_dict(), sort_keys=True).encode()).hexdigest()[:16]
+
+    def load(self, mac: str) -> Tuple[ConfigMessage, str]:
+        """ The cached config and its etag, None if there isn't one (or it doesn't validate anymore) """
+        entry = read_json(self.path, {}).get(mac)
+        if entry is None:
+            return None
+        try:
+            config = ConfigMessage.from_dict(entry["config"])
+        except (MessageError, KeyError, TypeError) as e:
+            print(f"ServerCommunicator: Ignoring the cached config: {e}")
+            return None
+        return config, ConfigCache.etag(config)
+
+    def store(self, mac: str, config: ConfigMessage) -> str:
+        """ Caches the config, returns its etag """
+        etag = ConfigCache.etag(config)
+        cache = read_json(self.path, {})
+        cache[mac] = {"etag": etag, "config": config.to_dict(), "saved": int(time())}
+        write_json(self.path, cache)
+        return etag
+
+    def forget(self, mac: str):
+        cache = read_json(self.path, {})
+        if cache.pop(mac, None) is not None:
+            write_json(self.path, cache)
@@ -1,30 +1,79 @@
-from transitions import Machine, EventData
-from transitions.extensions.states import add_state_features, Timeout
+from transitions import Machine, EventData, State
+from transitions.core import listify
 
 from .AudioHandler import AudioHandler, AudioType
+from .AudioCalibration import saved_buffer
+from .AudioPrefetcher import AudioPrefetcher
 from .constants import Access, BadEvent, RoomStatus, DoorStatus, Language, Topics, DoubleRoomType, DoubleRoomStatus
+from .NetworkIdentity import NetworkIdentity
+from .ReconnectBackoff import ReconnectBackoff
 from .ServerCommunicator import ServerFinder, ServerCommunicator
+from .Messages import ConfigMessage, DoorStatusMessage, RoomStatusMessage, ScanResultMessage, SetStatusMessage
 from .GameTimer import GameTimer
+from .TimerWheel import TimerWheel, shared_wheel
 from .log import Log
 
 from random import randint
-from threading import Timer
-from typing import Callable
+from time import monotonic, perf_counter
+from typing import Callable, Tuple, TYPE_CHECKING
 
 import os
-import tkinter as tk
 
-@add_state_features(Timeout)
+if TYPE_CHECKING:
+    # Only for the type hint, tkinter is never imported unless the room uses it
+    import tkinter as tk
+
+class TimeoutState(State):
+    """ Same as the Timeout state feature in transitions, without importing transitions.extensions (pulls in asyncio)
+
+    If 'timeout' is set the 'on_timeout' callbacks are run when the state hasn't been left within that many seconds, on the
+    model's timer wheel
+    """
+
+    dynamic_methods = State.dynamic_methods + ['on_timeout']
+
+    def __init__(self, *args, **kwargs):
+        self.timeout = kwargs.pop('timeout', 0)
+        self.on_timeout = listify(kwargs.pop('on_timeout', []))
+        if self.timeout > 0 and not self.on_timeout:
+            raise AttributeError("Timeout state requires 'on_timeout' when timeout is set.")
+        self.runner = {}
+        super(TimeoutState, self).__init__(*args, **kwargs)
+
+    def enter(self, event_data):
+        if self.timeout > 0:
+            # A timeout runs a whole transition (connecting, audio, the spool), not on the wheel thread that the other timers need
+            timer = event_data.model.wheel.call_later(self.timeout, self._process_timeout, event_data,
+                                                      name=f"{self.name} timeout", offload=True)
+            self.runner[id(event_data.model)] = timer
+        return super(TimeoutState, self).enter(event_data)
+
+    def exit(self, event_data):
+        timer = self.runner.get(id(event_data.model), None)
+        if timer is not None:
+            timer.cancel()
+        return super(TimeoutState, self).exit(event_data)
+
+    def _process_timeout(self, event_data):
+        for callback in self.on_timeout:
+            event_data.machine.callback(callback, event_data)
+
+
 class TimeoutMachine(Machine):
-    pass
+    state_cls = TimeoutState
 
 
 class GameLogic(object):
 
+    door_opening_expected_within = 2.0
+    """ Seconds from the granted scan until the door should report that it's opening, later than that we probe the server """
+
     # All the states, initial being "find server"
     states = ["init", "idle",
               {"name": "find_server", "timeout": (8 + randint(-2, 2)), "on_timeout": "server_not_found"},
-              {"name": "connecting_to_server", "timeout": (15 + randint(-2, 2)), "on_timeout": "server_conn_failed"},
+              # Longer than the longest backoff delay and the attempt after it, a retry that is waiting isn't cut off by a new search
+              {"name": "connecting_to_server", "timeout": (ReconnectBackoff.DEFAULT_CAP + ServerCommunicator.connect_timeout + randint(3, 7)),
+               "on_timeout": "server_conn_failed"},
               {"name": "get_config", "timeout": (5 + randint(-1, 3)), "on_timeout": "config_failed"},
               "tag_scanned", "door_open", "active", "closed", "shutting_down", "ended", "ended_feedback", "reboot_state"]
 
@@ -63,15 +112,31 @@ class GameLogic(object):
     ]
 
     def __init__(self, game_idle: Callable[[None], None], game_starting: Callable[[int, Language], None], game_started: Callable[[None], None],
-                 game_went_wrong: Callable[[BadEvent], None],  on_connection_lost: Callable[[None], None] = None, game_length_sec: int = 300, audio_buffer=4096) -> None:
+                 game_went_wrong: Callable[[BadEvent], None],  on_connection_lost: Callable[[None], None] = None, game_length_sec: int = 300, audio_buffer: int = None,
+                 audio_handler: AudioHandler = None, network: NetworkIdentity = None, server: Tuple[str, int] = None,
+                 wheel: TimerWheel = None, record_traffic: bool = True, on_room_status: Callable[[str, int], None] = None) -> None:
         
+        self.__access_granted_at: float = None
+
         self.game_active = False
         """ Indicates whether the game is active or not, used for moments when the server has disconnected to return to the game state
         """
 
-        """ The main logic of the Game, handles every boring aspect """
-        self.audio_handler = AudioHandler(f"{os.path.dirname(os.path.realpath(__file__))}{os.path.sep}sounds", audio_buffer)
-        """ Audio handler (accessible as a member in GameLogic for advanced users) """
+        """ The main logic of the Game, handles every boring aspect.
+        'audio_handler', 'network' and 'server' stand in for the Pi's sound, identity and server search, e.g. in the simulator.
+        'wheel' is where every timer of the room runs (the shared wheel if it's None), 'record_traffic' and 'on_room_status'
+        are handed to the communicator, a replay uses them to run a room of its own """
+        self.wheel = wheel if wheel is not None else shared_wheel()
+        if audio_handler is None:
+            if audio_buffer is None:
+                # The smallest stable buffer found by 'python3 -m utils.AudioCalibration', 4096 if it hasn't been run
+                audio_buffer = saved_buffer()
+            audio_handler = AudioHandler(f"{os.path.dirname(os.path.realpath(__file__))}{os.path.sep}sounds", audio_buffer, lazy_init=True)
+        self.audio_handler = audio_handler
+        """ Audio handler (accessible as a member in GameLogic for advanced users), the mixer starts in the background while we find the server """
+        self.audio_prefetcher = AudioPrefetcher(self.audio_handler)
+        """ Loads the team's ending clips while they walk in, set 'budget_bytes' on it to limit the memory it uses """
+        self.__language: Language = None
 
         self.auto_play_background_music = True
         """ Set if you want to start the music yourself instead of automatically """
@@ -89,11 +154,11 @@ class GameLogic(object):
         self.__times_played_please_leave = 0
 
         # If the main program is running tkinter, we use the mainloops own timer functionality
-        self.__game_timer = GameTimer(game_length_sec)
+        self.__game_timer = GameTimer(game_length_sec, self.wheel)
         self.__game_timer.set_callback(self.max_time_reached)
 
         # Debug specific threads
-        self.__debug_thread = None
+        self.__debug_timer = None
         self.__debug_mode = False
 
         self.game_idle = game_idle
@@ -102,22 +167,66 @@ class GameLogic(object):
         self.game_went_wrong = game_went_wrong
         self.__on_connection_lost = on_connection_lost
         
-        self.communicator = ServerCommunicator(
-            lambda: self.trigger("server_connected"), self.__cb_lost_server, self.__cb_server_conf_recieved, self.__cb_server_message_received, 
-            on_message_other_room = self.__cb_on_message_other_received)
-        self.server_finder = ServerFinder(self.__cb_found_server)
+        # Messages are dispatched on the topic's channel first and then on the value that decides what to do
+        self.__message_handlers = {
+            Topics.SET_STATUS.value: self.__on_set_status,
+            Topics.DOOR_STATUS.value: self.__on_door_status,
+            Topics.SCAN_RESULT.value: self.__on_scan_result,
+        }
+        self.__set_status_handlers = {
+            # Force stop or something? pass the reason as well
+            RoomStatus.STOP.value: lambda message: self.trigger("game_ended", reason=BadEvent(message.reason)),
+            RoomStatus.RESET.value: self.__on_reset_requested,
+            RoomStatus.REBOOT.value: lambda message: self.trigger("reboot_system"),
+            RoomStatus.SHUTDOWN.value: lambda message: self.trigger("shutdown_system"),
+            # Game has ended, send message upwards and let the room logic decide
+            RoomStatus.ENDED.value: lambda message: self.trigger("game_ended", reason=BadEvent.GAME_ENDED),
+        }
+        self.__door_status_handlers = {
+            DoorStatus.IDLING.value: self.__on_door_idling,
+            DoorStatus.DOOR_OPENING_STARTING.value: self.__on_door_opening_starting,
+            DoorStatus.DOOR_CLOSED_STARTING.value: self.__on_door_closed_starting,
+            # Door has closed and we've entered the active phase
+            DoorStatus.ACTIVE.value: lambda: self.trigger("game_active"),
+            # Opened during the game
+            DoorStatus.DOOR_OPENED_FAILED.value: lambda: self.trigger("door_failed"),
+            DoorStatus.TEAM_STILL_IN_ROOM.value: self.__on_team_still_in_room,
+        }
+        self.__other_room_handlers = {
+            Topics.ROOM_STATUS.value: self.__on_other_room_status,
+            Topics.DOOR_STATUS.value: self.__on_other_door_status,
+        }
 
+        self.communicator = ServerCommunicator(
+            self.__cb_server_connected, self.__cb_lost_server, self.__cb_server_conf_recieved, self.__cb_server_message_received, 
+            on_message_other_room = self.__cb_on_message_other_received, network=network, wheel=self.wheel,
+            record_traffic=record_traffic, on_room_status=on_room_status)
+        self.server_finder = ServerFinder(self.__cb_found_server, fixed=server, wheel=self.wheel)
+
+        # Recorded with the communicator's metrics, the room's registry or the simulated room's own
+        self.__transitions = self.communicator.telemetry.counter("fsm.transitions")
+        self.__transition_ms = self.communicator.telemetry.histogram("fsm.transition_ms")
         self.machine = TimeoutMachine(model=self, states=GameLogic.states, transitions=GameLogic.transitions,
-                                      initial="init", send_event=True, ignore_invalid_triggers=True)
+                                      initial="init", send_event=True, ignore_invalid_triggers=True,
+                                      prepare_event=self.__transition_started, finalize_event=self.__transition_finished)
 
     
-    def set_tk_timer(self, tk_object: tk.Tk):
+    def set_tk_timer(self, tk_object: "tk.Tk"):
         self.__game_timer.use_tk_as_timer(tk_object)
 
     def cleanup(self):
         self.server_finder.cleanup()
         self.communicator.disconnect(exiting=True)
     
+    def __transition_started(self, event: EventData):
+        event.started = perf_counter()
+
+    def __transition_finished(self, event: EventData):
+        # From the trigger until every callback of the transition (exit, enter ...) has run
+        if event.result:
+            self.__transitions.inc()
+            self.__transition_ms.observe((perf_counter() - event.started) * 1000)
+
     # Condition functions as helpers to the FSM
     def game_is_active(self, event):
         return self.game_active
@@ -137,8 +246,7 @@ class GameLogic(object):
         Optional parameter 'debug_mode' can be set so that it automatically calls room activation after a couple of seconds!
         """
         if debug_mode:
-            self.__debug_thread = Timer(.5, self.__cb_found_server, ["", 0])
-            self.__debug_thread.start()
+            self.__debug_timer = self.wheel.call_later(.5, self.__cb_found_server, "", 0, name="debug", offload=True)
         
         self.__debug_mode = debug_mode
 
@@ -242,6 +350,10 @@ class GameLogic(object):
         Log.print(self.state, "ServerFinder found a valid server !")
         self.trigger("server_found", addr=addr, port=port)
 
+    def __cb_server_connected(self):
+        self.server_finder.report_connected()
+        self.trigger("server_connected")
+
     def __cb_lost_server(self):
         Log.print(self.state, "Lost it!")
         if self.__on_connection_lost is not None:
@@ -251,137 +363,133 @@ class GameLogic(object):
     def __cb_server_message_received(self, topic, message):
         # Debug print
         #print("LOGIC: Recieved topic: " + topic + " - message: " + json.dumps(message))
-        if Topics.SET_STATUS.value in topic:
-            msg = message['access']
-
-            if msg == RoomStatus.STOP.value:
-                # Force stop or something? pass the reason as well
-                self.trigger("game_ended", reason=BadEvent(message['reason']))
-
-            elif msg == RoomStatus.RESET.value:
-                # Play game over sounds also! to indicate that they should leave the room
-                # Is this dead code? We are sending door status idling to reset the rooms now
-                if self.state == 'active':
-                    self.trigger("game_ended", reason=BadEvent.THROW_OUT_GROUP)
-                else:
-                    self.trigger("game_reset", send_to_server=False)
-            
-            elif msg == RoomStatus.REBOOT.value: 
-                self.trigger("reboot_system")
-            
-            elif msg == RoomStatus.SHUTDOWN.value:
-                self.trigger("shutdown_system")
-            
-            elif msg == RoomStatus.ENDED.value:
-                # Game has ended, send message upwards and let the room logic decide
-                self.trigger("game_ended", reason=BadEvent.GAME_ENDED)
-
-        if Topics.DOOR_STATUS.value in topic:
-            info = message['info']
-            if info == DoorStatus.IDLING.value and self.state != "idle":
-                if self.__points == None:
-                    # We haven't received our config yet
-                    return
-                
-                if self.state == 'active':
-                    self.trigger("game_ended", reason=BadEvent.THROW_OUT_GROUP)
-                    
-                elif self.state != "ended":
-                    # Eg. when door has been blipped and no one opened, they just ignored. we just reset
-                    self.trigger("game_reset", send_to_server=False)
-                else:
-                    # People left the room and the door is signaling that its idle now
-                    self.trigger("game_ended")
-
-            elif info == DoorStatus.DOOR_OPENING_STARTING.value:
-                self.trigger("game_starting")
-            
-            elif info == DoorStatus.DOOR_CLOSED_STARTING.value:
-                # Door has closed, check if we have a callback set
-                if self.__on_door_closed is not None:
-                    self.__on_door_closed()
-                
-                if self.__debug_mode:
-                    self.__debug_thread = Timer(0.5, self.__cb_server_message_received, ["door_status", { 'info': DoorStatus.ACTIVE.value}])
-                    self.__debug_thread.start()
-
-            elif info == DoorStatus.ACTIVE.value:
-                # Door has closed and we've entered the active phase
-                self.trigger("game_active")
-
-            elif info == DoorStatus.DOOR_OPENED_FAILED.value:
-                # Opened during the game
-                self.trigger("door_failed")
-
-            elif info == DoorStatus.TEAM_STILL_IN_ROOM.value:
-                # Play music that they should leave
-                # We keep a count of how many times they've complained about it, We are doing it here so that the sound doesn't
-                # become all garbled up when playing half of the please leave the room
-                self.__times_played_please_leave +=1
-                if self.__times_played_please_leave == 4:
-                    self.trigger("game_reset", send_to_server=True, final_sendoff=True)
-                else:
-                    self.audio_handler.play_please_leave_room(volume=0.5)
-
-        if Topics.SCAN_RESULT.value in topic:
-            if message['access'] == Access.SUCCESS.value: 
-                # No need for trigger as the server grants us access
-                self.trigger("access_granted", members=message['members'], lang=Language(message['lang']))
+        handler = self.__message_handlers.get(topic)
+        if handler is not None:
+            handler(message)
+
+    def __on_set_status(self, message: SetStatusMessage):
+        handler = self.__set_status_handlers.get(message.access)
+        if handler is not None:
+            handler(message)
+
+    def __on_reset_requested(self, message: SetStatusMessage):
+        # Play game over sounds also! to indicate that they should leave the room
+        # Is this dead code? We are sending door status idling to reset the rooms now
+        if self.state == 'active':
+            self.trigger("game_ended", reason=BadEvent.THROW_OUT_GROUP)
+        else:
+            self.trigger("game_reset", send_to_server=False)
+
+    def __on_door_status(self, message: DoorStatusMessage):
+        handler = self.__door_status_handlers.get(message.info)
+        if handler is not None:
+            handler()
+
+    def __on_door_opening_starting(self):
+        if self.__access_granted_at is not None:
+            delay = monotonic() - self.__access_granted_at
+            self.__access_granted_at = None
+            if delay > GameLogic.door_opening_expected_within:
+                # The door opens right after the scan, finding out whether the network or the broker was slow
+                print(f"LOGIC: The door took {delay:.1f} s to report opening, probing the server")
+                self.communicator.probe_rtt(f"{Topics.DOOR_STATUS.value} late")
+        self.trigger("game_starting")
+
+    def __on_door_idling(self):
+        if self.state == "idle":
+            return
+        if self.__points == None:
+            # We haven't received our config yet
+            return
 
-        
+        if self.state == 'active':
+            self.trigger("game_ended", reason=BadEvent.THROW_OUT_GROUP)
+
+        elif self.state != "ended":
+            # Eg. when door has been blipped and no one opened, they just ignored. we just reset
+            self.trigger("game_reset", send_to_server=False)
+        else:
+            # People left the room and the door is signaling that its idle now
+            self.trigger("game_ended")
+
+    def __on_door_closed_starting(self):
+        # Door has closed, check if we have a callback set
+        if self.__on_door_closed is not None:
+            self.__on_door_closed()
+
+        if self.__debug_mode:
+            self.__debug_timer = self.wheel.call_later(0.5, self.__cb_server_message_received, "door_status", DoorStatusMessage(info=DoorStatus.ACTIVE.value), name="debug", offload=True)
+
+    def __on_team_still_in_room(self):
+        # Play music that they should leave
+        # We keep a count of how many times they've complained about it, We are doing it here so that the sound doesn't
+        # become all garbled up when playing half of the please leave the room
+        self.__times_played_please_leave +=1
+        if self.__times_played_please_leave == 4:
+            self.trigger("game_reset", send_to_server=True, final_sendoff=True)
+        else:
+            self.audio_handler.play_please_leave_room(volume=0.5)
+
+    def __on_scan_result(self, message: ScanResultMessage):
+        if message.access == Access.SUCCESS.value:
+            self.__access_granted_at = monotonic()
+            # No need for trigger as the server grants us access
+            self.trigger("access_granted", members=message.members, lang=Language(message.lang))
 
     def __cb_on_message_other_received(self, topic, msg):
-        type = self.communicator.get_room_type()
-        slave = self.communicator.is_double_room_slave()
         #print(f"LOGIC: Other room message - topic: {topic}, - msg: {msg}")
         if self.__on_double_room_event is None:
             raise Exception("Event listener not set for double room events!! cannot proceed")
 
-        if Topics.ROOM_STATUS.value in topic:
-            other_room_status = msg["status"]
-            
-            if other_room_status == RoomStatus.LOST.value and slave and self.state == 'active':
-                if type == DoubleRoomType.COMPETITION:
-                    self.__on_double_room_event(DoubleRoomStatus.TEAM_WON)
-                elif type == DoubleRoomType.COOPERATIVE:
-                    self.__on_double_room_event(DoubleRoomStatus.TEAM_LOST)
-
-            elif other_room_status == RoomStatus.WON.value and slave and self.state == 'active':
-                if type == DoubleRoomType.COMPETITION:
-                    self.__on_double_room_event(DoubleRoomStatus.TEAM_LOST)
-                elif type == DoubleRoomType.COOPERATIVE:
-                    self.__on_double_room_event(DoubleRoomStatus.TEAM_WON)
-                    
-            elif other_room_status == RoomStatus.RESET.value:
-                if type == DoubleRoomType.COMPETITION and self.state == 'active':
-                    self.__on_double_room_event(DoubleRoomStatus.TEAM_WON)
-                elif type == DoubleRoomType.COOPERATIVE:
-                    self.trigger("game_reset")
-
-        elif Topics.DOOR_STATUS.value in topic:
-            other_door_info = msg['info']
-
-            if other_door_info == DoorStatus.DOOR_OPENED_FAILED.value and self.state == 'active':
-                if type == DoubleRoomType.COMPETITION:
-                    self.__on_double_room_event(DoubleRoomStatus.TEAM_WON)
-                elif type == DoubleRoomType.COOPERATIVE:
-                    self.__on_double_room_event(DoubleRoomStatus.TEAM_LOST)
-            
-            elif other_door_info == DoorStatus.TEAM_STILL_IN_ROOM.value and self.state != 'ended':
-                # If we are in ended as well we are perhaps taking care of this already, no need to be nagging
-                self.__times_played_please_leave +=1
-                if self.__times_played_please_leave == 4:
-                    self.audio_handler.play_please_leave_room(last_statement=True, volume=0.8)
-                    self.__times_played_please_leave = 0
-                else:
-                    self.audio_handler.play_please_leave_room(volume=0.5)
-
-    def __cb_server_conf_recieved(self, success, config: dict):
+        handler = self.__other_room_handlers.get(topic)
+        if handler is not None:
+            handler(msg, self.communicator.get_room_type(), self.communicator.is_double_room_slave())
+
+    def __on_other_room_status(self, msg: RoomStatusMessage, type: DoubleRoomType, slave: bool):
+        other_room_status = msg.status
+
+        if other_room_status == RoomStatus.LOST.value and slave and self.state == 'active':
+            if type == DoubleRoomType.COMPETITION:
+                self.__on_double_room_event(DoubleRoomStatus.TEAM_WON)
+            elif type == DoubleRoomType.COOPERATIVE:
+                self.__on_double_room_event(DoubleRoomStatus.TEAM_LOST)
+
+        elif other_room_status == RoomStatus.WON.value and slave and self.state == 'active':
+            if type == DoubleRoomType.COMPETITION:
+                self.__on_double_room_event(DoubleRoomStatus.TEAM_LOST)
+            elif type == DoubleRoomType.COOPERATIVE:
+                self.__on_double_room_event(DoubleRoomStatus.TEAM_WON)
+
+        elif other_room_status == RoomStatus.RESET.value:
+            if type == DoubleRoomType.COMPETITION and self.state == 'active':
+                self.__on_double_room_event(DoubleRoomStatus.TEAM_WON)
+            elif type == DoubleRoomType.COOPERATIVE:
+                self.trigger("game_reset")
+
+    def __on_other_door_status(self, msg: DoorStatusMessage, type: DoubleRoomType, slave: bool):
+        other_door_info = msg.info
+
+        if other_door_info == DoorStatus.DOOR_OPENED_FAILED.value and self.state == 'active':
+            if type == DoubleRoomType.COMPETITION:
+                self.__on_double_room_event(DoubleRoomStatus.TEAM_WON)
+            elif type == DoubleRoomType.COOPERATIVE:
+                self.__on_double_room_event(DoubleRoomStatus.TEAM_LOST)
+
+        elif other_door_info == DoorStatus.TEAM_STILL_IN_ROOM.value and self.state != 'ended':
+            # If we are in ended as well we are perhaps taking care of this already, no need to be nagging
+            self.__times_played_please_leave +=1
+            if self.__times_played_please_leave == 4:
+                self.audio_handler.play_please_leave_room(last_statement=True, volume=0.8)
+                self.__times_played_please_leave = 0
+            else:
+                self.audio_handler.play_please_leave_room(volume=0.5)
+
+    def __cb_server_conf_recieved(self, success, config: ConfigMessage):
         if success:
             print(f"LOGIC: Config recieved: {config}")
 
             # We are only picking up the points from the config atm.
-            self.__points = config['points']
+            self.__points = config.points
 
             if self.__debug_mode:
                 self.machine.set_state("get_config")
@@ -427,8 +535,7 @@ class GameLogic(object):
             self.communicator.connect(addr, port)
         else:
             print("LOGIC: Server connected!, requesting config")
-            self.__debug_thread = Timer(1.5, self.__cb_server_conf_recieved, [True, { 'points': [100, 200, 300]}])
-            self.__debug_thread.start()
+            self.__debug_timer = self.wheel.call_later(1.5, self.__cb_server_conf_recieved, True, ConfigMessage(room="debug", points=[100, 200, 300]), name="debug", offload=True)
         
 
     # get_config
@@ -437,10 +544,16 @@ class GameLogic(object):
         self.__points = None
         self.communicator.send_config_request()
 
+        if self.communicator.config is not None:
+            # The config we last ran with (cached or from before the connection was lost) is used right away, the
+            # server's copy only comes through if it's different
+            self.__cb_server_conf_recieved(True, self.communicator.config)
+
     # idle
     def on_enter_idle(self, event: EventData):
         Log.print(self.state, "Enter idle from: " + str(event.event.name))
         self.audio_handler.stop_all_music_and_sound()
+        self.audio_prefetcher.release()
         self.__times_played_please_leave = 0
         
         # Since we can end up here from many places we need to double check and notify the programming
@@ -460,9 +573,8 @@ class GameLogic(object):
         self.game_idle()
 
         if self.__debug_mode:
-            self.__cb_server_message_received("tag_scan_result", {'access': 'success', 'members': 4, 'lang': Language.SWEDISH.value})
-            self.__debug_thread = Timer(1, self.__cb_server_message_received, ["door_status", { 'info': DoorStatus.DOOR_OPENING_STARTING.value}])
-            self.__debug_thread.start()
+            self.__cb_server_message_received("tag_scan_result", ScanResultMessage(access=Access.SUCCESS.value, members=4, lang=Language.SWEDISH.value))
+            self.__debug_timer = self.wheel.call_later(1, self.__cb_server_message_received, "door_status", DoorStatusMessage(info=DoorStatus.DOOR_OPENING_STARTING.value), name="debug", offload=True)
 
     
     # tag_scanned
@@ -471,18 +583,21 @@ class GameLogic(object):
         members = event.kwargs.get("members")
         language = event.kwargs.get("lang")
 
+        self.__language = language
+        self.audio_prefetcher.prefetch(self.__points, language)
         self.game_starting(members, language)
 
     # door_open
     def on_enter_door_open(self, event):
         Log.print(self.state, "Enter door_open")
-        
+        # Only starts loading if nothing was prefetched for the team yet
+        self.audio_prefetcher.prefetch(self.__points, self.__language)
+
         if self.__on_door_opening is not None:
             self.__on_door_opening()
         
         if self.__debug_mode:
-            self.__debug_thread = Timer(1, self.__cb_server_message_received, ["door_status", { 'info': DoorStatus.DOOR_CLOSED_STARTING.value}])
-            self.__debug_thread.start()
+            self.__debug_timer = self.wheel.call_later(1, self.__cb_server_message_received, "door_status", DoorStatusMessage(info=DoorStatus.DOOR_CLOSED_STARTING.value), name="debug", offload=True)
 
     # active
     def on_enter_active(self, event):
@@ -9,8 +9,7 @@ import os
 class GameLogic(object):
     """ The main logic of the Game, handles every boring aspect """
 
-    audio_handler = AudioHandler(f"{os.path.dirname(os.path.realpath(__file__))}{os.path.sep}sounds")
-    """ Audio handler (accessible as a member in GameLogic for advanced users) """
+    __audio_handler: AudioHandler = None
 
     auto_play_background_music = True
     """ Set if you want to start the music yourself instead of automatically """
@@ -49,6 +48,13 @@ class GameLogic(object):
             self.__server_connected, self.__server_lost, self.__server_config_recieved, self.__server_message_recieved)
         self.finder = ServerFinder(self.__server_found)
 
+    @property
+    def audio_handler(self) -> AudioHandler:
+        """ Audio handler (accessible as a member in GameLogic for advanced users), the mixer is started on first use """
+        if GameLogic.__audio_handler is None:
+            GameLogic.__audio_handler = AudioHandler(f"{os.path.dirname(os.path.realpath(__file__))}{os.path.sep}sounds")
+        return GameLogic.__audio_handler
+
     def __server_lost(self):
         print("LOGIC: Server Lost, attempting to search again ...")
         if self.__on_connection_lost is not None:
@@ -1,19 +1,23 @@
-import threading
-import tkinter as Tk
-from typing import Callable
+from typing import Callable, TYPE_CHECKING
 
 from datetime import datetime
 
+from .TimerWheel import TimerWheel, shared_wheel
+
+if TYPE_CHECKING:
+    import tkinter as Tk
+
 class GameTimer:
-    def __init__(self, game_time_seconds: int):
+    def __init__(self, game_time_seconds: int, wheel: TimerWheel = None):
         """
         Initialize the timer. 
-        - If `use_tk` is None, it uses threading.Timer.
+        - If `use_tk` is None, it uses `wheel`, the shared timer wheel if it's None.
         - If `use_tk` is a Tkinter `Tk` object, it uses `after`.
         :param use_tk: Tkinter object if using Tkinter based timer.
         """
         
         self._tk_obj = None
+        self._wheel = wheel
         self._timer = None
         self._is_running = False
         self._timeout_event_started: datetime = None
@@ -37,15 +41,16 @@ class GameTimer:
     def set_callback(self, callback: Callable[[None], None]):
         self.callback = callback
     
-    def use_tk_as_timer(self, tk_object: Tk.Tk):
+    def use_tk_as_timer(self, tk_object: "Tk.Tk"):
         """ Use tk instead, stops current timer too """
         self.cancel()
         self._tk_obj = tk_object
 
     def _start_threading_timer(self, seconds: int):
-        """Starts a threading.Timer based timer."""
-        self._timer = threading.Timer(seconds, self._time_up)
-        self._timer.start()
+        """Starts the timer on the timer wheel."""
+        # Time up ends the game (transitions, audio), it runs on the wheel's worker thread
+        wheel = self._wheel if self._wheel is not None else shared_wheel()
+        self._timer = wheel.call_later(seconds, self._time_up, name="game timer", offload=True)
 
     def _start_tk_timer(self, seconds: int):
         """Starts a Tkinter-based timer using `after`."""
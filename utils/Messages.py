@@ -0,0 +1,145 @@
+from typing import Dict, List, Tuple
+
+from .constants import Access, BadEvent, DoubleRoomType, Language, RoomStatus, Topics
+
+
+class MessageError(ValueError):
+    """ The payload doesn't have the fields (or types) the topic's message needs """
+
+
+class Message(object):
+    """ Base for the messages of the known topics, decoded and validated once when they arrive.
+
+    'fields' maps each field to its type(s) and whether it's required, e.g. {"info": (str, True)}. Missing optional fields
+    are None. The fields can also be read like the dict the handlers used to get (message['info'])
+    """
+
+    __slots__ = ()
+    fields: Dict[str, Tuple[tuple, bool]] = {}
+
+    def __init__(self, **values):
+        for name in self.fields:
+            setattr(self, name, values.get(name))
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Message":
+        """Validates the decoded payload and returns the message
+
+        Raises:
+            MessageError: If a required field is missing or a field has the wrong type
+        """
+        if not isinstance(data, dict):
+            raise MessageError(f"{cls.__name__}: expected an object, got {type(data).__name__}")
+
+        values = {}
+        for name, (types, required) in cls.fields.items():
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise MessageError(f"{cls.__name__}: '{name}' is missing")
+            elif not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+                raise MessageError(f"{cls.__name__}: '{name}' should be {' or '.join(t.__name__ for t in types)}, got {value!r}")
+            values[name] = value
+
+        message = cls(**values)
+        message.validate()
+        return message
+
+    def validate(self):
+        """ Checks between fields, raise MessageError if they don't add up """
+        pass
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.fields if getattr(self, name) is not None}
+
+    def __getitem__(self, name: str):
+        if name not in self.fields:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.fields and getattr(self, name) is not None
+
+    def get(self, name: str, default=None):
+        value = getattr(self, name, None) if name in self.fields else None
+        return default if value is None else value
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()})"
+
+
+class SetStatusMessage(Message):
+    """ The server tells the room what to do, 'room/<room>/set_status' """
+    __slots__ = ("access", "reason")
+    fields = {"access": ((str,), True), "reason": ((int,), False)}
+
+    def validate(self):
+        # A stop is handed on with its reason, it can't go without one
+        if self.access == RoomStatus.STOP.value and self.reason is None:
+            raise MessageError("SetStatusMessage: a stop needs 'reason'")
+        if self.reason is not None and self.reason not in BadEvent._value2member_map_:
+            raise MessageError(f"SetStatusMessage: unknown reason {self.reason}")
+
+
+class DoorStatusMessage(Message):
+    """ What the door is doing, 'door/<room>/door_status' """
+    __slots__ = ("info",)
+    fields = {"info": ((str,), True)}
+
+
+class ScanResultMessage(Message):
+    """ The result of a tag scan at the door, 'door/<room>/tag_scan_result' """
+    __slots__ = ("access", "members", "lang")
+    fields = {"access": ((str,), True), "members": ((int,), False), "lang": ((str,), False)}
+
+    def validate(self):
+        # A granted scan starts the game, it needs everything the game needs
+        if self.access != Access.SUCCESS.value:
+            return
+        if self.members is None:
+            raise MessageError("ScanResultMessage: 'members' is missing")
+        if self.lang not in Language._value2member_map_:
+            raise MessageError(f"ScanResultMessage: unknown language {self.lang!r}")
+
+
+class RoomStatusMessage(Message):
+    """ What a room reports, 'room/<room>/room_status' (we only listen to the other room of a double room) """
+    __slots__ = ("status", "mac", "room", "level", "msgId")
+    fields = {"status": ((str,), True), "mac": ((str,), False), "room": ((str, int), False), "level": ((int,), False),
+              "msgId": ((str,), False)}
+
+
+class ConfigMessage(Message):
+    """ The room's configuration, 'config/<mac>/recieve'. The room is 'removed' if the room has been taken out """
+    __slots__ = ("room", "points", "roomType", "otherRoomNbr", "isRoomSpy", "contentType", "telemetryInterval")
+    fields = {"room": ((str, int), True), "points": ((list,), False), "roomType": ((str,), False),
+              "otherRoomNbr": ((str, int), False), "isRoomSpy": ((bool,), False), "contentType": ((str,), False),
+              "telemetryInterval": ((int, float), False)}
+
+    def validate(self):
+        if str(self.room) == "removed":
+            return
+        if self.points is None:
+            raise MessageError("ConfigMessage: 'points' is missing")
+        if self.roomType is not None:
+            if self.roomType not in DoubleRoomType._value2member_map_:
+                raise MessageError(f"ConfigMessage: unknown room type {self.roomType!r}")
+            if self.otherRoomNbr is None:
+                raise MessageError("ConfigMessage: a double room needs 'otherRoomNbr'")
+
+
+class EchoMessage(Message):
+    """ The server's echo of our round trip probe, 'probe/<mac>/echo' """
+    __slots__ = ("id", "reason")
+    fields = {"id": ((int,), True), "reason": ((str,), False)}
+
+
+MESSAGE_TYPES = {
+    Topics.SET_STATUS.value: SetStatusMessage,
+    Topics.DOOR_STATUS.value: DoorStatusMessage,
+    Topics.SCAN_RESULT.value: ScanResultMessage,
+    Topics.ROOM_STATUS.value: RoomStatusMessage,
+    "recieve": ConfigMessage,
+    "echo": EchoMessage,
+}
+""" The message type of each topic channel """
@@ -0,0 +1,620 @@
+from base64 import b64decode, b64encode
+from threading import Event, Lock, RLock, Thread
+from time import monotonic
+from typing import Callable, Dict, List, Tuple
+
+import json
+import os
+import select
+import socket
+import tempfile
+
+from .lazy import lazy_import
+from .NetworkIdentity import network_identity
+from .ReconnectBackoff import ReconnectBackoff
+
+mqtt = lazy_import("paho.mqtt.client")
+
+MUX_SOCKET_ENV = "ROOM_MQTT_MUX"
+""" Set the environment variable to put the multiplexer's socket somewhere else """
+
+# paho's return codes, so the client can stand in for paho's without importing it
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+MQTT_ERR_CONN_LOST = 7
+
+
+MUX_RUNTIME_DIR = "/run/room-mqtt"
+""" Made by systemd for room-mqtt.service (RuntimeDirectory=), only the service user and its group can enter it """
+
+
+def mux_socket_path() -> str:
+    """ The multiplexer's Unix socket. Anyone who can connect to it publishes with the room's broker credentials, so it's
+    in the service's runtime directory where the game (the user) and the system handler (root) can reach it and nobody
+    else can. Without the service (development) it's in a directory of the user's own in the temp directory """
+    if MUX_SOCKET_ENV in os.environ:
+        return os.environ[MUX_SOCKET_ENV]
+    if os.path.isdir(MUX_RUNTIME_DIR):
+        return os.path.join(MUX_RUNTIME_DIR, "mqtt.sock")
+    return os.path.join(tempfile.gettempdir(), f"room-utils-{os.getuid()}", "mqtt.sock")
+
+
+def _frame(frame: dict) -> bytes:
+    return json.dumps(frame, separators=(",", ":")).encode() + b"\n"
+
+
+def _pack(payload: bytes) -> str:
+    return b64encode(payload).decode("ascii")
+
+
+class MuxMessage(object):
+    """ A message from the multiplexer, with the attributes of paho's MQTTMessage that the room uses """
+    __slots__ = ("topic", "payload", "qos", "retain", "mid")
+
+    def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = 0
+
+
+class MuxPublishInfo(object):
+    """ What publish returns, like paho's MQTTMessageInfo. QoS 0 is published once it's written to the multiplexer,
+    QoS 1 and 2 when the broker has acknowledged it to the multiplexer """
+    __slots__ = ("mid", "rc", "published")
+
+    def __init__(self, mid: int):
+        self.mid = mid
+        self.rc = MQTT_ERR_SUCCESS
+        self.published = False
+
+    def is_published(self) -> bool:
+        return self.published
+
+
+class MuxClient(object):
+    """ Attaches to the local multiplexer, with the part of paho's Client interface the room uses.
+
+    It's driven the same way: connect, then loop on one thread while socket() isn't None. on_connect is called once the
+    multiplexer is connected to the broker, on_disconnect when the multiplexer goes away or loses the broker. The last
+    will is handed over when attaching, the multiplexer publishes it if we go away without disconnecting
+    """
+
+    def __init__(self, client_id: str = "", path: str = None):
+        """
+        Args:
+            client_id (str, optional): Names the client in the multiplexer's stats and logs. Defaults to "".
+            path (str, optional): The multiplexer's socket. Defaults to mux_socket_path().
+        """
+        self.client_id = client_id
+        self.path = path
+
+        self.on_connect: Callable = None
+        self.on_disconnect: Callable = None
+        self.on_message: Callable = None
+        self.on_publish: Callable = None
+
+        self.identity: dict = {}
+        """ The room's MAC, IP and hostname as the multiplexer knows them, from when it accepted us """
+
+        self.__sock: socket.socket = None
+        self.__buffer = b""
+        self.__connected = False
+        self.__will: dict = None
+        self.__write_lock = RLock()
+        self.__mid = 0
+        self.__pending: Dict[int, MuxPublishInfo] = {}
+
+    def username_pw_set(self, username: str, password: str = None):
+        # The multiplexer logs in to the broker, there is nothing to log in to here
+        pass
+
+    def will_set(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.__will = {"t": topic, "p": _pack(self.__bytes(payload)), "q": qos, "r": retain}
+
+    def connect(self, host: str = None, port: int = 0, keepalive: int = 60) -> int:
+        """ Attaches to the multiplexer at 'host' (a socket path), or at the client's path. Raises OSError if it isn't
+        running """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(host or self.path or mux_socket_path())
+        except OSError:
+            sock.close()
+            raise
+        with self.__write_lock:
+            self.__sock = sock
+            self.__buffer = b""
+            hello = {"op": "hello", "id": self.client_id}
+            if self.__will is not None:
+                hello["will"] = self.__will
+            self.__write(hello)
+        return MQTT_ERR_SUCCESS
+
+    def socket(self) -> socket.socket:
+        return self.__sock
+
+    def is_connected(self) -> bool:
+        return self.__connected
+
+    def disconnect(self) -> int:
+        if self.__sock is None:
+            return MQTT_ERR_NO_CONN
+        try:
+            self.__write({"op": "bye"})
+        except OSError:
+            pass
+        self.__dropped(MQTT_ERR_SUCCESS)
+        return MQTT_ERR_SUCCESS
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False) -> MuxPublishInfo:
+        with self.__write_lock:
+            self.__mid = self.__mid % 65535 + 1
+            info = MuxPublishInfo(self.__mid)
+            if not self.__connected:
+                info.rc = MQTT_ERR_NO_CONN
+                return info
+            if qos:
+                # Known before the write, the ack can come back on the loop's thread before we get here again
+                self.__pending[info.mid] = info
+            try:
+                self.__write({"op": "pub", "mid": info.mid, "t": topic, "p": _pack(self.__bytes(payload)), "q": qos,
+                              "r": retain})
+            except OSError:
+                self.__pending.pop(info.mid, None)
+                info.rc = MQTT_ERR_NO_CONN
+                return info
+            info.published = not qos
+        if info.published and self.on_publish is not None:
+            self.on_publish(self, None, info.mid)
+        return info
+
+    def subscribe(self, topic: str, qos: int = 0) -> Tuple[int, int]:
+        return self.__request({"op": "sub", "t": topic, "q": qos})
+
+    def unsubscribe(self, topic: str) -> Tuple[int, int]:
+        return self.__request({"op": "unsub", "t": topic})
+
+    def loop(self, timeout: float = 1.0) -> int:
+        """ Waits up to 'timeout' seconds for what the multiplexer sends and calls the callbacks for it """
+        sock = self.__sock
+        if sock is None:
+            return MQTT_ERR_NO_CONN
+        try:
+            readable, _, _ = select.select([sock], [], [], timeout)
+            if not readable:
+                return MQTT_ERR_SUCCESS
+            data = sock.recv(65536)
+        except (OSError, ValueError):
+            data = b""
+        if sock is not self.__sock:
+            # Disconnected while we were waiting
+            return MQTT_ERR_NO_CONN
+        if not data:
+            self.__dropped(MQTT_ERR_CONN_LOST)
+            return MQTT_ERR_CONN_LOST
+
+        *lines, self.__buffer = (self.__buffer + data).split(b"\n")
+        for line in lines:
+            self.__handle(json.loads(line))
+        return MQTT_ERR_SUCCESS
+
+    def __handle(self, frame: dict):
+        op = frame.get("op")
+        if op == "msg":
+            if self.on_message is not None:
+                self.on_message(self, None, MuxMessage(frame["t"], b64decode(frame["p"]), frame.get("q", 0), frame.get("r", False)))
+        elif op == "ack":
+            with self.__write_lock:
+                info = self.__pending.pop(frame["mid"], None)
+            if info is not None:
+                info.published = True
+                if self.on_publish is not None:
+                    self.on_publish(self, None, info.mid)
+        elif op == "connack":
+            self.identity = {key: frame.get(key) for key in ("mac", "ip", "hostname")}
+            self.__connected = frame["rc"] == 0
+            if self.on_connect is not None:
+                self.on_connect(self, None, {}, frame["rc"])
+
+    def __request(self, frame: dict) -> Tuple[int, int]:
+        with self.__write_lock:
+            self.__mid = self.__mid % 65535 + 1
+            if self.__sock is None:
+                return MQTT_ERR_NO_CONN, self.__mid
+            try:
+                self.__write(frame)
+            except OSError:
+                return MQTT_ERR_NO_CONN, self.__mid
+            return MQTT_ERR_SUCCESS, self.__mid
+
+    def __write(self, frame: dict):
+        with self.__write_lock:
+            self.__sock.sendall(_frame(frame))
+
+    def __dropped(self, rc: int):
+        with self.__write_lock:
+            sock, self.__sock = self.__sock, None
+            self.__connected = False
+            self.__pending.clear()
+        if sock is None:
+            return
+        try:
+            # Wakes the loop if it's waiting on the socket
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, rc)
+
+    @staticmethod
+    def __bytes(payload) -> bytes:
+        if payload is None:
+            return b""
+        return payload.encode() if isinstance(payload, str) else bytes(payload)
+
+
+class _LocalClient(object):
+    """ A process attached to the multiplexer """
+    __slots__ = ("sock", "name", "will", "attached", "clean", "lock")
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.name: str = None
+        self.will: dict = None
+        self.attached = False
+        self.clean = False
+        self.lock = Lock()
+
+    def send(self, data: bytes):
+        with self.lock:
+            self.sock.sendall(data)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class MqttMux(object):
+    """ Holds the Pi's one connection to the broker, which the room's processes (the game, the system handler,
+    diagnostics) share over a Unix socket.
+
+    The multiplexer finds the server (ServerFinder) and connects with the reconnect backoff, the processes attach with a
+    MuxClient. A topic filter is subscribed at the broker while any process wants it, at the highest QoS asked for, and
+    each message is handed to every process with a matching filter. Publishes go out with the process' QoS, and are
+    acknowledged back to it when the broker has acknowledged them. When the broker is lost every process is let go and
+    attaches again, so each of them goes through its own connect as it did with a connection of its own.
+
+    The broker only takes one last will per connection, the multiplexer registers the last one a process handed over on
+    its next connect. A process that goes away without disconnecting has its will published by the multiplexer.
+
+    The protocol is a json object per line: 'hello' (id, will), 'sub' (t, q), 'unsub' (t), 'pub' (mid, t, p, q, r),
+    'bye' and 'stats' from the process, 'connack' (rc, mac, ip, hostname), 'msg' (t, p, q, r), 'ack' (mid) and 'stats'
+    from the multiplexer. Payloads ('p') are base64
+    """
+
+    connect_timeout = 10.0
+
+    def __init__(self, path: str = None):
+        """
+        Args:
+            path (str, optional): The socket to listen on. Defaults to mux_socket_path().
+        """
+        # Imported here, the communicator imports this module for the client
+        from .ServerCommunicator import ServerCommunicator, ServerFinder
+
+        self.path = path if path is not None else mux_socket_path()
+        self.network = network_identity()
+        self.mac = self.network.mac
+        self.keepalive = ServerCommunicator.keepalive
+
+        self.__client = mqtt.Client(client_id="Room_" + self.mac + "_mux")
+        self.__client.username_pw_set(ServerCommunicator.username, password=ServerCommunicator.password)
+        self.__client.on_connect = self.__on_connect
+        self.__client.on_disconnect = self.__on_disconnect
+        self.__client.on_message = self.__on_message
+        self.__client.on_publish = self.__on_publish
+        # The multiplexer mustn't find itself
+        self.finder = ServerFinder(self.__on_server_found, use_mux=False)
+        self.backoff = ReconnectBackoff()
+
+        self.__lock = RLock()
+        self.__clients: List[_LocalClient] = []
+        self.__subscriptions: Dict[str, Dict[_LocalClient, int]] = {}
+        self.__inflight: Dict[int, Tuple[_LocalClient, int]] = {}
+        self.__inflight_lock = RLock()
+        self.__will: dict = None
+
+        self.__target = None
+        self.__next_attempt = 0.0
+        self.__attempt_started = None
+        self.__wake = Event()
+        self.__exiting = False
+
+        self.attaches = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.connect_attempts = 0
+        self.connect_failures = 0
+
+    @staticmethod
+    def available(path: str = None) -> bool:
+        """ Is a multiplexer accepting processes on the socket """
+        if not hasattr(socket, "AF_UNIX"):
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(0.5)
+        try:
+            sock.connect(path or mux_socket_path())
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            if MqttMux.available(self.path):
+                raise RuntimeError(f"A multiplexer is already running on {self.path}")
+            os.unlink(self.path)
+        # A directory we make ourselves is only ours, the service's runtime directory is made by systemd
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        # The game (the user or its group) attaches, the system handler is root
+        os.chmod(self.path, 0o660)
+        server.listen()
+
+        Thread(target=self.__network_loop, name="MQTT", daemon=True).start()
+        self.finder.search()
+        print(f"MqttMux: Listening on {self.path}")
+        try:
+            while True:
+                sock, _ = server.accept()
+                Thread(target=self.__serve_client, args=(_LocalClient(sock),), name="MqttMux client", daemon=True).start()
+        finally:
+            self.__exiting = True
+            self.__wake.set()
+            self.__client.disconnect()
+            server.close()
+            os.unlink(self.path)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"connected": self.__client.is_connected(), "clients": [c.name for c in self.__clients],
+                    "subscriptions": len(self.__subscriptions), "attaches": self.attaches, "messages_in": self.messages_in,
+                    "messages_out": self.messages_out, "connect_attempts": self.connect_attempts,
+                    "connect_failures": self.connect_failures}
+
+    ### The processes ###
+
+    def __serve_client(self, local: _LocalClient):
+        try:
+            for line in local.sock.makefile("rb"):
+                frame = json.loads(line)
+                op = frame.get("op")
+                if op == "hello":
+                    self.__hello(local, frame)
+                elif op == "pub":
+                    self.__local_publish(local, frame)
+                elif op == "sub":
+                    self.__local_subscribe(local, frame["t"], frame.get("q", 0))
+                elif op == "unsub":
+                    self.__local_unsubscribe(local, frame["t"])
+                elif op == "stats":
+                    local.send(_frame(dict(self.stats(), op="stats")))
+                elif op == "bye":
+                    local.clean = True
+                    break
+        except OSError:
+            pass
+        except (ValueError, KeyError) as e:
+            print(f"MqttMux: Letting {local.name} go, it sent something we don't understand: {e}")
+        finally:
+            self.__detach(local)
+
+    def __hello(self, local: _LocalClient, frame: dict):
+        local.name = frame.get("id") or "anonymous"
+        local.will = frame.get("will")
+        with self.__lock:
+            self.__clients.append(local)
+            self.attaches += 1
+            if local.will is not None:
+                self.__will = local.will
+        print(f"MqttMux: {local.name} attached")
+        if self.__client.is_connected():
+            self.__accept(local)
+
+    def __accept(self, local: _LocalClient):
+        with self.__lock:
+            if local.attached or local not in self.__clients:
+                return
+            local.attached = True
+        self.__send(local, _frame({"op": "connack", "rc": 0, "mac": self.mac, "ip": self.network.ip,
+                                   "hostname": self.network.hostname}))
+
+    def __detach(self, local: _LocalClient):
+        with self.__lock:
+            if local in self.__clients:
+                self.__clients.remove(local)
+            for topic in [t for t, subscribers in self.__subscriptions.items() if local in subscribers]:
+                self.__local_unsubscribe(local, topic)
+        with self.__inflight_lock:
+            for mid in [mid for mid, (owner, _) in self.__inflight.items() if owner is local]:
+                del self.__inflight[mid]
+
+        if local.name is not None and not local.clean and local.will is not None and self.__client.is_connected():
+            print(f"MqttMux: {local.name} went away, publishing its last will")
+            will = local.will
+            self.__client.publish(will["t"], b64decode(will["p"]), qos=will.get("q", 0), retain=will.get("r", False))
+        elif local.name is not None:
+            print(f"MqttMux: {local.name} detached")
+        local.close()
+
+    def __local_publish(self, local: _LocalClient, frame: dict):
+        qos = frame.get("q", 0)
+        # The lock makes sure the mid is known before paho's thread can report it as published
+        with self.__inflight_lock:
+            info = self.__client.publish(frame["t"], b64decode(frame["p"]), qos=qos, retain=frame.get("r", False))
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # Not acked, the process sends it again when it's attached again
+                return
+            self.messages_out += 1
+            if not qos:
+                return
+            if info.is_published():
+                self.__send(local, _frame({"op": "ack", "mid": frame["mid"]}))
+            else:
+                self.__inflight[info.mid] = (local, frame["mid"])
+
+    def __local_subscribe(self, local: _LocalClient, topic: str, qos: int):
+        with self.__lock:
+            subscribers = self.__subscriptions.setdefault(topic, {})
+            highest = max(subscribers.values(), default=-1)
+            subscribers[local] = qos
+            if qos > highest and self.__client.is_connected():
+                self.__client.subscribe(topic, qos=qos)
+
+    def __local_unsubscribe(self, local: _LocalClient, topic: str):
+        with self.__lock:
+            subscribers = self.__subscriptions.get(topic)
+            if not subscribers or subscribers.pop(local, None) is None:
+                return
+            if not subscribers:
+                del self.__subscriptions[topic]
+                if self.__client.is_connected():
+                    self.__client.unsubscribe(topic)
+
+    def __send(self, local: _LocalClient, data: bytes):
+        try:
+            local.send(data)
+        except OSError:
+            # Its thread notices and detaches it
+            local.close()
+
+    ### The broker ###
+
+    def __on_server_found(self, addr: str, port: int):
+        delay = 0.0 if self.connect_attempts == 0 else self.backoff.next()
+        if delay:
+            print(f"MqttMux: Connecting to {addr}:{port} in {delay:.1f} s (retry {self.backoff.attempts})")
+        self.__target = (addr, port)
+        self.__next_attempt = monotonic() + delay
+        self.__wake.set()
+
+    def __network_loop(self):
+        """ Runs paho's loop while there is a socket, and the next connect attempt when it's due while there isn't """
+        while not self.__exiting:
+            if self.__client.socket() is not None:
+                self.__client.loop(timeout=1.0)
+                if self.__attempt_started is not None and monotonic() - self.__attempt_started > self.connect_timeout:
+                    print("MqttMux: No answer from the broker, giving up on this attempt")
+                    self.__attempt_started = None
+                    self.connect_failures += 1
+                    self.__client.disconnect()
+                continue
+
+            self.__wake.clear()
+            if self.__target is None:
+                self.__wake.wait()
+            elif self.__next_attempt > monotonic():
+                self.__wake.wait(self.__next_attempt - monotonic())
+            else:
+                self.__attempt(*self.__target)
+
+    def __attempt(self, addr: str, port: int):
+        self.connect_attempts += 1
+        self.__attempt_started = monotonic()
+        try:
+            will = self.__will
+            if will is not None:
+                self.__client.will_set(will["t"], b64decode(will["p"]), qos=will.get("q", 0), retain=will.get("r", False))
+            self.__client.connect(addr, port, keepalive=self.keepalive)
+        except Exception as e:
+            print(f"MqttMux: Connecting to {addr}:{port} failed: {e}")
+            self.__attempt_started = None
+            self.__target = None
+            self.connect_failures += 1
+            self.finder.search(forced=True)
+
+    def __on_connect(self, client, userdata, flags, rc):
+        self.__attempt_started = None
+        if rc != 0:
+            print(f"MqttMux: The broker refused the connection: {mqtt.connack_string(rc)}")
+            self.connect_failures += 1
+            return
+
+        print("MqttMux: Connected to the broker")
+        self.backoff.reset()
+        self.finder.report_connected()
+        with self.__lock:
+            for topic, subscribers in self.__subscriptions.items():
+                client.subscribe(topic, qos=max(subscribers.values()))
+            waiting = [local for local in self.__clients if not local.attached]
+        for local in waiting:
+            self.__accept(local)
+
+    def __on_disconnect(self, client, userdata, rc):
+        if self.__attempt_started is not None:
+            self.__attempt_started = None
+            self.connect_failures += 1
+        with self.__inflight_lock:
+            self.__inflight.clear()
+        with self.__lock:
+            clients = list(self.__clients)
+        # The processes see it like a lost connection of their own, and attach again when we are back
+        for local in clients:
+            local.clean = True
+            local.close()
+
+        if not self.__exiting:
+            print("MqttMux: Lost the broker, searching ...")
+            self.__target = None
+            self.finder.search()
+
+    def __on_message(self, client, userdata, msg):
+        self.messages_in += 1
+        with self.__lock:
+            targets = {local for topic, subscribers in self.__subscriptions.items()
+                       if mqtt.topic_matches_sub(topic, msg.topic) for local in subscribers}
+        if not targets:
+            return
+        data = _frame({"op": "msg", "t": msg.topic, "p": _pack(msg.payload), "q": msg.qos, "r": bool(msg.retain)})
+        for local in targets:
+            self.__send(local, data)
+
+    def __on_publish(self, client, userdata, mid):
+        with self.__inflight_lock:
+            entry = self.__inflight.pop(mid, None)
+        if entry is not None:
+            local, local_mid = entry
+            self.__send(local, _frame({"op": "ack", "mid": local_mid}))
+
+
+if __name__ == "__main__":
+    # python -m utils.MqttMux                   runs the multiplexer (setup_env.sh installs it as a service)
+    # python -m utils.MqttMux tap [filter ...]  prints what arrives on the filters, '#' by default
+    # python -m utils.MqttMux stats             the multiplexer's counters
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "serve"
+    if command == "tap":
+        filters = sys.argv[2:] or ["#"]
+        tap = MuxClient(client_id="tap")
+        tap.on_connect = lambda client, userdata, flags, rc: [client.subscribe(f) for f in filters]
+        tap.on_message = lambda client, userdata, msg: print(f"{msg.topic} {msg.payload[:200]!r}")
+        tap.connect()
+        while tap.loop(1.0) == MQTT_ERR_SUCCESS:
+            pass
+    elif command == "stats":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(mux_socket_path())
+        sock.sendall(_frame({"op": "stats"}))
+        print(sock.makefile("rb").readline().decode().strip())
+        sock.close()
+    else:
+        MqttMux().serve_forever()
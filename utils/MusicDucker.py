@@ -0,0 +1,183 @@
+from itertools import count
+from time import monotonic, perf_counter
+from typing import Callable, Dict
+
+from .lazy import lazy_import
+mixer = lazy_import("pygame.mixer")
+
+
+class DuckEnvelope(object):
+    """ How the music volume moves when a duck starts (attack) and when the last one is released (release) """
+
+    def __init__(self, attack_seconds: float = 0.15, release_seconds: float = 0.5, smooth: bool = True):
+        """Creates the envelope
+
+        Args:
+            attack_seconds (float, optional): Time to go down to the ducked level. Defaults to 0.15.
+            release_seconds (float, optional): Time to come back up. Defaults to 0.5.
+            smooth (bool, optional): S-shaped ramp instead of a straight line, no audible corners. Defaults to True.
+        """
+        self.attack_seconds = attack_seconds
+        self.release_seconds = release_seconds
+        self.smooth = smooth
+
+    def duration(self, going_down: bool) -> float:
+        return self.attack_seconds if going_down else self.release_seconds
+
+    def shape(self, progress: float) -> float:
+        """ Maps the time progress of a ramp (0 - 1) to the volume progress (0 - 1) """
+        if progress >= 1.0:
+            return 1.0
+        return progress * progress * (3 - 2 * progress) if self.smooth else progress
+
+
+class MusicDucker(object):
+    """ Lowers the background music while other sounds play and brings it back when they are done.
+
+    Every duck request is counted, the music sits at the lowest requested level until the last request is released, so
+    overlapping sounds can't restore the music under each other. Volume changes are ramped along the envelope from the
+    audio scheduler tick (call tick on every tick), no threads are started per ramp.
+    Not thread safe, every call is expected to come from the audio scheduler thread
+    """
+
+    def __init__(self, envelope: DuckEnvelope = None, set_volume: Callable[[float], None] = None,
+                 clock: Callable[[], float] = monotonic):
+        """Creates the ducker, the music starts at full volume
+
+        Args:
+            envelope (DuckEnvelope, optional): The ramp times. Defaults to DuckEnvelope().
+            set_volume (Callable, optional): Applies the music volume. Defaults to mixer.music.set_volume.
+            clock (Callable, optional): Monotonic time in seconds. Defaults to time.monotonic.
+        """
+        self.envelope = envelope if envelope is not None else DuckEnvelope()
+        self.__set_volume = set_volume if set_volume is not None else (lambda level: mixer.music.set_volume(level))
+        self.__clock = clock
+
+        self.__base_level = 1.0
+        self.__ducks: Dict[int, float] = {}
+        self.__tokens = count(1)
+
+        self.__level = 1.0
+        self.__ramp_from = 1.0
+        self.__ramp_to = 1.0
+        self.__ramp_start = 0.0
+        self.__ramp_seconds = 0.0
+
+        self.__requests = 0
+        self.__ticks = 0
+        self.__updates = 0
+        self.__tick_seconds = 0.0
+        self.__max_tick_seconds = 0.0
+
+    def duck(self, level: float) -> int:
+        """Lowers the music to 'level' times the base level until the request is released
+
+        Args:
+            level (float): Relative music level while ducked, 0.0 - 1.0
+
+        Returns:
+            int: Token to release the request with
+        """
+        token = next(self.__tokens)
+        self.__ducks[token] = max(0.0, min(1.0, level))
+        self.__requests += 1
+        self.__retarget()
+        return token
+
+    def release(self, token: int):
+        """ Releases a duck request, releasing one twice or after release_all is fine """
+        if self.__ducks.pop(token, None) is not None:
+            self.__retarget()
+
+    def release_all(self):
+        self.__ducks.clear()
+        self.__retarget()
+
+    def set_base_level(self, level: float, ramp: bool = True):
+        """ The music volume when nothing is ducking it, without 'ramp' it's applied right away """
+        self.__base_level = level
+        self.__retarget()
+        if not ramp:
+            self.apply()
+
+    def apply(self):
+        """ Jumps to the target level, e.g. after new music has been loaded and the mixer reset the volume """
+        self.__ramp_seconds = 0.0
+        self.__level = self.__ramp_to
+        self.__set_volume(self.__level)
+        self.__updates += 1
+
+    def target_level(self) -> float:
+        ducked = min(self.__ducks.values()) if self.__ducks else 1.0
+        return self.__base_level * ducked
+
+    def is_ramping(self) -> bool:
+        return self.__level != self.__ramp_to
+
+    def tick(self) -> bool:
+        """Moves the music volume one step along the ramp
+
+        Returns:
+            bool: True while the volume is still moving
+        """
+        if not self.is_ramping():
+            return False
+
+        start = perf_counter()
+        self.__ticks += 1
+        elapsed = self.__clock() - self.__ramp_start
+        progress = elapsed / self.__ramp_seconds if self.__ramp_seconds > 0 else 1.0
+        if progress >= 1.0:
+            level = self.__ramp_to
+        else:
+            level = self.__ramp_from + (self.__ramp_to - self.__ramp_from) * self.envelope.shape(progress)
+
+        # The mixer only has 128 volume steps, skip calls that wouldn't change anything
+        if level == self.__ramp_to or int(level * 128) != int(self.__level * 128):
+            self.__set_volume(level)
+            self.__updates += 1
+        self.__level = level
+
+        spent = perf_counter() - start
+        self.__tick_seconds += spent
+        self.__max_tick_seconds = max(self.__max_tick_seconds, spent)
+        return self.is_ramping()
+
+    def stats(self) -> dict:
+        """ Duck requests and what the ramps cost, the tick times are measured around tick itself """
+        return {"level": round(self.__level, 3), "target": round(self.target_level(), 3), "active": len(self.__ducks),
+                "requests": self.__requests, "ticks": self.__ticks, "volume_updates": self.__updates,
+                "avg_tick_us": round(self.__tick_seconds / self.__ticks * 1e6, 1) if self.__ticks else 0.0,
+                "max_tick_us": round(self.__max_tick_seconds * 1e6, 1)}
+
+    def __retarget(self):
+        target = self.target_level()
+        if target == self.__ramp_to:
+            return
+        # A new ramp always starts where the volume is right now, so changing direction halfway doesn't jump
+        self.__ramp_from = self.__level
+        self.__ramp_to = target
+        self.__ramp_start = self.__clock()
+        self.__ramp_seconds = self.envelope.duration(target < self.__level)
+
+
+if __name__ == "__main__":
+    # Cost of the ramps without a mixer: two overlapping ducks ticked every 2 ms like the audio scheduler does
+    volumes = []
+    now = [0.0]
+    ducker = MusicDucker(set_volume=volumes.append, clock=lambda: now[0])
+
+    first = ducker.duck(0.5)
+    for _ in range(50):
+        now[0] += 0.002
+        ducker.tick()
+    second = ducker.duck(0.3)
+    ducker.release(first)
+    while ducker.tick():
+        now[0] += 0.002
+    ducker.release(second)
+    while ducker.tick():
+        now[0] += 0.002
+
+    print(f"DUCKING: Final level {volumes[-1]}, {len(volumes)} volume changes")
+    print(f"DUCKING: {ducker.stats()}")
@@ -0,0 +1,160 @@
+from threading import Lock, Thread
+from typing import Callable, List
+
+import socket
+
+from .lazy import lazy_import
+from .TimerWheel import shared_wheel
+
+netifaces = lazy_import("netifaces")
+
+
+class NetworkIdentity(object):
+    """ The room's MAC, IP and hostname, read once and kept up to date.
+
+    Changes are learnt from an rtnetlink socket, the kernel tells us when a link goes up or down or an address is added or
+    removed, so nothing is polled while the network is stable. Where there is no rtnetlink (not Linux) the addresses are
+    polled every few seconds on the shared timer wheel instead. Subscribers are called when the IP changes, e.g. the
+    server search starts again the moment the link comes up
+    """
+
+    UNKNOWN_IP = "Unknown IP"
+    poll_interval = 2.0
+
+    # rtnetlink multicast groups, from linux/rtnetlink.h
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+
+    def __init__(self, wired: str = "eth0", wireless: str = "wlan0", mac: str = None):
+        """Reads the addresses, call watch to follow the changes
+
+        Args:
+            wired (str, optional): The interface the room normally uses. Defaults to "eth0".
+            wireless (str, optional): Used when the wired interface has no address. Defaults to "wlan0".
+            mac (str, optional): The MAC to identify with instead of the wired interface's, e.g. for a simulated room.
+                Defaults to None.
+        """
+        self.wired = wired
+        self.wireless = wireless
+
+        self.__lock = Lock()
+        self.__subscribers: List[Callable[["NetworkIdentity"], None]] = []
+        self.__mac = mac
+        self.__ip = NetworkIdentity.UNKNOWN_IP
+        self.__hostname = socket.gethostname()
+        self.__watcher = None
+
+        self.changes = 0
+        self.refreshes = 0
+        self.refresh()
+
+    @property
+    def mac(self) -> str:
+        """ The MAC address of the wired interface, which identifies the room to the server """
+        if self.__mac is None:
+            self.__mac = str(netifaces.ifaddresses(self.wired)[netifaces.AF_LINK][0]['addr'])
+        return self.__mac
+
+    @property
+    def ip(self) -> str:
+        """ The IPv4 address, ' (WiFi)' is added when it's the wireless one and it's 'Unknown IP' while there is none """
+        return self.__ip
+
+    @property
+    def hostname(self) -> str:
+        return self.__hostname
+
+    def has_ip(self) -> bool:
+        return self.__ip != NetworkIdentity.UNKNOWN_IP
+
+    def subscribe(self, callback: Callable[["NetworkIdentity"], None]):
+        """ Calls back (on the watcher's thread) when the IP changes """
+        with self.__lock:
+            self.__subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[["NetworkIdentity"], None]):
+        with self.__lock:
+            if callback in self.__subscribers:
+                self.__subscribers.remove(callback)
+
+    def refresh(self):
+        """ Reads the addresses again and notifies the subscribers if the IP has changed """
+        self.refreshes += 1
+        ip = self.__read_ip()
+        hostname = socket.gethostname()
+        with self.__lock:
+            changed = ip != self.__ip
+            self.__ip = ip
+            self.__hostname = hostname
+            subscribers = list(self.__subscribers) if changed else []
+
+        if changed:
+            self.changes += 1
+            print(f"NetworkIdentity: IP is now {ip}")
+        for callback in subscribers:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"NetworkIdentity: Subscriber failed: {e}")
+
+    def watch(self) -> "NetworkIdentity":
+        """ Starts following the changes, through rtnetlink if we can and by polling if we can't """
+        if self.__watcher is not None:
+            return self
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, NetworkIdentity.RTMGRP_LINK | NetworkIdentity.RTMGRP_IPV4_IFADDR))
+        except (AttributeError, OSError) as e:
+            print(f"NetworkIdentity: No rtnetlink ({e}), polling every {self.poll_interval} s")
+            self.__watcher = shared_wheel().call_every(self.poll_interval, self.refresh, name="network identity")
+            return self
+
+        self.__watcher = Thread(target=self.__netlink_loop, args=(sock,), name="NetworkIdentity", daemon=True)
+        self.__watcher.start()
+        return self
+
+    def stats(self) -> dict:
+        return {"ip": self.__ip, "changes": self.changes, "refreshes": self.refreshes,
+                "watcher": "netlink" if isinstance(self.__watcher, Thread) else "polling" if self.__watcher else None}
+
+    def __netlink_loop(self, sock: socket.socket):
+        while True:
+            try:
+                # What changed doesn't matter, the addresses are read again. A burst of messages (link up, then the
+                # address from dhcp) is read as one when they are already waiting
+                sock.recv(65536)
+                sock.setblocking(False)
+                try:
+                    while sock.recv(65536):
+                        pass
+                except BlockingIOError:
+                    pass
+                sock.setblocking(True)
+            except OSError as e:
+                print(f"NetworkIdentity: rtnetlink failed ({e}), polling every {self.poll_interval} s")
+                sock.close()
+                self.__watcher = shared_wheel().call_every(self.poll_interval, self.refresh, name="network identity")
+                return
+            self.refresh()
+
+    def __read_ip(self) -> str:
+        for interface, suffix in ((self.wired, ""), (self.wireless, " (WiFi)")):
+            try:
+                return str(netifaces.ifaddresses(interface)[netifaces.AF_INET][0]['addr']) + suffix
+            except (KeyError, ValueError):
+                # No address on it, or no such interface
+                continue
+        return NetworkIdentity.UNKNOWN_IP
+
+
+_shared: NetworkIdentity = None
+_shared_lock = Lock()
+
+
+def network_identity() -> NetworkIdentity:
+    """ The identity every component of the room shares, watching for changes from first use """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = NetworkIdentity().watch()
+        return _shared
@@ -0,0 +1,176 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from threading import Lock
+from typing import List, NamedTuple
+
+import json
+import os
+
+from .storage import data_path
+
+
+class SpooledMessage(NamedTuple):
+    seq: int
+    topic: str
+    payload: bytes
+    qos: int
+    critical: bool
+    """ Game results, always synced to disk and the last to be dropped when the spool is full """
+    coalesce: str
+    """ A newer message with the same key replaces this one while it's still waiting, e.g. READY or a ping """
+    retain: bool = False
+
+
+class OutboundSpool(object):
+    """ Messages on their way to the broker, kept in an append-only file until the broker has them.
+
+    Every message is appended before it's published and an ack line is appended when paho reports it as sent, so
+    whatever hasn't been acked (broker down, Pi restarted) is replayed in order on the next connect.
+    The file is compacted when it grows, and bounded: when it's full the oldest non critical messages are dropped first
+    """
+
+    FSYNC_ALWAYS = "always"
+    FSYNC_CRITICAL = "critical"
+    FSYNC_NEVER = "never"
+
+    def __init__(self, path: str = None, fsync: str = FSYNC_CRITICAL, max_messages: int = 500, compact_bytes: int = 256 * 1024):
+        """Opens the spool, messages left from the last run are pending right away
+
+        Args:
+            path (str, optional): The spool file. Defaults to 'spool/outbound.log' in the data directory.
+            fsync (str, optional): Sync to disk on every append ('always'), only for critical messages ('critical') or leave it
+                to the OS ('never'). Defaults to 'critical'.
+            max_messages (int, optional): Pending messages kept at most. Defaults to 500.
+            compact_bytes (int, optional): The file is rewritten with only the pending messages when it grows past this. Defaults to 256 kB.
+        """
+        self.path = path if path is not None else data_path("spool", "outbound.log")
+        self.fsync = fsync
+        self.max_messages = max_messages
+        self.compact_bytes = compact_bytes
+
+        self.dropped = 0
+        self.coalesced = 0
+
+        self.__lock = Lock()
+        self.__pending: "OrderedDict[int, SpooledMessage]" = OrderedDict()
+        self.__next_seq = 1
+        self.__file = None
+        # Starts with a compacted file that holds only what's left from the last run
+        self.__load()
+        self.__compact()
+
+    def append(self, topic: str, payload: bytes, qos: int = 2, critical: bool = False, coalesce: str = None,
+               retain: bool = False) -> SpooledMessage:
+        """Stores the message until it's acked
+
+        Args:
+            topic (str): MQTT topic
+            payload (bytes): The encoded payload
+            qos (int, optional): MQTT quality of service. Defaults to 2.
+            critical (bool, optional): Synced to disk right away and dropped last. Defaults to False.
+            coalesce (str, optional): Replaces the pending messages with the same key. Defaults to None.
+            retain (bool, optional): Published as a retained message. Defaults to False.
+
+        Returns:
+            SpooledMessage: The stored message, 'seq' is used to ack it
+        """
+        with self.__lock:
+            if coalesce is not None:
+                for stale in [m for m in self.__pending.values() if m.coalesce == coalesce]:
+                    self.__remove(stale.seq)
+                    self.coalesced += 1
+
+            message = SpooledMessage(self.__next_seq, topic, bytes(payload), qos, critical, coalesce, retain)
+            self.__next_seq += 1
+            self.__pending[message.seq] = message
+            self.__write(OutboundSpool.__record(message), sync=self.__should_sync(critical))
+
+            while len(self.__pending) > self.max_messages:
+                self.__remove(self.__oldest_droppable())
+                self.dropped += 1
+            return message
+
+    def ack(self, seq: int):
+        """ The broker has the message, it won't be replayed """
+        with self.__lock:
+            if seq in self.__pending:
+                self.__remove(seq)
+                if not self.__pending or self.__file.tell() > self.compact_bytes:
+                    self.__compact()
+
+    def pending(self) -> List[SpooledMessage]:
+        """ The messages that haven't been acked, oldest first """
+        with self.__lock:
+            return list(self.__pending.values())
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"pending": len(self.__pending), "critical": len([m for m in self.__pending.values() if m.critical]),
+                    "coalesced": self.coalesced, "dropped": self.dropped, "file_bytes": self.__file.tell()}
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+    def __should_sync(self, critical: bool) -> bool:
+        return self.fsync == OutboundSpool.FSYNC_ALWAYS or (critical and self.fsync == OutboundSpool.FSYNC_CRITICAL)
+
+    def __oldest_droppable(self) -> int:
+        for message in self.__pending.values():
+            if not message.critical:
+                return message.seq
+        return next(iter(self.__pending))
+
+    def __remove(self, seq: int):
+        del self.__pending[seq]
+        self.__write({"ack": seq}, sync=False)
+
+    def __write(self, record: dict, sync: bool):
+        self.__file.write(json.dumps(record).encode() + b"\n")
+        self.__file.flush()
+        if sync:
+            os.fsync(self.__file.fileno())
+
+    @staticmethod
+    def __record(message: SpooledMessage) -> dict:
+        record = message._asdict()
+        record["payload"] = b64encode(message.payload).decode()
+        return record
+
+    def __load(self):
+        try:
+            with open(self.path, "rb") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            lines = []
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+                if "ack" in record:
+                    self.__pending.pop(record["ack"], None)
+                else:
+                    self.__pending[record["seq"]] = SpooledMessage(record["seq"], record["topic"], b64decode(record["payload"]),
+                                                                   record["qos"], record["critical"], record["coalesce"],
+                                                                   record.get("retain", False))
+                    self.__next_seq = max(self.__next_seq, record["seq"] + 1)
+            except (ValueError, KeyError, TypeError):
+                # A line cut off by a power cut, everything before it is still good
+                continue
+
+        if self.__pending:
+            print(f"ServerCommunicator: {len(self.__pending)} messages left in the spool from the last run")
+
+    def __compact(self):
+        """ Rewrites the file with only the pending messages, atomically so a power cut leaves the old or the new file """
+        if self.__file is not None:
+            self.__file.close()
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            for message in self.__pending.values():
+                f.write(json.dumps(OutboundSpool.__record(message)).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.__file = open(self.path, "ab")
@@ -0,0 +1,120 @@
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import Dict
+
+from .storage import data_path, read_json
+
+
+class QosProfile(object):
+    """ The MQTT QoS of each class of topic the room publishes or subscribes to.
+
+    QoS 2 costs four packets per message and QoS 1 two, on a broker that serves the whole building. Room statuses carry an
+    idempotency key ('msgId') so a status delivered twice under QoS 1 is only acted on once. Statuses that are sent again
+    anyway (the ping, the config request until it's answered, door statuses that are replaced by the next one) use QoS 0.
+    The defaults can be overridden per class in 'qos_profile.json' in the data directory, e.g. {"room_status": 2}
+    """
+
+    ROOM_STATUS = "room_status"
+    PRESENCE = "presence"
+    PING = "ping"
+    TELEMETRY = "telemetry"
+    PROBE = "probe"
+    CONFIG_REQUEST = "config_request"
+    CONFIG = "config"
+    SET_STATUS = "set_status"
+    DOOR_STATUS = "door_status"
+    SCAN_RESULT = "tag_scan_result"
+    OTHER_ROOM_STATUS = "other_room_status"
+    OTHER_DOOR_STATUS = "other_door_status"
+
+    DEFAULTS = {
+        # Published
+        ROOM_STATUS: 1,
+        PRESENCE: 1,
+        PING: 0,
+        TELEMETRY: 0,
+        PROBE: 0,
+        CONFIG_REQUEST: 0,
+        # Subscribed
+        CONFIG: 1,
+        SET_STATUS: 1,
+        DOOR_STATUS: 0,
+        SCAN_RESULT: 1,
+        OTHER_ROOM_STATUS: 1,
+        OTHER_DOOR_STATUS: 0,
+    }
+
+    PACKETS = {0: 1, 1: 2, 2: 4}
+    """ Packets between the client and the broker for one message at each QoS """
+
+    def __init__(self, overrides: Dict[str, int] = None):
+        self.__levels = dict(QosProfile.DEFAULTS)
+        for topic_class, qos in (overrides or {}).items():
+            if topic_class not in QosProfile.DEFAULTS or qos not in QosProfile.PACKETS:
+                print(f"ServerCommunicator: Ignoring QoS {qos!r} for topic class '{topic_class}'")
+                continue
+            self.__levels[topic_class] = qos
+
+    @staticmethod
+    def load() -> "QosProfile":
+        """ The defaults with the overrides from 'qos_profile.json', if there is one """
+        return QosProfile(read_json(data_path("qos_profile.json"), {}))
+
+    def qos(self, topic_class: str) -> int:
+        return self.__levels[topic_class]
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self.__levels)
+
+
+class PublishLatency(object):
+    """ Time from handing a message to paho until it's acknowledged, per QoS.
+
+    QoS 0 is 'acknowledged' when it has been written to the socket, QoS 1 on PUBACK and QoS 2 on PUBCOMP
+    """
+
+    def __init__(self, window: int = 500):
+        """
+        Args:
+            window (int, optional): The percentiles are over the last this many messages of each QoS. Defaults to 500.
+        """
+        self.__lock = Lock()
+        self.__sent: Dict[int, tuple] = {}
+        self.__samples = {qos: deque(maxlen=window) for qos in QosProfile.PACKETS}
+        self.__count = dict.fromkeys(QosProfile.PACKETS, 0)
+        self.__max = dict.fromkeys(QosProfile.PACKETS, 0.0)
+
+    def sent(self, mid: int, qos: int):
+        with self.__lock:
+            self.__sent[mid] = (qos, monotonic())
+
+    def acked(self, mid: int):
+        with self.__lock:
+            sent = self.__sent.pop(mid, None)
+            if sent is None:
+                return
+            qos, at = sent
+            latency = monotonic() - at
+            self.__samples[qos].append(latency)
+            self.__count[qos] += 1
+            self.__max[qos] = max(self.__max[qos], latency)
+
+    def forget(self):
+        """ The connection is gone, what's in flight will be sent again and timed from then """
+        with self.__lock:
+            self.__sent.clear()
+
+    def stats(self) -> dict:
+        """ Per QoS: messages acked, median, 95th percentile and max latency in ms, and the packets they took """
+        with self.__lock:
+            stats = {}
+            for qos, samples in self.__samples.items():
+                if not self.__count[qos]:
+                    continue
+                ordered = sorted(samples)
+                stats[qos] = {"acked": self.__count[qos], "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+                              "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                              "max_ms": round(self.__max[qos] * 1000, 1),
+                              "packets": self.__count[qos] * QosProfile.PACKETS[qos]}
+            return stats
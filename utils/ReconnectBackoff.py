@@ -0,0 +1,85 @@
+from random import Random
+
+
+class ReconnectBackoff(object):
+    """ The delays between reconnect attempts, exponential backoff with decorrelated jitter.
+
+    Every delay is drawn between the base and three times the previous delay and capped, so the delays grow like an
+    exponential backoff but two rooms that lost the broker at the same moment don't retry at the same moments. Reset it
+    once a connection has been made
+    """
+
+    DEFAULT_BASE = 2.0
+    DEFAULT_CAP = 30.0
+
+    def __init__(self, base: float = DEFAULT_BASE, cap: float = DEFAULT_CAP, rng: Random = None):
+        """Creates the backoff
+
+        Args:
+            base (float, optional): Shortest delay in seconds. Defaults to 2.0.
+            cap (float, optional): Longest delay in seconds. Defaults to 30.0.
+            rng (Random, optional): Random source, e.g. seeded for a simulation. Defaults to a new one.
+        """
+        self.base = base
+        self.cap = cap
+        self.__rng = rng if rng is not None else Random()
+        self.__delay = base
+        self.attempts = 0
+        """ Attempts since the last reset """
+
+    def next(self) -> float:
+        """ Seconds to wait before the next attempt """
+        self.attempts += 1
+        self.__delay = min(self.cap, self.__rng.uniform(self.base, self.__delay * 3))
+        return self.__delay
+
+    def reset(self):
+        self.__delay = self.base
+        self.attempts = 0
+
+
+if __name__ == "__main__":
+    # A venue of rooms losing the broker at the same moment, with the broker stand-in back after a restart and only able to
+    # take so many connects per second. The old fixed 5 s (+-2 s) retry against the backoff, on a virtual clock
+    from collections import Counter
+    from typing import Callable
+
+    from .TimerWheel import TimerWheel
+
+    rooms = 60
+    restart_seconds = 90.0
+    connects_per_second = 15
+
+    def simulate(next_delay: Callable[[Random, ReconnectBackoff], float]) -> dict:
+        now = [0.0]
+        wheel = TimerWheel(resolution=0.01, clock=lambda: now[0])
+        accepted = Counter()
+        attempts = Counter()
+        recovered = {}
+
+        def attempt(room: int, rng: Random, backoff: ReconnectBackoff):
+            second = int(now[0])
+            attempts[second] += 1
+            if now[0] >= restart_seconds and accepted[second] < connects_per_second:
+                accepted[second] += 1
+                recovered[room] = now[0]
+                return
+            wheel.call_later(next_delay(rng, backoff), attempt, room, rng, backoff)
+
+        for room in range(rooms):
+            rng = Random(room)
+            backoff = ReconnectBackoff(rng=rng)
+            wheel.call_later(next_delay(rng, backoff), attempt, room, rng, backoff)
+
+        while len(recovered) < rooms and now[0] < 600:
+            now[0] += wheel.resolution
+            wheel.run_due(now[0])
+
+        after = [attempts[s] for s in range(int(restart_seconds), int(max(recovered.values())) + 1)]
+        return {"attempts": sum(attempts.values()), "peak_per_second": max(attempts.values()),
+                "peak_after_restart": max(after), "all_back_after": round(max(recovered.values()) - restart_seconds, 1)}
+
+    fixed = simulate(lambda rng, backoff: 5 + rng.uniform(-2, 2))
+    decorrelated = simulate(lambda rng, backoff: backoff.next())
+    for name, result in (("fixed 5s", fixed), ("backoff", decorrelated)):
+        print(f"RECONNECT: {name:9} {result}")
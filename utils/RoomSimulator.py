@@ -0,0 +1,363 @@
+from random import Random
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Tuple
+
+import json
+
+from .constants import Access, DoorStatus, Language, RoomStatus, Topics
+from .lazy import lazy_import
+from .TimerWheel import TimerWheel
+
+mqtt = lazy_import("paho.mqtt.client")
+
+
+class VirtualClock(object):
+    """ Time for the room's timers that runs 'speed' times faster than the real clock, so a five minute game is played
+    in seconds. The network is still real, only the timers (state timeouts, the game timer, the jobs) are sped up """
+
+    def __init__(self, speed: float):
+        self.speed = speed
+        self.__started = monotonic()
+
+    def __call__(self) -> float:
+        return (monotonic() - self.__started) * self.speed
+
+
+class SilentAudio(object):
+    """ Stands in for the AudioHandler, the simulated rooms play nothing and load nothing """
+
+    def wait_until_ready(self, timeout: float = None) -> bool:
+        return True
+
+    def ending_clips(self, points: List[int]) -> List[str]:
+        return []
+
+    def prerender_endings(self, points: List[int], budget_bytes: int = None, wanted: Callable[[], bool] = None) -> int:
+        return 0
+
+    def __getattr__(self, name: str):
+        # Every other sound the room asks for is skipped
+        return lambda *args, **kwargs: None
+
+
+class PlayScript(object):
+    """ What the door, the server and the team do during one game, step by step.
+
+    Written as 'action@delay' separated by commas, the delay is in (virtual) seconds after the room reacted to the step
+    before. The actions are scan, door_opening, door_closed, active and idle (what the door sends), won[:level] and lost
+    (what the game decides) and outcome (won or lost, at random)
+    """
+
+    ACTIONS = ("scan", "door_opening", "door_closed", "active", "idle", "won", "lost", "outcome")
+    DEFAULT = "scan@5,door_opening@2,door_closed@8,active@2,outcome@180,idle@30"
+
+    def __init__(self, script: str = DEFAULT):
+        self.steps: List[Tuple[str, int, float]] = []
+        for step in script.split(","):
+            action, _, delay = step.strip().partition("@")
+            action, _, level = action.partition(":")
+            if action not in PlayScript.ACTIONS:
+                raise ValueError(f"Unknown action '{action}' in the play script, expected one of {', '.join(PlayScript.ACTIONS)}")
+            self.steps.append((action, int(level) if level else 1, float(delay or 0)))
+
+
+class SimulatedRoom(object):
+    """ A room on the real GameLogic and ServerCommunicator, with a MAC of its own, no audio and a fixed broker. Its traffic
+    isn't recorded, a log write per message would be part of the load the simulator measures """
+
+    def __init__(self, simulator: "RoomSimulator", number: int):
+        # Imported here, the FSM pulls in the game's dependencies which the report doesn't need
+        from .FSM import GameLogic
+        from .NetworkIdentity import NetworkIdentity
+
+        self.simulator = simulator
+        self.number = number
+        self.name = str(simulator.first_room + number)
+        self.mac = "02:00:00:%02x:%02x:%02x" % ((number >> 16) & 0xff, (number >> 8) & 0xff, number & 0xff)
+
+        self.__lock = Lock()
+        self.__waiting: Tuple[str, float] = None
+        self.__step = 0
+        self.__timeout = None
+        self.started: float = None
+        self.booted: float = None
+        self.games = 0
+        self.missed = 0
+
+        self.logic = GameLogic(self.__on_idle, lambda members, language: self.reacted("scan"), lambda: self.reacted("active"),
+                               lambda event: None, audio_handler=SilentAudio(), network=NetworkIdentity(mac=self.mac),
+                               server=(simulator.host, simulator.port), wheel=simulator.wheel, record_traffic=False)
+        self.logic.set_team_entering_door_opened_listener(lambda: self.reacted("door_opening"))
+        self.logic.set_team_entered_door_closed_listener(lambda: self.reacted("door_closed"))
+
+    def start(self):
+        self.started = monotonic()
+        self.logic.start()
+
+    def stop(self):
+        self.logic.cleanup()
+
+    def reacted(self, action: str):
+        """ The room did what the step expects of it, the next step is scheduled """
+        with self.__lock:
+            if self.__waiting is None or self.__waiting[0] != action:
+                return
+            self.simulator.record(action, monotonic() - self.__waiting[1])
+            self.__waiting = None
+            if self.__timeout is not None:
+                self.__timeout.cancel()
+        self.__next()
+
+    def __on_idle(self):
+        if self.booted is None:
+            self.booted = monotonic()
+            self.simulator.record("boot", self.booted - self.started)
+            self.__next()
+        else:
+            self.reacted("idle")
+
+    def __next(self):
+        steps = self.simulator.script.steps
+        if self.__step == len(steps):
+            self.__step = 0
+            self.games += 1
+            if self.games == self.simulator.games:
+                self.simulator.finished(self)
+                return
+        action, level, delay = steps[self.__step]
+        self.__step += 1
+        self.simulator.wheel.call_later(delay, self.__play, action, level, name=f"room {self.name} {action}")
+
+    def __play(self, action: str, level: int):
+        if action == "outcome":
+            action = "won" if self.simulator.rng.random() < self.simulator.win_rate else "lost"
+        with self.__lock:
+            self.__waiting = (action, monotonic())
+            self.__timeout = self.simulator.wheel.call_later(self.simulator.reaction_timeout * self.simulator.clock.speed,
+                                                             self.__missed, action, name=f"room {self.name} timeout")
+
+        door = "door/" + self.name + "/"
+        if action == "scan":
+            self.simulator.send(door + Topics.SCAN_RESULT.value, {"access": Access.SUCCESS.value, "members": 4,
+                                                                   "lang": Language.ENGLISH.value})
+        elif action in ("door_opening", "door_closed", "active", "idle"):
+            info = {"door_opening": DoorStatus.DOOR_OPENING_STARTING, "door_closed": DoorStatus.DOOR_CLOSED_STARTING,
+                    "active": DoorStatus.ACTIVE, "idle": DoorStatus.IDLING}[action]
+            self.simulator.send(door + Topics.DOOR_STATUS.value, {"info": info.value})
+        elif action == "won":
+            self.logic.room_won(min(level, len(self.simulator.points)))
+        else:
+            self.logic.room_lost()
+
+    def __missed(self, action: str):
+        with self.__lock:
+            if self.__waiting is None or self.__waiting[0] != action:
+                return
+            self.__waiting = None
+            self.missed += 1
+        print(f"SIM: Room {self.name} didn't react to '{action}' within {self.simulator.reaction_timeout} s")
+        self.__next()
+
+    def room_status(self, status: str):
+        """ The room's status as the server sees it """
+        if status in (RoomStatus.WON.value, RoomStatus.LOST.value):
+            self.reacted(status)
+
+
+class RoomSimulator(object):
+    """ Many rooms in one process against a broker, to load the venue's server (and broker) without a Pi per room.
+
+    Every room runs the real GameLogic and ServerCommunicator, with a fake MAC, no audio and the server at a fixed
+    address. The rooms' timers are all on one wheel on a virtual clock ('speed' times real time). The simulator plays
+    the door (scan results and door statuses on the broker, as the door does), the team (won, lost) and, unless the
+    real server is there to do it, the server's config answers and probe echoes. Each step is timed until the room has
+    reacted to it: the FSM callback for what arrives through the broker, the room status reaching the broker for won
+    and lost, and 'ready' for the door going back to idle
+    """
+
+    reaction_timeout = 10.0
+    """ Real seconds a room has to react to a step before it's counted as missed """
+
+    def __init__(self, rooms: int, games: int = 1, speed: float = 20.0, script: PlayScript = None, host: str = "localhost",
+                 port: int = 1883, serve_config: bool = True, first_room: int = 9000, win_rate: float = 0.5, seed: int = None):
+        """
+        Args:
+            rooms (int): Rooms to simulate
+            games (int, optional): Games each room plays. Defaults to 1.
+            speed (float, optional): How much faster than real time the rooms' timers run. Defaults to 20.0.
+            script (PlayScript, optional): One game. Defaults to PlayScript.DEFAULT.
+            host (str, optional): The broker. Defaults to "localhost".
+            port (int, optional): Defaults to 1883.
+            serve_config (bool, optional): Answer the rooms' config requests and probes, turn it off when the server is
+                running and knows the fake MACs. Defaults to True.
+            first_room (int, optional): The rooms are numbered from this one. Defaults to 9000.
+            win_rate (float, optional): How often 'outcome' is a win. Defaults to 0.5.
+            seed (int, optional): Seeds the outcomes. Defaults to None.
+        """
+        self.rooms_count = rooms
+        self.games = games
+        self.script = script if script is not None else PlayScript()
+        self.host = host
+        self.port = port
+        self.serve_config = serve_config
+        self.first_room = first_room
+        self.win_rate = win_rate
+        self.rng = Random(seed)
+        self.points = [100, 200, 300]
+
+        self.clock = VirtualClock(speed)
+        # The rooms' timers are handed this wheel, the shared one is left to whatever else runs in the process
+        self.wheel = TimerWheel(clock=self.clock)
+
+        self.__lock = Lock()
+        self.__samples: Dict[str, List[float]] = {}
+        self.__done = Event()
+        self.__finished = 0
+        self.__rooms_by_mac: Dict[str, SimulatedRoom] = {}
+        self.__rooms_by_name: Dict[str, SimulatedRoom] = {}
+        self.rooms: List[SimulatedRoom] = []
+        self.messages_in = 0
+        self.messages_out = 0
+
+        from .ServerCommunicator import ServerCommunicator
+        self.__client = mqtt.Client(client_id=f"room-simulator-{self.rng.randrange(1 << 24):06x}")
+        self.__client.username_pw_set(ServerCommunicator.username, password=ServerCommunicator.password)
+        self.__client.on_connect = self.__on_connect
+        self.__client.on_message = self.__on_message
+        self.__connected = Event()
+
+    def run(self) -> dict:
+        """ Runs every room through its games and returns the report """
+        self.__client.connect(self.host, self.port)
+        self.__client.loop_start()
+        if not self.__connected.wait(10):
+            raise ConnectionError(f"No broker at {self.host}:{self.port}")
+        Thread(target=self.__drive, name="VirtualClock", daemon=True).start()
+
+        started = monotonic()
+        for number in range(self.rooms_count):
+            room = SimulatedRoom(self, number)
+            self.rooms.append(room)
+            self.__rooms_by_mac[room.mac] = room
+            self.__rooms_by_name[room.name] = room
+        for room in self.rooms:
+            room.start()
+
+        self.__done.wait()
+        elapsed = monotonic() - started
+        for room in self.rooms:
+            room.stop()
+        self.__client.loop_stop()
+        self.__client.disconnect()
+        return self.report(elapsed)
+
+    def send(self, topic: str, message: dict):
+        # The rooms' steps send from the wheel thread, the config answers from paho's
+        with self.__lock:
+            self.messages_out += 1
+        self.__client.publish(topic, json.dumps(message), qos=1)
+
+    def record(self, action: str, seconds: float):
+        with self.__lock:
+            self.__samples.setdefault(action, []).append(seconds)
+
+    def finished(self, room: SimulatedRoom):
+        with self.__lock:
+            self.__finished += 1
+            if self.__finished == self.rooms_count:
+                self.__done.set()
+
+    def report(self, elapsed: float) -> dict:
+        """ Games and messages per second, and the latency percentiles of each step in ms """
+        def percentile(ordered: List[float], p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 1)
+
+        with self.__lock:
+            steps = {}
+            for action, samples in self.__samples.items():
+                ordered = sorted(samples)
+                steps[action] = {"samples": len(ordered), "p50_ms": percentile(ordered, 0.5), "p90_ms": percentile(ordered, 0.9),
+                                 "p99_ms": percentile(ordered, 0.99), "max_ms": round(ordered[-1] * 1000, 1)}
+            messages = self.messages_in + self.messages_out
+        games = sum(room.games for room in self.rooms)
+        return {"rooms": self.rooms_count, "games": games, "seconds": round(elapsed, 1), "games_per_s": round(games / elapsed, 2),
+                "messages": messages, "messages_per_s": round(messages / elapsed, 1), "missed": sum(r.missed for r in self.rooms),
+                "virtual_seconds": round(self.clock(), 1), "steps": steps}
+
+    def __drive(self):
+        """ Fires the rooms' timers as the virtual clock passes them """
+        while not self.__done.is_set():
+            self.wheel.run_due()
+            sleep(0.005)
+
+    def __on_connect(self, client, userdata, flags, rc):
+        client.subscribe("room/+/" + Topics.ROOM_STATUS.value, qos=1)
+        client.subscribe("alive", qos=0)
+        client.subscribe("presence/+/state", qos=0)
+        client.subscribe("telemetry/+", qos=0)
+        if self.serve_config:
+            client.subscribe("config/+/request", qos=0)
+            client.subscribe("probe/+/request", qos=0)
+        self.__connected.set()
+
+    def __on_message(self, client, userdata, msg):
+        with self.__lock:
+            self.messages_in += 1
+        kind, key, channel = (msg.topic.split("/") + [None, None])[:3]
+        if kind == "room" and channel == Topics.ROOM_STATUS.value:
+            room = self.__rooms_by_name.get(key)
+            if room is not None:
+                status = json.loads(msg.payload).get("status")
+                if status == RoomStatus.READY.value:
+                    # Back in idle, the room's game_idle callback runs before the status goes out
+                    return
+                room.room_status(status)
+        elif kind == "config" and key in self.__rooms_by_mac:
+            self.send("config/" + key + "/recieve", {"room": self.__rooms_by_mac[key].name, "points": self.points})
+        elif kind == "probe" and key in self.__rooms_by_mac:
+            with self.__lock:
+                self.messages_out += 1
+            client.publish("probe/" + key + "/echo", msg.payload, qos=0)
+
+
+if __name__ == "__main__":
+    # Load test against a local broker: python -m utils.RoomSimulator --rooms 50 --games 3 [--host h] [--port p]
+    import argparse
+    import os
+    import sys
+    import tempfile
+
+    from .storage import DATA_DIR_ENV
+
+    parser = argparse.ArgumentParser(prog="python -m utils.RoomSimulator", description=RoomSimulator.__doc__.split("\n")[0])
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--games", type=int, default=1, help="games each room plays")
+    parser.add_argument("--speed", type=float, default=20.0, help="virtual seconds per real second")
+    parser.add_argument("--script", default=PlayScript.DEFAULT, help=f"one game, default '{PlayScript.DEFAULT}'")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--server", action="store_true", help="the venue's server answers the config requests and probes")
+    parser.add_argument("--win-rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", action="store_true", help="show what the rooms log")
+    args = parser.parse_args()
+
+    # The rooms' caches and spools go to a directory of their own, not the Pi's
+    os.environ.setdefault(DATA_DIR_ENV, tempfile.mkdtemp(prefix="room-simulator-"))
+    simulator = RoomSimulator(args.rooms, args.games, args.speed, PlayScript(args.script), args.host, args.port,
+                              serve_config=not args.server, win_rate=args.win_rate, seed=args.seed)
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        report = simulator.run()
+    finally:
+        sys.stdout = out
+
+    print(f"SIM: {report['rooms']} rooms played {report['games']} games in {report['seconds']} s "
+          f"({report['games_per_s']}/s, {report['virtual_seconds']} s of virtual time), {report['missed']} steps missed")
+    print(f"SIM: {report['messages']} messages through the broker ({report['messages_per_s']}/s)")
+    for action, stats in report["steps"].items():
+        print(f"SIM: {action:12} p50 {stats['p50_ms']:8.1f} ms  p90 {stats['p90_ms']:8.1f} ms  p99 {stats['p99_ms']:8.1f} ms  "
+              f"max {stats['max_ms']:8.1f} ms  ({stats['samples']})")
@@ -0,0 +1,105 @@
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict
+
+from .Telemetry import Telemetry, telemetry
+
+
+class RttProbe(object):
+    """ Round trips to the server, to tell a slow network or broker apart from a slow room.
+
+    The room publishes a numbered probe on 'probe/<mac>/request', the server (or the stand-in in this module) publishes
+    the payload back unchanged on 'probe/<mac>/echo'. The round trip times are kept in a rolling window for the
+    percentiles, probes that aren't echoed within the timeout count as lost
+    """
+
+    def __init__(self, window: int = 100, timeout: float = 5.0, clock: Callable[[], float] = monotonic,
+                 registry: Telemetry = None):
+        """
+        Args:
+            window (int, optional): Percentiles are over the last this many round trips. Defaults to 100.
+            timeout (float, optional): Seconds after which a probe without an echo is lost. Defaults to 5.0.
+            clock (Callable[[], float], optional): Monotonic time in seconds. Defaults to time.monotonic.
+            registry (Telemetry, optional): Where the round trips are recorded. Defaults to telemetry().
+        """
+        self.timeout = timeout
+        self.clock = clock
+
+        self.__lock = Lock()
+        self.__next_id = 1
+        self.__pending: Dict[int, float] = {}
+        self.__window = deque(maxlen=window)
+
+        self.sent = 0
+        self.lost = 0
+        self.last_reason: str = None
+        self.__rtt_ms = (registry if registry is not None else telemetry()).histogram("mqtt.rtt_ms")
+
+    def request(self, reason: str) -> dict:
+        """ A new probe, returns the message to publish """
+        with self.__lock:
+            self.__expire()
+            probe_id = self.__next_id
+            self.__next_id += 1
+            self.__pending[probe_id] = self.clock()
+            self.sent += 1
+            self.last_reason = reason
+        return {"id": probe_id, "reason": reason}
+
+    def echo(self, probe_id: int) -> float:
+        """ The echo of a probe arrived, returns the round trip in seconds, None if it's unknown or already lost """
+        now = self.clock()
+        with self.__lock:
+            sent = self.__pending.pop(probe_id, None)
+            if sent is None or now - sent > self.timeout:
+                return None
+            rtt = now - sent
+            self.__window.append(rtt)
+        self.__rtt_ms.observe(rtt * 1000)
+        return rtt
+
+    def stats(self) -> dict:
+        """ Round trip percentiles in ms over the window, with how many probes were sent and lost """
+        with self.__lock:
+            self.__expire()
+            ordered = sorted(self.__window)
+
+        def percentile(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 1) if ordered else None
+
+        return {"samples": len(ordered), "p50_ms": percentile(0.5), "p90_ms": percentile(0.9), "p99_ms": percentile(0.99),
+                "max_ms": round(ordered[-1] * 1000, 1) if ordered else None, "sent": self.sent, "lost": self.lost,
+                "last_reason": self.last_reason}
+
+    def __expire(self):
+        now = self.clock()
+        for probe_id in [i for i, sent in self.__pending.items() if now - sent > self.timeout]:
+            del self.__pending[probe_id]
+            self.lost += 1
+
+
+if __name__ == "__main__":
+    # A stand-in for the server's side of the probe, echoes every room's probes: python -m utils.RttProbe <broker> [port]
+    import sys
+
+    import paho.mqtt.client as mqtt
+
+    from .ServerCommunicator import ServerCommunicator
+
+    host = sys.argv[1] if len(sys.argv) > 1 else "localhost"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 1883
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe("probe/+/request", qos=0)
+        print(f"PROBE: Echoing probes on {host}:{port}")
+
+    def on_message(client, userdata, msg):
+        client.publish(msg.topic.rsplit("/", 1)[0] + "/echo", msg.payload, qos=0)
+
+    client = mqtt.Client(client_id="probe-echo")
+    client.username_pw_set(ServerCommunicator.username, password=ServerCommunicator.password)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(host, port)
+    client.loop_forever()
@@ -1,40 +1,95 @@
+from __future__ import annotations
+
+from collections import deque
 from random import randint
-from zeroconf import IPVersion, ServiceBrowser, ServiceStateChange, Zeroconf
-from typing import Callable
+from typing import Callable, Tuple
 
-import paho.mqtt.client as mqtt
 from secrets import choice
 import string
 import json
+import weakref
+
+from threading import Event, RLock, Thread
+from time import monotonic, perf_counter, time
+from uuid import uuid4
+from .constants import DoubleRoomType, RoomStatus, Topics
+from .lazy import lazy_import
+from .TopicRouter import TopicRouter, TopicKey
+from .Codec import best_json_codec, codec_for, supported_content_types
+from .ConfigCache import ConfigCache
+from .Messages import MESSAGE_TYPES, ConfigMessage, EchoMessage
+from .MqttMux import MqttMux, MuxClient, mux_socket_path
+from .OutboundSpool import OutboundSpool, SpooledMessage
+from .QosProfile import PublishLatency, QosProfile
+from .ReconnectBackoff import ReconnectBackoff
+from .RttProbe import RttProbe
+from .NetworkIdentity import network_identity, NetworkIdentity
+from .storage import data_path, read_json, write_json
+from .Telemetry import Telemetry, telemetry
+from .TimerWheel import TimerWheel, shared_wheel
+from .TrafficRecorder import TrafficRecorder
 
-from threading import Timer
-from .constants import DoubleRoomType
-
-import netifaces
 import socket
 
-from apscheduler.schedulers.background import BackgroundScheduler
+# The network libraries are imported the first time they are used
+zc = lazy_import("zeroconf")
+mqtt = lazy_import("paho.mqtt.client")
 
 
 class ServerFinder(object):
+    """ Finds the MQTT server, the last server that worked is tried first.
+
+    A search races the endpoint saved from the last successful connection against the zeroconf browse and the permanent
+    fallback (a little later, happy eyeballs style). The saved endpoint and the fallback are tried with a TCP connect,
+    the first one that answers wins. Call report_connected when the connection has been made, that saves the endpoint
+    for the next boot and reports how long it took to get connected.
+
+    When the local multiplexer (MqttMux) is running it already holds the connection to the broker, the search finds its
+    socket (with port 0) right away and the communicator attaches to it. A finder with a fixed server (e.g. the
+    simulator's broker) doesn't search at all
+    """
 
     services = ["_team._tcp.local."]
 
     permanent_server_ip = "192.168.1.200"
     permanent_server_port = 51000
 
-    def __init__(self, on_server_found: Callable[[str, int], None]):
+    fallback_delay = 1.0
+    """ Seconds the fallback waits for the saved endpoint and zeroconf before it's tried """
+    probe_timeout = 1.0
+
+    def __init__(self, on_server_found: Callable[[str, int], None], use_mux: bool = True, fixed: Tuple[str, int] = None,
+                 wheel: TimerWheel = None):
         self.__on_server_found = on_server_found
+        self.__use_mux = use_mux
+        self.__fixed = fixed
+        # The probes run on the room's wheel, the shared one unless the room has its own (a replay)
+        self.__wheel = wheel
 
         self.__server_found = False
         self.__browser = None
+        self.__zeroconf = None
         self.__no_times_searched = 0
 
-        self.__check_online_thread = None
+        # Without an IP the search waits for the link to come up, the network identity tells us when it does
+        self.__network = network_identity()
+        self.__waiting_for_ip = False
+        self.__network.subscribe(self.__on_network_change)
 
         self.__found_ip = None
         self.__found_port = None
 
+        self.__endpoint_path = data_path("server_endpoint.json")
+        self.__lock = RLock()
+        self.__round = 0
+        self.__probes = []
+        self.__started = None
+        self.__found_by = None
+        self.__failed = None
+
+        self.time_to_connected: float = None
+        """ Seconds from the first search until the server was connected, None until it has been """
+
     def search(self, forced=False):
         # Cleanup if this is the second time around
         if self.__browser is not None:
@@ -43,54 +98,122 @@ class ServerFinder(object):
             self.__zeroconf.close()
             self.__browser = None
 
-        if self.__check_online_thread is not None:
-            print("ServerFinder: The online checker is not None, canceling it")
-            self.__check_online_thread.cancel()
-            self.__check_online_thread = None
+        self.__waiting_for_ip = False
+
+        if self.__started is None:
+            self.__started = monotonic()
 
         # Start up (or over again), setting up a new browser will cause the callback to be called!
         # Since the removed callback isn't working, we are just recreating the browser everytime something fails, and let the
         # mqttclient handle disconnect events
         if forced:
+            # The endpoint we had didn't work, it's left out of the race
+            self.__failed = (self.__found_ip, self.__found_port)
             self.__server_found = False
             self.__found_ip = None
             self.__found_port = None
+
+        if self.__fixed is not None:
+            self.__found_by = "fixed"
+            self.__on_server_found(*self.__fixed)
+            return
+
+        if self.__use_mux and MqttMux.available():
+            print("ServerFinder: Using the local MQTT multiplexer")
+            self.__found_by = "mux"
+            self.__on_server_found(mux_socket_path(), 0)
+            return
         
         if self.__server_found:
             self.__on_server_found(self.__found_ip, self.__found_port)
             return
 
-        if self.__get_ip_addr() == "Unknown IP":
-            print("ServerFinder: Unknown IP, restarting ...")
-            self.__check_online_thread = Timer(0.5, self.search)
-            self.__check_online_thread.start()
+        if not self.__network.has_ip():
+            print("ServerFinder: Unknown IP, searching as soon as the link is up ...")
+            self.__waiting_for_ip = True
             
         elif self.__no_times_searched <= 5:
-            self.__zeroconf = Zeroconf(ip_version=IPVersion.V4Only)
-            self.__browser = ServiceBrowser(self.__zeroconf, ServerFinder.services, handlers=[
+            self.__start_race()
+            self.__zeroconf = zc.Zeroconf(ip_version=zc.IPVersion.V4Only)
+            self.__browser = zc.ServiceBrowser(self.__zeroconf, ServerFinder.services, handlers=[
                 self.on_service_state_change])
             self.__no_times_searched += 1
             print("ServerFinder:  Searching ...")
             
         else:
             print("ServerFinder: Forcing permanent fallback IP ...")
-            self.__on_server_found(
-                self.permanent_server_ip, self.permanent_server_port)
+            self.__won(self.__round, "fallback", self.permanent_server_ip, self.permanent_server_port)
             self.__no_times_searched = 0  # Resetting so that we search again just in case
 
-    def on_service_state_change(self, zeroconf: Zeroconf, service_type: str, name: str, state_change: ServiceStateChange
+    def on_service_state_change(self, zeroconf: zc.Zeroconf, service_type: str, name: str, state_change: zc.ServiceStateChange
                                 ) -> None:
         print(
             f"Service {name} of type {service_type} state changed: {state_change}")
 
-        if state_change == ServiceStateChange.Added:
+        if state_change == zc.ServiceStateChange.Added:
             info = zeroconf.get_service_info(service_type, name)
             if info:
-                addr = info.parsed_scoped_addresses(version=IPVersion.V4Only)
-                self.__found_ip = addr[0]
-                self.__found_port = info.port
-                self.__on_server_found(self.__found_ip, self.__found_port)
-                self.__server_found = True
+                addr = info.parsed_scoped_addresses(version=zc.IPVersion.V4Only)
+                self.__won(self.__round, "zeroconf", addr[0], info.port)
+
+    def report_connected(self):
+        """ Saves the endpoint we are connected to for the next boot, and reports the time it took to get connected """
+        if self.__found_ip is None or self.__found_by in ("mux", "fixed"):
+            return
+
+        saved = read_json(self.__endpoint_path, {})
+        same = saved.get("ip") == self.__found_ip and saved.get("port") == self.__found_port
+        write_json(self.__endpoint_path, {"ip": self.__found_ip, "port": self.__found_port, "last_success": int(time()),
+                                          "successes": saved.get("successes", 0) + 1 if same else 1})
+        self.__failed = None
+
+        if self.time_to_connected is None and self.__started is not None:
+            self.time_to_connected = monotonic() - self.__started
+            print(f"ServerFinder: Connected to {self.__found_ip}:{self.__found_port} (found by {self.__found_by}) "
+                  f"{self.time_to_connected:.2f} s after the first search")
+
+    def stats(self) -> dict:
+        return {"found_by": self.__found_by, "time_to_connected": self.time_to_connected, "searches": self.__no_times_searched}
+
+    def __start_race(self):
+        """ Tries the saved endpoint right away and the fallback a little later, zeroconf runs alongside them """
+        with self.__lock:
+            self.__round += 1
+            for probe in self.__probes:
+                probe.cancel()
+
+            candidates = []
+            saved = read_json(self.__endpoint_path, {})
+            if saved.get("ip") is not None and (saved["ip"], saved.get("port")) != self.__failed:
+                candidates.append(("saved endpoint", saved["ip"], saved["port"], 0.0))
+            if (self.permanent_server_ip, self.permanent_server_port) != self.__failed:
+                candidates.append(("fallback", self.permanent_server_ip, self.permanent_server_port, ServerFinder.fallback_delay))
+
+            wheel = self.__wheel if self.__wheel is not None else shared_wheel()
+            self.__probes = [wheel.call_later(delay, self.__probe, self.__round, source, ip, port, name=f"probe {source}",
+                                              offload=True) for source, ip, port, delay in candidates]
+
+    def __probe(self, round: int, source: str, ip: str, port: int):
+        if round != self.__round or self.__server_found:
+            return
+        try:
+            socket.create_connection((ip, port), timeout=ServerFinder.probe_timeout).close()
+        except OSError:
+            return
+        self.__won(round, source, ip, port)
+
+    def __won(self, round: int, source: str, ip: str, port: int):
+        """ The first endpoint of the search round that answers is used, the rest of the race is called off """
+        with self.__lock:
+            if round != self.__round or self.__server_found:
+                return
+            for probe in self.__probes:
+                probe.cancel()
+            self.__found_ip = ip
+            self.__found_port = port
+            self.__found_by = source
+            self.__server_found = True
+        self.__on_server_found(ip, port)
 
     def is_server_found(self) -> bool:
         return self.__server_found
@@ -99,25 +222,19 @@ class ServerFinder(object):
         if self.__browser is not None:
             self.__browser.cancel()
             self.__browser = None
-        if self.__check_online_thread is not None:
-            self.__check_online_thread.cancel()
-        self.__zeroconf.close()
+        self.__waiting_for_ip = False
+        self.__network.unsubscribe(self.__on_network_change)
+        if self.__zeroconf is not None:
+            self.__zeroconf.close()
         
         self.__server_found = False
         self.__found_ip = None
         self.__found_port = None
 
-    def __get_ip_addr(self):
-        ip = "Unknown IP"
-        try:
-            ip = str(netifaces.ifaddresses('eth0')[2][0]['addr'])
-        except KeyError:
-            try:
-                ip = str(netifaces.ifaddresses('wlan0')[2][0]['addr'])
-                ip += " (WiFi)"
-            except KeyError:
-                pass
-        return ip
+    def __on_network_change(self, network: NetworkIdentity):
+        if self.__waiting_for_ip and network.has_ip():
+            print("ServerFinder: The link is up, searching ...")
+            self.search()
 
 
 
@@ -131,208 +248,596 @@ class ServerCommunicator(object):
     config_job = None
     config_recieved = False
     
-    connect_job = None
-    
-    __loop_started = False
+    connect_timeout = 10.0
+    """ Seconds to wait for the broker to accept the connection before the attempt counts as failed """
+    keepalive = 30
+    """ Seconds between MQTT keepalives, the broker sends our last will when it hasn't heard from us for 1.5 times this """
+
+    telemetry_interval = 60.0
+    """ Seconds between the telemetry batches, the server can set it with 'telemetryInterval' in the config """
+
+    rtt_interval = 60.0
+    """ Seconds between the round trip probes, the room also probes when something arrives later than expected """
+
+    heartbeat_min = 60.0
+    heartbeat_max = 300.0
+    """ The ping goes out when nothing else has for this long, the quiet time doubles with every ping in a row """
+
+    room_status_topic = "room/{room}/room_status"
+    """ Spooled statuses keep the '{room}' and get the room we are in when they go out, it may not be known when they are sent """
+
     __disconnect_handled = False
 
 
     def __init__(self, on_connect: Callable[[None], None], on_server_lost: Callable[[None], None], 
                  on_config: Callable[[bool, dict], None], on_message: Callable[[str, str], None],
-                 is_a_spy: bool = False, on_message_other_room: Callable[[str, str], None] = None
-                 ):
+                 is_a_spy: bool = False, on_message_other_room: Callable[[str, str], None] = None,
+                 qos_profile: QosProfile = None, network: NetworkIdentity = None, wheel: TimerWheel = None,
+                 record_traffic: bool = True, on_room_status: Callable[[str, int], None] = None):
         """Init the Server communicator to talk with the MQTT Server
 
         Args:
             `on_connect` (Callable[[None], None]): connection callback
             `on_server_lost` (Callable[[None], None]): server lost callback
-            `on_config` (Callable[[bool, dict], None]): game config received callback
-            `on_message` (Callable[[str, str], None]): message from the server received callback
+            `on_config` (Callable[[bool, ConfigMessage], None]): game config received callback
+            `on_message` (Callable[[str, Message], None]): message from the server received callback, called with the topic's
+            channel (e.g. 'door_status') and the validated message (e.g. DoorStatusMessage)
             `is_a_spy` (`bool`, optional): Ask the server to not update room health/monitor with this connection. Defaults to `False`, 
+            `qos_profile` (`QosProfile`, optional): The QoS of each class of topic. Defaults to `QosProfile.load()`
+            `network` (`NetworkIdentity`, optional): Who the room is, e.g. a simulated room's MAC. Defaults to the Pi's `network_identity()`
+            `wheel` (`TimerWheel`, optional): The wheel the room's jobs run on, e.g. one on a replay's clock. Defaults to `shared_wheel()`
+            `record_traffic` (`bool`, optional): Write every message in and out to 'traffic/<mac>.rec' in the data directory, see
+            `TrafficRecorder`. Defaults to `True`
+            `on_room_status` (`Callable[[str, int], None]`, optional): Called with every status (and level) the room sends
         """
         self.message_callback = on_message
         self.message_from_other_callback = on_message_other_room
         self.connect_callback = on_connect
         self.config_callback = on_config
         self.disconnect_callback = on_server_lost
+        self.room_status_callback = on_room_status
         self.is_a_spy = is_a_spy
         
         self.double_room_slave = False
         self.room_other = None
         
-        self.macaddress = str(netifaces.ifaddresses('eth0')[
-                              netifaces.AF_LINK][0]['addr'])
+        self.network = network if network is not None else network_identity()
+        self.macaddress = self.network.mac
 
-        clientid = "Room_" + self.macaddress + "_" + \
+        self.__client_id = "Room_" + self.macaddress + "_" + \
             "".join([choice(string.ascii_lowercase + string.digits)
                     for _ in range(6)])
         
-        self.mqttclient = mqtt.Client(client_id=clientid)
-
-        self.mqttclient.on_connect = self.on_connect_event
-        self.mqttclient.on_disconnect = self.on_disconnected
-        self.mqttclient.on_message = self.on_message_received
-        self.mqttclient.username_pw_set(self.username, password=self.password)
-
-        self.scheduler = BackgroundScheduler(timezone="Europe/Stockholm")
-        self.scheduler.start()
+        self.mqttclient = self.__new_client(mux=False)
+        # Json until the server has picked a content type in the config, the config request itself is always json
+        self.codec = best_json_codec()
+        # Only the topics we have subscribed to have a route, anything else is rejected
+        self.router = TopicRouter(self.codec.decode)
+
+        # The game results are spooled to disk until paho reports them as sent, and replayed on the next connect. The
+        # other statuses (READY) are spooled too, a newer one replaces the one that is waiting. The rest (presence, pings,
+        # telemetry) is only worth sending while we are connected, a newer one follows.
+        # The spy runs next to the room on the same Pi, so it gets its own spool, as does every room of the simulator
+        spool_name = "spy.log" if is_a_spy else "outbound.log" if network is None else self.macaddress.replace(":", "") + ".log"
+        self.spool = OutboundSpool(data_path("spool", spool_name))
+        self.__inflight = {}
+        self.__inflight_lock = RLock()
+        # Spooled statuses that wait for the config to tell us which room we are
+        self.__held = []
+        self.qos = qos_profile if qos_profile is not None else QosProfile.load()
+        self.publish_latency = PublishLatency()
+        # Under QoS 1 the other room's statuses can arrive twice, they are only handed on once
+        self.__seen_message_ids = deque(maxlen=32)
+        self.recorder = TrafficRecorder(data_path("traffic", self.macaddress.replace(":", "") + ".rec"), self.macaddress) \
+            if record_traffic and not is_a_spy else None
+
+        # The last config is cached so it can be used as soon as we are connected, the server's copy is checked against
+        # it when it arrives
+        self.config_cache = ConfigCache()
+        self.config: ConfigMessage = None
+        self.config_etag: str = None
+        self.config_from_cache = False
+
+        # The config request and ping jobs run on the timer wheel that all the room's timers share
+        self.scheduler = wheel if wheel is not None else shared_wheel()
+
+        # Connecting and paho's network loop run on one thread that lives as long as the communicator. The attempts are
+        # paced by the backoff, which is only reset by a connection, so a venue of rooms that lost the broker at the
+        # same moment doesn't come back at the same moment
+        self.backoff = ReconnectBackoff()
+        self.__target = None
+        self.__next_attempt = 0.0
+        self.__retry = False
+        self.__attempt_started = None
+        self.__lost_at = None
+        self.__wake = Event()
+        self.__exiting = False
+        self.__network_thread = None
+
+        # The broker keeps the room's state (retained) on 'presence/<mac>/state', and publishes our last will there
+        # if we go away without saying so. The spy shares the room's MAC, it stays out of it
+        self.presence_topic = "presence/" + self.macaddress + "/state"
+        self.__status: str = None
+        self.__last_sent = monotonic()
+        self.__heartbeat_interval = self.heartbeat_min
+        self.pings_sent = 0
+        self.pings_skipped = 0
+
+        self.connect_attempts = 0
+        self.connect_failures = 0
+        self.recoveries = 0
+        self.last_time_to_recover: float = None
+        self.max_time_to_recover = 0.0
+
+        # Metrics are collected by the telemetry registry and sent as one batch every 'telemetry_interval'. A room with an
+        # injected identity (one of the simulator's) has a registry of its own, the readers below are this room's
+        self.telemetry = telemetry() if network is None else Telemetry()
+        self.telemetry_job = None
+        # The bucket bounds of the histograms go with the first batch of every connection, not with every batch
+        self.__telemetry_bounds_sent = False
+        self.rtt = RttProbe(registry=self.telemetry)
+        self.rtt_job = None
+        self.__dispatch_ms = self.telemetry.histogram("mqtt.dispatch_ms")
+        self.__recover_s = self.telemetry.histogram("mqtt.time_to_recover_s", (1, 2, 5, 10, 30, 60, 120, 300))
+        self.__readers = []
+        if not is_a_spy:
+            # The room's registry lives as long as the process, it reads us through a weak reference so it doesn't keep
+            # us alive. The readers are removed again when we exit
+            ref = weakref.ref(self)
+            for name, read, counter in (("mqtt.connect_attempts", lambda c: c.connect_attempts, True),
+                                        ("mqtt.connect_failures", lambda c: c.connect_failures, True),
+                                        ("mqtt.recoveries", lambda c: c.recoveries, True),
+                                        ("mqtt.pings_skipped", lambda c: c.pings_skipped, True),
+                                        ("mqtt.spool_pending", lambda c: len(c.spool.pending()), False),
+                                        ("mqtt.rtt_lost", lambda c: c.rtt.lost, True)):
+                reader = ServerCommunicator.__weak_reader(ref, read)
+                (self.telemetry.read_counter if counter else self.telemetry.read_gauge)(name, reader)
+                self.__readers.append((name, reader))
+
+    @staticmethod
+    def __weak_reader(ref: "weakref.ref[ServerCommunicator]", read: Callable[[ServerCommunicator], float]) -> Callable[[], float]:
+        """ Reads the value from the communicator while there is one, None (left out of the batch) once it's gone """
+        def reader():
+            communicator = ref()
+            return read(communicator) if communicator is not None else None
+        return reader
 
     def __del__(self):
-        self.disconnect(True)
-        #self.__set_loop(False)
-        self.scheduler.shutdown()
-
-    def __set_loop(self, start: bool):
-        if start and not self.__loop_started:
-            self.mqttclient.loop_start()
-            self.__loop_started = True
-        
-        elif not start and self.__loop_started:
-            self.mqttclient.loop_stop()
-            self.__loop_started = False
+        self.disconnect(True, exiting=True)
+        self.__remove_config_job()
+        self.__remove_ping_job()
+
+    def __new_client(self, mux: bool):
+        """ paho's client for a broker, or the multiplexer's client that stands in for it """
+        client = MuxClient(client_id=self.__client_id) if mux else mqtt.Client(client_id=self.__client_id)
+        client.on_connect = self.on_connect_event
+        client.on_disconnect = self.on_disconnected
+        client.on_message = self.on_message_received
+        client.on_publish = self.on_published
+        client.username_pw_set(self.username, password=self.password)
+        return client
 
     def connect(self, addr: str, port: int):
-        self.__remove_connect_job()
-        self.connect_job = self.scheduler.add_job(
-            self.__connect_job, 'interval', seconds=5, args=[addr, port], jitter=2)
+        """ Connects to the broker, right away the first time and after the backoff's delay when an attempt has failed
+        or the connection was lost. An attempt that is already waiting keeps its time, it only goes to the new address """
+        if self.__lost_at is None:
+            self.__lost_at = monotonic()
+        self.__disconnect_handled = False
+        waiting = self.__target is not None and self.__next_attempt > monotonic()
+        self.__target = (addr, port)
+        if not waiting:
+            # One delay per failure, finding the server again while we wait doesn't draw another one
+            delay = self.backoff.next() if self.__retry else 0.0
+            self.__retry = False
+            self.__next_attempt = monotonic() + delay
+            if delay:
+                print(f"ServerCommunicator: Connecting to {addr}:{port} in {delay:.1f} s (retry {self.backoff.attempts})")
+
+        if self.__network_thread is None:
+            self.__network_thread = Thread(target=self.__network_loop, name="MQTT", daemon=True)
+            self.__network_thread.start()
+        self.__wake.set()
     
     def is_connected(self) -> bool:
         return self.mqttclient.is_connected()
-    
-    def __connect_job(self, addr: str, port: int):
-        self.disconnect()
+
+    def __network_loop(self):
+        """ Runs paho's loop while there is a socket, and the next connect attempt when it's due while there isn't """
+        while not self.__exiting:
+            if self.mqttclient.socket() is not None:
+                self.mqttclient.loop(timeout=1.0)
+                if self.__attempt_started is not None and monotonic() - self.__attempt_started > self.connect_timeout:
+                    # The broker took the socket but never accepted the connection, it's dropped like a lost connection
+                    print("ServerCommunicator: No answer from the broker, giving up on this attempt")
+                    self.__attempt_started = None
+                    self.connect_failures += 1
+                    self.mqttclient.disconnect()
+                continue
+
+            self.__wake.clear()
+            if self.__target is None:
+                self.__wake.wait()
+            elif self.__next_attempt > monotonic():
+                self.__wake.wait(self.__next_attempt - monotonic())
+            else:
+                self.__attempt(*self.__target)
+
+    def __attempt(self, addr: str, port: int):
+        self.connect_attempts += 1
+        self.__attempt_started = monotonic()
+        mux = addr == mux_socket_path()
+        if mux != isinstance(self.mqttclient, MuxClient):
+            # There is no socket between attempts, the client is swapped for the multiplexer's or paho's
+            print(f"ServerCommunicator: {'Attaching to the local multiplexer' if mux else 'Connecting to the broker directly'}")
+            self.mqttclient = self.__new_client(mux)
         try:
-            self.mqttclient.connect(addr, port)
-            self.__set_loop(True)
-        except:
-            # Something went wrong, notifying the user
-            self.__remove_connect_job()
+            if not self.is_a_spy:
+                # Set for every attempt, so the will has the room and status we last had
+                self.mqttclient.will_set(self.presence_topic, self.__presence(False), qos=self.qos.qos(QosProfile.PRESENCE),
+                                         retain=True)
+            # Blocks until the socket is connected, the broker's answer arrives through the loop (on_connect_event)
+            self.mqttclient.connect(addr, port, keepalive=self.keepalive)
+        except Exception as e:
+            # Something went wrong, notifying the user who will look for the server again and call connect
+            print(f"ServerCommunicator: Connecting to {addr}:{port} failed: {e}")
+            self.__attempt_started = None
+            self.__target = None
+            self.__retry = True
+            self.connect_failures += 1
             self.disconnect_callback()
-    
-    def __remove_connect_job(self):
-        if self.connect_job != None:
-            self.connect_job.remove()
-            self.connect_job = None
 
-    def disconnect(self, avoid_callback=False):
-        if self.is_connected():
+    def reconnect_stats(self) -> dict:
+        return {"attempts": self.connect_attempts, "failures": self.connect_failures, "recoveries": self.recoveries,
+                "last_time_to_recover": self.last_time_to_recover, "max_time_to_recover": round(self.max_time_to_recover, 2)}
+
+    def disconnect(self, avoid_callback=False, exiting=False):
+        self.__target = None
+        # Set first, paho can report the disconnect before disconnect() returns
+        self.__disconnect_handled = avoid_callback
+        if self.mqttclient.socket() is not None:
             try:
+                if exiting and not self.is_a_spy and self.is_connected():
+                    # The broker doesn't send the will on a clean disconnect
+                    self.__publish_now(self.presence_topic, self.__presence(False), QosProfile.PRESENCE, retain=True)
                 self.mqttclient.disconnect()
             except:
                 pass
             
-        self.__set_loop(False)
-        self.__disconnect_handled = avoid_callback
+        if exiting:
+            self.__exiting = True
+            self.__wake.set()
+            for name, reader in self.__readers:
+                self.telemetry.remove_reader(name, reader)
+            self.__readers = []
 
     def send_room_status(self, message, level: int = None):
-        payload = {"status": message,
-                   "mac": self.macaddress, "room": self.room}
+        if self.room_status_callback is not None:
+            self.room_status_callback(message, level)
+        payload = {"status": message, "mac": self.macaddress}
         if level is not None:
             payload["level"] = level
+        # The same status sent twice (QoS 1 redelivery, a replay from the spool) has the same id, the server acts on it once
+        payload["msgId"] = uuid4().hex
 
-        self.mqttclient.publish("room/" + self.room +
-                                "/room_status", json.dumps(payload), qos=2)
+        # Spooled as json without the room, both are filled in when it goes out
+        if message in (RoomStatus.WON.value, RoomStatus.LOST.value, RoomStatus.RESET.value):
+            # Game results must reach the server, every one of them
+            self.__publish(self.room_status_topic, json.dumps(payload).encode(), QosProfile.ROOM_STATUS, critical=True)
+        else:
+            # Of the other statuses (e.g. READY) only the latest is worth sending after an outage, it replaces the waiting one
+            self.__publish(self.room_status_topic, json.dumps(payload).encode(), QosProfile.ROOM_STATUS, coalesce="status")
+
+        self.__status = message
+        self.__publish_presence()
+
+    def __presence(self, online: bool) -> bytes:
+        # Always json, it's read by anyone who subscribes, whatever they negotiated
+        return json.dumps({"mac": self.macaddress, "online": online, "room": None if self.room == "-1" else self.room,
+                           "status": self.__status, "ip": self.network.ip}).encode()
+
+    def __publish_presence(self):
+        if not self.is_a_spy:
+            self.__publish_now(self.presence_topic, self.__presence(True), QosProfile.PRESENCE, retain=True)
+
+    def __publish(self, topic: str, payload: bytes, topic_class: str, critical: bool = False, coalesce: str = None,
+                  retain: bool = False):
+        """ Spools the message and sends it right away if we are connected, otherwise it goes out on the next connect """
+        message = self.spool.append(topic, payload, self.qos.qos(topic_class), critical, coalesce, retain)
+        if self.is_connected():
+            self.__send(message)
+
+    def __publish_now(self, topic: str, payload, topic_class: str, retain: bool = False):
+        """ Publishes without spooling, for what is only worth sending while we are connected. Dropped while we aren't """
+        if self.is_connected():
+            self.__send(SpooledMessage(None, topic, payload, self.qos.qos(topic_class), False, None, retain))
+
+    def __send(self, message: SpooledMessage):
+        # The lock makes sure the mid is known before paho's thread can report it as published
+        with self.__inflight_lock:
+            topic, payload = message.topic, message.payload
+            if "{room}" in topic:
+                if self.room == "-1":
+                    # Sent when the config has told us which room we are
+                    self.__held.append(message)
+                    return
+                status = json.loads(payload)
+                status["room"] = self.room
+                topic, payload = topic.format(room=self.room), self.codec.encode(status)
+
+            info = self.mqttclient.publish(topic, payload, qos=message.qos, retain=message.retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                return
+            if self.recorder is not None:
+                self.recorder.outbound(topic, payload)
+            self.__last_sent = monotonic()
+            if message.topic != "alive":
+                # The room is busy, the server hears from it anyway
+                self.__heartbeat_interval = self.heartbeat_min
+            self.publish_latency.sent(info.mid, message.qos)
+            if info.is_published():
+                # QoS 0 can be written (and reported) before publish returns
+                self.publish_latency.acked(info.mid)
+                if message.seq is not None:
+                    self.spool.ack(message.seq)
+            else:
+                self.__inflight[info.mid] = message.seq
+
+    def __send_held(self):
+        with self.__inflight_lock:
+            held, self.__held = self.__held, []
+        for message in held:
+            self.__send(message)
+
+    def __replay_spool(self):
+        with self.__inflight_lock:
+            self.__inflight.clear()
+            # Everything pending goes out again, the held ones with it
+            self.__held.clear()
+        self.publish_latency.forget()
+        pending = self.spool.pending()
+        if pending:
+            print(f"ServerCommunicator: Replaying {len(pending)} spooled messages")
+        for message in pending:
+            self.__send(message)
+
+    def on_published(self, client, userdata, mid):
+        with self.__inflight_lock:
+            if mid not in self.__inflight:
+                return
+            seq = self.__inflight.pop(mid)
+        self.publish_latency.acked(mid)
+        if seq is not None:
+            self.spool.ack(seq)
+
+    def publish_stats(self) -> dict:
+        """ The QoS profile and the publish to ack latency per QoS """
+        return {"profile": self.qos.as_dict(), "latency": self.publish_latency.stats()}
 
     def send_config_request(self):
         self.__remove_config_job()
         self.config_recieved = False
         self.__send_config_request_job()
-        self.config_job = self.scheduler.add_job(
-            self.__send_config_request_job, 'interval', seconds=4, jitter=2)
+        self.config_job = self.scheduler.call_every(4, self.__send_config_request_job, name="config request", jitter=2)
 
     def __send_config_request_job(self):
         if not self.config_recieved:
-            ip = self.__get_ip_addr()
-
-            message = {"mac": self.macaddress, "type": "room", "ip": ip, "hostname": socket.gethostname(),
-                       "spy": self.is_a_spy
+            message = {"mac": self.macaddress, "type": "room", "ip": self.network.ip, "hostname": self.network.hostname,
+                       "spy": self.is_a_spy, "accept": supported_content_types(), "etag": self.config_etag
                        }
-            self.mqttclient.publish(
-                "config/" + self.macaddress + "/request", json.dumps(message), qos=2)
+            self.__publish_now("config/" + self.macaddress + "/request", json.dumps(message), QosProfile.CONFIG_REQUEST)
         else:
             self.config_recieved = True
             self.__remove_config_job()
 
     def __remove_config_job(self):
         if self.config_job != None:
-            self.config_job.remove()
+            self.config_job.cancel()
             self.config_job = None
     
     def on_disconnected(self, client, userdata, rc):
         self.__remove_config_job()
         self.__remove_ping_job()
+        if self.rtt_job is not None:
+            self.rtt_job.cancel()
+            self.rtt_job = None
+        if self.__attempt_started is not None:
+            # Dropped before the broker accepted the connection
+            self.__attempt_started = None
+            self.connect_failures += 1
+        if self.__lost_at is None:
+            self.__lost_at = monotonic()
+        # Failed, refused or lost, the next attempt waits for the backoff
+        self.__retry = True
 
         if not self.__disconnect_handled:
             self.disconnect()
             self.disconnect_callback()
 
     def on_message_received(self, client, userdata, msg):
-        decoded_message = json.loads(msg.payload.decode())
-        other_room = False
-
-        if "config" in msg.topic:
-            self.on_config_received(decoded_message)
-            return
-
-        if self.room_other and f"/{self.room_other}/" in msg.topic:
-            other_room = True
-
-        if not other_room:
-            self.message_callback(msg.topic, decoded_message)
-        else:
-            self.message_from_other_callback(msg.topic, decoded_message)
-
-    def on_config_received(self, config):
-        # Setup all the jobs and unsubscribe any previous engagements
+        if self.recorder is not None:
+            self.recorder.inbound(msg.topic, msg.payload)
+        started = perf_counter()
+        self.router.dispatch(msg.topic, msg.payload)
+        self.__dispatch_ms.observe((perf_counter() - started) * 1000)
+
+    def __on_room_message(self, key: TopicKey, message: dict):
+        self.message_callback(key.channel, message)
+
+    def __on_other_room_message(self, key: TopicKey, message: dict):
+        message_id = message.get("msgId")
+        if message_id is not None:
+            if message_id in self.__seen_message_ids:
+                return
+            self.__seen_message_ids.append(message_id)
+        self.message_from_other_callback(key.channel, message)
+
+    def on_config_received(self, config: ConfigMessage):
         self.__remove_config_job()
-        room_configuration = str(config['room'])
+        room_configuration = str(config.room)
         if room_configuration == 'removed':
+            self.codec = codec_for(config.contentType)
+            self.router.decode = self.codec.decode
+            self.config = None
+            self.config_etag = None
+            self.config_cache.forget(self.macaddress)
             self.config_callback(False, None)
             return
 
+        etag = ConfigCache.etag(config)
+        if etag == self.config_etag:
+            # The one we are already running with (from the cache), nothing to apply
+            print("ServerCommunicator: Config unchanged")
+            self.config_from_cache = False
+            return
+
+        self.__apply_config(config)
+        self.config_etag = self.config_cache.store(self.macaddress, config)
+        self.config_from_cache = False
+        if self.is_connected():
+            self.__send_held()
+        self.config_callback(True, config)
+
+    def __apply_config(self, config: ConfigMessage):
+        # Setup all the jobs and unsubscribe any previous engagements
+        self.config = config
+        self.codec = codec_for(config.contentType)
+        self.router.decode = self.codec.decode
         self.__setup_ping_job()
-        self.room = str(config['room'])
+        self.__setup_telemetry_job(config.telemetryInterval or self.telemetry_interval)
+        self.room = str(config.room)
 
         self.mqttclient.unsubscribe("room/#")
         self.mqttclient.unsubscribe("door/#")
+        self.router.remove_kind("room")
+        self.router.remove_kind("door")
         # Server or Door can ask the room to start playing or to stop
-        self.mqttclient.subscribe("room/" + self.room + "/set_status", 2)
-        self.mqttclient.subscribe("door/" + self.room + "/door_status", 2)
-        self.mqttclient.subscribe("door/" + self.room + "/tag_scan_result", 2)
+        self.__subscribe("room/" + self.room + "/" + Topics.SET_STATUS.value, self.__on_room_message, QosProfile.SET_STATUS)
+        self.__subscribe("door/" + self.room + "/" + Topics.DOOR_STATUS.value, self.__on_room_message, QosProfile.DOOR_STATUS)
+        self.__subscribe("door/" + self.room + "/" + Topics.SCAN_RESULT.value, self.__on_room_message, QosProfile.SCAN_RESULT)
 
         # Do we have a special room?
-        if 'roomType' in config:
-            self.room_type = DoubleRoomType(str(config['roomType'])) 
-            self.room_other = config['otherRoomNbr']
-            if 'isRoomSpy' in config:
+        if config.roomType is not None:
+            self.room_type = DoubleRoomType(config.roomType)
+            self.room_other = str(config.otherRoomNbr)
+            if config.isRoomSpy is not None:
                 # If we are a spy (slave unit) we listen to what the other room reports and react accordingly
-                self.double_room_slave = config['isRoomSpy']
-            self.mqttclient.subscribe("room/" + self.room_other + "/room_status", qos=2)
-            self.mqttclient.subscribe("door/" + self.room_other + "/door_status", qos=2)
+                self.double_room_slave = config.isRoomSpy
+            self.__subscribe("room/" + self.room_other + "/" + Topics.ROOM_STATUS.value, self.__on_other_room_message,
+                             QosProfile.OTHER_ROOM_STATUS)
+            self.__subscribe("door/" + self.room_other + "/" + Topics.DOOR_STATUS.value, self.__on_other_room_message,
+                             QosProfile.OTHER_DOOR_STATUS)
             
         else:
             self.room_type = None
             self.double_room_slave = False
             self.room_other = None
 
-        self.config_callback(True, config)
-
     def on_connect_event(self, clientRef, userdata, flags, rc):
-        self.__remove_connect_job()
-        self.mqttclient.subscribe(
-            "config/" + self.macaddress + "/recieve", qos=2)
+        self.__attempt_started = None
+        if rc != 0:
+            # Refused (e.g. the broker is still starting), paho drops the socket and on_disconnected takes it from there
+            print(f"ServerCommunicator: The broker refused the connection: {mqtt.connack_string(rc)}")
+            self.connect_failures += 1
+            return
+
+        if self.__lost_at is not None:
+            self.last_time_to_recover = monotonic() - self.__lost_at
+            self.max_time_to_recover = max(self.max_time_to_recover, self.last_time_to_recover)
+            self.recoveries += 1
+            self.__recover_s.observe(self.last_time_to_recover)
+            self.__lost_at = None
+            if self.backoff.attempts:
+                print(f"ServerCommunicator: Connected after {self.backoff.attempts} retries, "
+                      f"{self.last_time_to_recover:.1f} s without the server")
+        self.backoff.reset()
+        self.__retry = False
+        self.__telemetry_bounds_sent = False
+        self.__subscribe("config/" + self.macaddress + "/recieve", lambda key, config: self.on_config_received(config),
+                         QosProfile.CONFIG)
+        if not self.is_a_spy:
+            self.__subscribe("probe/" + self.macaddress + "/echo", self.__on_probe_echo, QosProfile.PROBE)
+            if self.rtt_job is not None:
+                self.rtt_job.cancel()
+            self.rtt_job = self.scheduler.call_every(self.rtt_interval, self.probe_rtt, "scheduled", name="rtt probe",
+                                                     jitter=self.rtt_interval / 10)
+        if self.config is None:
+            cached = self.config_cache.load(self.macaddress)
+            if cached is not None:
+                self.config, self.config_etag = cached
+                self.config_from_cache = True
+        if self.config is not None:
+            # Subscriptions don't outlive the connection, the config we have is applied again right away
+            self.__apply_config(self.config)
+        # What didn't make it out before (broker down, restart) goes first, in the order it was sent
+        self.__replay_spool()
+        self.__publish_presence()
         self.connect_callback()
 
+    def __subscribe(self, topic: str, handler: Callable[[TopicKey, dict], None], topic_class: str):
+        """ Subscribes to the topic at its class' QoS and routes its messages, validated into the channel's message type,
+        to the handler """
+        self.router.add(topic, handler, MESSAGE_TYPES.get(topic.rsplit("/", 1)[-1]))
+        self.mqttclient.subscribe(topic, qos=self.qos.qos(topic_class))
+
     def __setup_ping_job(self):
         self.__remove_ping_job()
+        self.__heartbeat_interval = self.heartbeat_min
         self.send_ping()
+        self.__schedule_heartbeat(self.__heartbeat_interval)
+
+    def __schedule_heartbeat(self, delay: float):
         # Adding seconds parameter so that not all send at the same time
-        self.ping_job = self.scheduler.add_job(
-            self.send_ping, 'interval', minutes=1, seconds=randint(0, 15))
+        self.ping_job = self.scheduler.call_later(delay + randint(0, 15), self.__heartbeat, name="ping")
+
+    def __heartbeat(self):
+        """ Pings only if nothing has been sent for a while, the last will and the retained presence tell the server
+        when we are gone, the ping only keeps its health monitor fed """
+        if not self.is_connected():
+            return
+        quiet = monotonic() - self.__last_sent
+        if quiet >= self.__heartbeat_interval:
+            self.send_ping()
+            self.pings_sent += 1
+            self.__heartbeat_interval = min(self.__heartbeat_interval * 2, self.heartbeat_max)
+            self.__schedule_heartbeat(self.__heartbeat_interval)
+        else:
+            self.pings_skipped += 1
+            self.__schedule_heartbeat(self.__heartbeat_interval - quiet)
+
+    def probe_rtt(self, reason: str = "on demand"):
+        """ Sends a round trip probe to the server, see rtt_stats for the results """
+        if self.is_a_spy or not self.is_connected():
+            return
+        # Not spooled, a probe that waited for the connection would measure the wait
+        self.__publish_now("probe/" + self.macaddress + "/request", self.codec.encode(self.rtt.request(reason)), QosProfile.PROBE)
+
+    def __on_probe_echo(self, key: TopicKey, echo: EchoMessage):
+        rtt = self.rtt.echo(echo.id)
+        if rtt is not None and echo.reason != "scheduled":
+            print(f"ServerCommunicator: Round trip to the server {rtt * 1000:.1f} ms ({echo.reason})")
+
+    def rtt_stats(self) -> dict:
+        return self.rtt.stats()
+
+    def __setup_telemetry_job(self, interval: float):
+        if self.is_a_spy:
+            return
+        if self.telemetry_job is not None:
+            self.telemetry_job.cancel()
+        self.telemetry_job = self.scheduler.call_every(interval, self.send_telemetry, name="telemetry", jitter=interval / 10)
+
+    def send_telemetry(self):
+        """ Sends what the registry has collected since the last batch to 'telemetry/<mac>' """
+        if not self.is_connected():
+            # It keeps collecting, the next batch covers the time we were away
+            return
+        batch = self.telemetry.batch(all_bounds=not self.__telemetry_bounds_sent)
+        self.__telemetry_bounds_sent = True
+        self.__publish_now("telemetry/" + self.macaddress, self.codec.encode(batch), QosProfile.TELEMETRY)
 
     def __remove_ping_job(self):
         if self.ping_job != None:
-            self.ping_job.remove()
+            self.ping_job.cancel()
             self.ping_job = None
 
     def get_room_type(self):
@@ -343,18 +848,5 @@ class ServerCommunicator(object):
         return self.double_room_slave
     
     def send_ping(self):
-        ip = self.__get_ip_addr()
-        message = {"mac": self.macaddress, "ip": ip, "type": "room"}
-        self.mqttclient.publish("alive", json.dumps(message), qos=1)
-
-    def __get_ip_addr(self):
-        ip = "Unknown IP"
-        try:
-            ip = str(netifaces.ifaddresses('eth0')[2][0]['addr'])
-        except KeyError:
-            try:
-                ip = str(netifaces.ifaddresses('wlan0')[2][0]['addr'])
-                ip += " (WiFi)"
-            except KeyError:
-                pass
-        return ip
\ No newline at end of file
+        message = {"mac": self.macaddress, "ip": self.network.ip, "type": "room"}
+        self.__publish_now("alive", self.codec.encode(message), QosProfile.PING)
@@ -0,0 +1,190 @@
+from bisect import bisect_left
+from threading import Lock
+from time import time
+from typing import Callable, Dict, List, Tuple
+
+
+class Counter(object):
+    """ A count that only goes up, e.g. reconnect attempts. Exported as the total since the start """
+    __slots__ = ("value", "__lock")
+
+    def __init__(self):
+        self.value = 0
+        self.__lock = Lock()
+
+    def inc(self, amount: int = 1):
+        with self.__lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """ A value that goes up and down, e.g. messages waiting in the spool. Exported as the last value set """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram(object):
+    """ How often a value fell into each of a fixed set of buckets, e.g. latencies in ms.
+
+    'bounds' are the upper bounds of the buckets, the last bucket takes everything above them. Exported as the counts
+    since the last export, so every batch covers one interval
+    """
+    __slots__ = ("bounds", "counts", "count", "sum", "__lock")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.__lock = Lock()
+
+    def observe(self, value: float):
+        bucket = bisect_left(self.bounds, value)
+        with self.__lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += value
+
+    def take(self) -> list:
+        """ [count, sum, counts per bucket] since the last take, None if nothing was observed. Starts the next interval """
+        with self.__lock:
+            if not self.count:
+                return None
+            taken = [self.count, round(self.sum, 3), self.counts]
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.sum = 0.0
+            return taken
+
+
+class Telemetry(object):
+    """ The room's metrics, aggregated in memory and exported as one compact batch at an interval.
+
+    Metrics are created on first use by name, e.g. telemetry().histogram("mqtt.dispatch_ms").observe(0.2). Recording is
+    a dict lookup and an addition under the metric's own lock, cheap enough for every message and every timer. The
+    registry's lock only guards creating metrics and taking the batch.
+
+    telemetry() is the room's registry. Where several rooms run in one process (the simulator) each room's communicator
+    has a registry of its own, so a batch only has that room's metrics
+    """
+
+    LATENCY_MS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 250, 500, 1000)
+    """ Bucket bounds for latencies in milliseconds, the default for histograms """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__counters: Dict[str, Counter] = {}
+        self.__gauges: Dict[str, Gauge] = {}
+        self.__histograms: Dict[str, Histogram] = {}
+        self.__gauge_readers: Dict[str, Callable[[], float]] = {}
+        self.__counter_readers: Dict[str, Callable[[], int]] = {}
+        # Histograms whose bucket bounds have been in a batch, they don't change so they are only sent once
+        self.__bounds_sent = set()
+        self.batches = 0
+
+    def counter(self, name: str) -> Counter:
+        metric = self.__counters.get(name)
+        if metric is None:
+            with self.__lock:
+                metric = self.__counters.setdefault(name, Counter())
+        return metric
+
+    def gauge(self, name: str) -> Gauge:
+        metric = self.__gauges.get(name)
+        if metric is None:
+            with self.__lock:
+                metric = self.__gauges.setdefault(name, Gauge())
+        return metric
+
+    def histogram(self, name: str, bounds: Tuple[float, ...] = LATENCY_MS) -> Histogram:
+        metric = self.__histograms.get(name)
+        if metric is None:
+            with self.__lock:
+                metric = self.__histograms.setdefault(name, Histogram(bounds))
+        return metric
+
+    def read_gauge(self, name: str, reader: Callable[[], float]):
+        """ A gauge that is read when the batch is taken, for values a component already keeps (e.g. a queue length).
+        A reader that returns None is left out of the batch """
+        self.__add_reader(self.__gauge_readers, name, reader)
+
+    def read_counter(self, name: str, reader: Callable[[], int]):
+        """ A counter that is read when the batch is taken, for counts a component already keeps """
+        self.__add_reader(self.__counter_readers, name, reader)
+
+    def remove_reader(self, name: str, reader: Callable[[], float]):
+        """ Stops reading the gauge or counter, if it's still read by this reader and not one that has replaced it """
+        with self.__lock:
+            for readers in (self.__gauge_readers, self.__counter_readers):
+                if readers.get(name) is reader:
+                    del readers[name]
+
+    def batch(self, all_bounds: bool = False) -> dict:
+        """Takes the batch to export and starts the next interval for the histograms
+
+        Args:
+            all_bounds (bool, optional): Send the bucket bounds of every histogram again, e.g. with the first batch of a new
+                connection. Defaults to False, only the bounds of histograms that haven't been in a batch yet are sent.
+
+        Returns:
+            dict: {"t": unix time, "c": {counter: total}, "g": {gauge: value}, "h": {histogram: [count, sum, [counts per bucket]]}},
+                plus "b": {histogram: bucket bounds} when there are bounds to send. Empty histograms are left out
+        """
+        with self.__lock:
+            counters = {name: counter.value for name, counter in self.__counters.items()}
+            gauges = {name: gauge.value for name, gauge in self.__gauges.items()}
+            for values, readers in ((counters, self.__counter_readers), (gauges, self.__gauge_readers)):
+                for name, reader in readers.items():
+                    try:
+                        value = reader()
+                    except Exception as e:
+                        print(f"TELEMETRY: Reading '{name}' failed: {e}")
+                        continue
+                    if value is not None:
+                        values[name] = value
+
+            if all_bounds:
+                self.__bounds_sent.clear()
+            histograms, bounds = {}, {}
+            for name, histogram in self.__histograms.items():
+                taken = histogram.take()
+                if taken is not None:
+                    histograms[name] = taken
+                    if name not in self.__bounds_sent:
+                        bounds[name] = histogram.bounds
+                        self.__bounds_sent.add(name)
+
+            self.batches += 1
+            batch = {"t": int(time()), "c": counters, "g": gauges, "h": histograms}
+            if bounds:
+                batch["b"] = bounds
+            return batch
+
+    def __add_reader(self, readers: Dict[str, Callable], name: str, reader: Callable):
+        with self.__lock:
+            if readers.get(name) not in (None, reader):
+                print(f"TELEMETRY: '{name}' is read by a new reader, the old one is dropped")
+            readers[name] = reader
+
+    def names(self) -> List[str]:
+        with self.__lock:
+            return sorted(list(self.__counters) + list(self.__counter_readers) + list(self.__gauges) + list(self.__gauge_readers)
+                          + list(self.__histograms))
+
+
+_shared: Telemetry = None
+_shared_lock = Lock()
+
+
+def telemetry() -> Telemetry:
+    """ The registry every component of the room records to """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Telemetry()
+        return _shared
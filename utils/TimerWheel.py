@@ -0,0 +1,296 @@
+from queue import SimpleQueue
+from random import uniform
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import Callable, List
+
+import math
+
+from .Telemetry import telemetry
+
+
+class TimerHandle(object):
+    """ A timer on the wheel, cancel it if it shouldn't fire (anymore) """
+    __slots__ = ("due", "tick", "interval", "jitter", "fn", "args", "name", "offload", "cancelled", "__wheel")
+
+    def __init__(self, wheel: "TimerWheel", due: float, interval: float, jitter: float, fn: Callable, args: tuple, name: str,
+                 offload: bool):
+        self.due = due
+        self.tick = 0
+        self.interval = interval
+        self.jitter = jitter
+        self.fn = fn
+        self.args = args
+        self.name = name
+        self.offload = offload
+        self.cancelled = False
+        self.__wheel = wheel
+
+    def cancel(self):
+        """ Stops the timer, an interval timer won't fire again either """
+        self.cancelled = True
+
+    def remaining(self) -> float:
+        """ Seconds until it fires, 0 if it's due or cancelled """
+        return 0.0 if self.cancelled else max(0.0, self.due - self.__wheel.clock())
+
+    def is_active(self) -> bool:
+        return not self.cancelled and (self.interval is not None or self.remaining() > 0)
+
+    def __repr__(self) -> str:
+        kind = f"every {self.interval}s" if self.interval is not None else "once"
+        return f"<timer '{self.name}' {kind}, due in {self.remaining():.2f}s{' (cancelled)' if self.cancelled else ''}>"
+
+
+class TimerWheel(object):
+    """ All the timers of the room on one hierarchical timing wheel, run by one thread on a monotonic clock.
+
+    Level 0 has a slot per tick (10 ms), the levels above it cover 64 times the range of the level below and are
+    cascaded down as time passes, so adding and cancelling a timer is O(1) whatever its delay. The thread only wakes
+    up for a slot that has timers or to cascade, not on every tick.
+    Callbacks run on the wheel thread and should be quick, pass 'offload' for anything that may block (e.g. connecting)
+    so it runs on the wheel's worker thread instead.
+
+    With an injected clock the wheel can also be driven by hand (run_due) without starting the thread, e.g. in a simulation.
+    Then every callback runs on the caller of run_due, offloaded or not, in the order they were due
+    """
+
+    LEVEL_BITS = (8, 6, 6, 6)
+
+    def __init__(self, resolution: float = 0.01, clock: Callable[[], float] = monotonic):
+        """Creates the wheel, call start to run it on its own thread
+
+        Args:
+            resolution (float, optional): Seconds per tick, timers fire at most this late. Defaults to 0.01.
+            clock (Callable[[], float], optional): Monotonic time in seconds. Defaults to time.monotonic.
+        """
+        self.resolution = resolution
+        self.clock = clock
+
+        self.__origin = clock()
+        self.__tick = 0
+        self.__levels: List[List[List[TimerHandle]]] = [[[] for _ in range(1 << bits)] for bits in TimerWheel.LEVEL_BITS]
+        self.__overflow: List[TimerHandle] = []
+        self.__expired: List[TimerHandle] = []
+        self.__count = 0
+
+        self.__condition = Condition(Lock())
+        self.__thread: Thread = None
+        self.__worker: Thread = None
+        self.__work = SimpleQueue()
+        self.__running = False
+
+        self.fired = 0
+        self.max_late = 0.0
+        self.__late_ms = telemetry().histogram("timer.late_ms")
+
+    def call_later(self, delay: float, fn: Callable, *args, name: str = None, jitter: float = 0.0, offload: bool = False) -> TimerHandle:
+        """Runs the callback once after 'delay' seconds
+
+        Args:
+            delay (float): Seconds from now
+            fn (Callable): The callback
+            name (str, optional): Shown when the timers are listed. Defaults to the callback's name.
+            jitter (float, optional): The delay is moved by up to this many seconds either way. Defaults to 0.0.
+            offload (bool, optional): Run it on the worker thread, for callbacks that may block. Defaults to False.
+        """
+        return self.__add(delay, None, jitter, fn, args, name, offload)
+
+    def call_every(self, interval: float, fn: Callable, *args, name: str = None, jitter: float = 0.0, offload: bool = False,
+                   first_delay: float = None) -> TimerHandle:
+        """Runs the callback every 'interval' seconds until the handle is cancelled, the first time after one interval
+
+        Args:
+            interval (float): Seconds between the runs, the runs don't drift with the time the callback takes
+            jitter (float, optional): Every run is moved by up to this many seconds either way, so rooms don't all
+                send at the same time. Defaults to 0.0.
+            first_delay (float, optional): Delay of the first run instead of one interval. Defaults to None.
+        """
+        return self.__add(interval if first_delay is None else first_delay, interval, jitter, fn, args, name, offload)
+
+    def start(self) -> "TimerWheel":
+        with self.__condition:
+            if not self.__running:
+                self.__running = True
+                self.__thread = Thread(target=self.__run, name="TimerWheel", daemon=True)
+                self.__thread.start()
+        return self
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        self.__work.put(None)
+
+    def run_due(self, now: float = None):
+        """ Fires every timer that is due at 'now' (defaults to the clock), what the wheel thread does when it wakes up """
+        now = self.clock() if now is None else now
+        with self.__condition:
+            due = self.__collect(now)
+        self.__fire(due, now)
+
+    def timers(self) -> List[TimerHandle]:
+        """ Every timer that is waiting, soonest first """
+        with self.__condition:
+            handles = [h for level in self.__levels for slot in level for h in slot] + self.__overflow + self.__expired
+        return sorted([h for h in handles if not h.cancelled], key=lambda h: h.due)
+
+    def stats(self) -> dict:
+        return {"timers": len(self.timers()), "fired": self.fired, "max_late_ms": round(self.max_late * 1000, 1),
+                "threads": int(self.__thread is not None) + int(self.__worker is not None)}
+
+    def __add(self, delay: float, interval: float, jitter: float, fn: Callable, args: tuple, name: str, offload: bool) -> TimerHandle:
+        handle = TimerHandle(self, 0.0, interval, jitter, fn, args, name if name is not None else getattr(fn, "__name__", str(fn)), offload)
+        with self.__condition:
+            handle.due = self.clock() + max(0.0, delay + (uniform(-jitter, jitter) if jitter else 0.0))
+            self.__insert(handle)
+            self.__condition.notify()
+        return handle
+
+    # Everything below expects the condition to be held, except for firing the callbacks
+
+    def __insert(self, handle: TimerHandle):
+        handle.tick = math.ceil((handle.due - self.__origin) / self.resolution)
+        delta = handle.tick - self.__tick
+        self.__count += 1
+
+        if delta <= 0:
+            self.__expired.append(handle)
+            return
+
+        shift = 0
+        for level, bits in enumerate(TimerWheel.LEVEL_BITS):
+            if delta < 1 << (shift + bits):
+                self.__levels[level][(handle.tick >> shift) & ((1 << bits) - 1)].append(handle)
+                return
+            shift += bits
+        self.__overflow.append(handle)
+
+    def __collect(self, now: float) -> List[TimerHandle]:
+        due, self.__expired = self.__expired, []
+        target = math.floor((now - self.__origin) / self.resolution)
+
+        while self.__tick < target:
+            self.__tick += 1
+            self.__cascade()
+            slot = self.__levels[0][self.__tick & ((1 << TimerWheel.LEVEL_BITS[0]) - 1)]
+            if slot:
+                due += slot
+                slot.clear()
+
+        self.__count -= len(due)
+        return [h for h in due if not h.cancelled]
+
+    def __cascade(self):
+        """ Moves the timers of the next slot of a higher level down when a lower level wraps around """
+        shift = 0
+        for level, bits in enumerate(TimerWheel.LEVEL_BITS):
+            if (self.__tick >> shift) & ((1 << bits) - 1) != 0:
+                return
+            shift += bits
+            if level + 1 < len(TimerWheel.LEVEL_BITS):
+                slot = self.__levels[level + 1][(self.__tick >> shift) & ((1 << TimerWheel.LEVEL_BITS[level + 1]) - 1)]
+            else:
+                slot = self.__overflow
+            handles = slot[:]
+            slot.clear()
+            self.__count -= len(handles)
+            for handle in handles:
+                if not handle.cancelled:
+                    self.__insert(handle)
+
+    def __fire(self, due: List[TimerHandle], now: float):
+        for handle in due:
+            if handle.cancelled:
+                continue
+            self.fired += 1
+            self.max_late = max(self.max_late, now - handle.due)
+            self.__late_ms.observe((now - handle.due) * 1000)
+
+            if handle.interval is not None:
+                # The next run is counted from when this one was due, so the interval doesn't drift
+                handle.due = max(handle.due + handle.interval, now) + (uniform(-handle.jitter, handle.jitter) if handle.jitter else 0.0)
+                with self.__condition:
+                    self.__insert(handle)
+
+            if handle.offload and self.__thread is not None:
+                self.__offload(handle)
+            else:
+                TimerWheel.__call(handle)
+
+    @staticmethod
+    def __call(handle: TimerHandle):
+        try:
+            handle.fn(*handle.args)
+        except Exception as e:
+            print(f"TIMER: '{handle.name}' failed: {e}")
+
+    def __offload(self, handle: TimerHandle):
+        if self.__worker is None:
+            self.__worker = Thread(target=self.__work_loop, name="TimerWheelWorker", daemon=True)
+            self.__worker.start()
+        self.__work.put(handle)
+
+    def __work_loop(self):
+        while True:
+            handle = self.__work.get()
+            if handle is None:
+                return
+            if not handle.cancelled:
+                TimerWheel.__call(handle)
+
+    def __next_wakeup(self) -> float:
+        """ Seconds until the next slot with timers on level 0, or until level 0 wraps and has to be cascaded """
+        if self.__expired:
+            return 0.0
+        if self.__count == 0:
+            return None
+
+        size = 1 << TimerWheel.LEVEL_BITS[0]
+        ticks = size - (self.__tick & (size - 1))
+        for step in range(1, ticks):
+            if self.__levels[0][(self.__tick + step) & (size - 1)]:
+                ticks = step
+                break
+        return max(0.0, self.__origin + (self.__tick + ticks) * self.resolution - self.clock())
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                if not self.__running:
+                    return
+                now = self.clock()
+                due = self.__collect(now)
+                if not due:
+                    self.__condition.wait(self.__next_wakeup())
+                    continue
+            self.__fire(due, now)
+
+
+_shared: TimerWheel = None
+_shared_lock = Lock()
+
+
+def shared_wheel() -> TimerWheel:
+    """ The wheel every component of the room puts its timers on, started on first use """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = TimerWheel().start()
+        return _shared
+
+
+if __name__ == "__main__":
+    # What the room's timers look like on the wheel, and how late they fire
+    from time import sleep
+
+    wheel = shared_wheel()
+    fired = []
+    wheel.call_every(0.2, lambda: fired.append("ping"), name="ping", jitter=0.05)
+    wheel.call_later(0.5, lambda: fired.append("door"), name="door timeout")
+    wheel.call_later(300, lambda: None, name="game timer")
+    wheel.call_later(4000, lambda: None, name="far away")
+    print("TIMER: " + "\n       ".join(repr(t) for t in wheel.timers()))
+    sleep(1.05)
+    print(f"TIMER: Fired {fired}")
+    print(f"TIMER: {wheel.stats()}")
@@ -0,0 +1,312 @@
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+from typing import Callable, Dict, Iterator, List
+
+import os
+import struct
+
+
+class TrafficRecord(object):
+    __slots__ = ("direction", "time", "topic", "payload")
+
+    def __init__(self, direction: int, time: float, topic: str, payload: bytes):
+        self.direction = direction
+        self.time = time
+        self.topic = topic
+        self.payload = payload
+
+
+class TrafficRecorder(object):
+    """ Every message the room receives and sends, in a compact binary log, so a busy evening can be replayed.
+
+    The file starts with 'RTRC', a version byte and the room's MAC (a length byte and the ascii). Each record is the
+    direction (0 in, 1 out), the monotonic time as a double, the topic's and the payload's length (16 and 32 bits,
+    little endian), then the topic and the payload as they were on the wire. A record is one unbuffered write, so a
+    crash loses at most the record it was writing. When the file grows past 'max_bytes' it's moved to '<path>.1' and a
+    new one is started, beginning with the last config so it can be replayed on its own
+    """
+
+    MAGIC = b"RTRC\x01"
+    RECORD = struct.Struct("<BdHI")
+    INBOUND = 0
+    OUTBOUND = 1
+
+    def __init__(self, path: str, mac: str, max_bytes: int = 4 * 1024 * 1024, clock: Callable[[], float] = monotonic):
+        """
+        Args:
+            path (str): The log file, appended to if it's there
+            mac (str): The room's MAC, for the header
+            max_bytes (int, optional): The file is rotated when it grows past this. Defaults to 4 MB.
+            clock (Callable[[], float], optional): Monotonic time in seconds. Defaults to time.monotonic.
+        """
+        self.path = path
+        self.mac = mac
+        self.max_bytes = max_bytes
+        self.clock = clock
+
+        self.__lock = Lock()
+        self.__file = None
+        self.__size = 0
+        self.__config: bytes = None
+
+        self.records = 0
+        self.rotations = 0
+
+    def inbound(self, topic: str, payload: bytes):
+        self.__write(self.__record(TrafficRecorder.INBOUND, topic, payload), config=topic.startswith("config/"))
+
+    def outbound(self, topic: str, payload):
+        self.__write(self.__record(TrafficRecorder.OUTBOUND, topic, payload.encode() if isinstance(payload, str) else payload))
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def stats(self) -> dict:
+        return {"records": self.records, "bytes": self.__size, "rotations": self.rotations}
+
+    def __record(self, direction: int, topic: str, payload: bytes) -> bytes:
+        topic = topic.encode()
+        return TrafficRecorder.RECORD.pack(direction, self.clock(), len(topic), len(payload)) + topic + payload
+
+    def __write(self, record: bytes, config: bool = False):
+        with self.__lock:
+            try:
+                if self.__file is None or self.__size + len(record) > self.max_bytes:
+                    # A new config that starts the file is the one it begins with, the saved one is stale
+                    self.__open(with_config=not config)
+                self.__file.write(record)
+                self.__size += len(record)
+                self.records += 1
+                if config:
+                    self.__config = record
+            except OSError as e:
+                # Recording is for later, it never gets in the way of the message
+                print(f"TRAFFIC: Recording the traffic failed: {e}")
+
+    def __open(self, with_config: bool):
+        if self.__file is not None:
+            self.__file.close()
+            os.replace(self.path, self.path + ".1")
+            self.rotations += 1
+        self.__file = open(self.path, "ab", buffering=0)
+        self.__size = self.__file.tell()
+        if self.__size == 0:
+            mac = self.mac.encode()
+            self.__file.write(TrafficRecorder.MAGIC + bytes([len(mac)]) + mac)
+            self.__size = self.__file.tell()
+            if self.__config is not None and with_config:
+                self.__file.write(self.__config)
+                self.__size += len(self.__config)
+                self.records += 1
+
+
+class TrafficLog(object):
+    """ Reads a log written by the TrafficRecorder, a record that was cut off by a crash ends it """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(len(TrafficRecorder.MAGIC) + 1)
+            if header[:len(TrafficRecorder.MAGIC)] != TrafficRecorder.MAGIC:
+                raise ValueError(f"{path} isn't a traffic log")
+            self.mac = f.read(header[-1]).decode()
+            self.__start = f.tell()
+
+    def __iter__(self) -> Iterator[TrafficRecord]:
+        size = TrafficRecorder.RECORD.size
+        with open(self.path, "rb") as f:
+            f.seek(self.__start)
+            while True:
+                head = f.read(size)
+                if len(head) < size:
+                    return
+                direction, time, topic_length, payload_length = TrafficRecorder.RECORD.unpack(head)
+                topic = f.read(topic_length)
+                payload = f.read(payload_length)
+                if len(topic) < topic_length or len(payload) < payload_length:
+                    return
+                yield TrafficRecord(direction, time, topic.decode(), payload)
+
+
+class ReplayClock(object):
+    """ The replay's time, set to where the log is so the room's timers fire when they did while it was recorded """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TrafficReplay(object):
+    """ Feeds what a room received back into a GameLogic, through the communicator's routing as if it came from the
+    broker, at the recorded pace, 'speed' times faster or as fast as possible (speed None).
+
+    The room's timers run on a wheel on the log's clock, so at any speed they fire between the same messages as they
+    did. Won and lost come from the game rather than a message. Where the log has the room report one, the replayed room
+    has to be in a state the game decides from (active), then the game's decision is replayed. If it isn't, the replay
+    has diverged from the recording: it's reported with the state the room was in, and the decision is left out.
+    The room is silent, not connected (the results it sends are spooled, the rest dropped) and starts waiting for its config
+    """
+
+    def __init__(self, paths: List[str], speed: float = 1.0):
+        self.logs = [TrafficLog(path) for path in paths]
+        self.speed = speed
+        self.clock = ReplayClock()
+
+        self.dispatch_seconds: List[float] = []
+        self.statuses_recorded: List[str] = []
+        self.statuses_replayed: List[str] = []
+        self.divergences: List[dict] = []
+        self.states: Dict[str, int] = {}
+
+    def run(self) -> dict:
+        self.clock.now = 0.0
+        for results in (self.dispatch_seconds, self.statuses_recorded, self.statuses_replayed, self.divergences):
+            results.clear()
+        self.states.clear()
+
+        # Imported here, the FSM imports the communicator which imports this module
+        from .FSM import GameLogic
+        from .Messages import ConfigMessage, MessageError
+        from .MqttMux import MuxMessage
+        from .NetworkIdentity import NetworkIdentity
+        from .RoomSimulator import SilentAudio
+        from .TimerWheel import TimerWheel
+
+        # The room has a wheel of its own on the log's clock, so replays can run one after the other in one process.
+        # What the replayed room sends isn't recorded, the statuses it sends are collected for the report
+        wheel = TimerWheel(clock=self.clock)
+        logic = GameLogic(lambda: None, lambda members, language: None, lambda: None, lambda event: None,
+                          audio_handler=SilentAudio(), network=NetworkIdentity(mac=self.logs[0].mac), wheel=wheel,
+                          record_traffic=False, on_room_status=lambda message, level: self.statuses_replayed.append(message))
+        communicator = logic.communicator
+        self.__decided_from = {t["source"] for t in GameLogic.transitions if t["trigger"] in ("game_won", "game_lost")}
+        logic.machine.set_state("get_config")
+
+        started = perf_counter()
+        first = None
+        try:
+            for log in self.logs:
+                for record in log:
+                    first = record.time if first is None else first
+                    self.__advance(wheel, max(self.clock.now, record.time - first))
+                    if record.direction == TrafficRecorder.OUTBOUND:
+                        if record.topic.endswith("/room_status"):
+                            self.__game_decision(logic, communicator, record.payload)
+                        continue
+                    if record.topic.startswith("probe/"):
+                        # The echoes measured the network, there is nothing in them for the room
+                        continue
+
+                    begun = perf_counter()
+                    if record.topic.startswith("config/"):
+                        try:
+                            communicator.on_config_received(ConfigMessage.from_dict(communicator.codec.decode(record.payload)))
+                        except (MessageError, ValueError, TypeError) as e:
+                            print(f"REPLAY: Skipping an invalid config: {e}")
+                    else:
+                        communicator.on_message_received(None, None, MuxMessage(record.topic, record.payload))
+                    self.dispatch_seconds.append(perf_counter() - begun)
+                    self.states[logic.state] = self.states.get(logic.state, 0) + 1
+        finally:
+            # The room is done with, it lets go of the Pi's network identity and its spool
+            logic.cleanup()
+            communicator.spool.close()
+
+        elapsed = perf_counter() - started
+        ordered = sorted(self.dispatch_seconds)
+
+        def percentile(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 3) if ordered else None
+
+        busy = sum(ordered)
+        return {"messages": len(ordered), "seconds": round(elapsed, 2), "log_seconds": round(self.clock.now, 1),
+                "messages_per_s": round(len(ordered) / busy) if busy else None, "p50_ms": percentile(0.5),
+                "p99_ms": percentile(0.99), "max_ms": round(ordered[-1] * 1000, 3) if ordered else None,
+                "rejected": communicator.router.rejected, "invalid": communicator.router.invalid, "final_state": logic.state,
+                "statuses_recorded": self.statuses_recorded, "statuses_replayed": self.statuses_replayed,
+                "divergences": self.divergences}
+
+    def __advance(self, wheel, target: float):
+        """ Moves the clock to the record, firing the timers on the way. In real time unless it's as fast as possible """
+        if self.speed is None:
+            self.clock.now = target
+            wheel.run_due()
+            return
+        while self.clock.now < target:
+            step = min(target - self.clock.now, wheel.resolution * self.speed)
+            sleep(step / self.speed)
+            self.clock.now += step
+            wheel.run_due()
+
+    def __game_decision(self, logic, communicator, payload: bytes):
+        """ Won and lost are decided by the game, not by a message. They are replayed from the statuses it sent, if the
+        replayed room is where the recorded one must have been """
+        try:
+            status = communicator.codec.decode(payload)
+        except (ValueError, TypeError):
+            return
+        self.statuses_recorded.append(status.get("status"))
+        if status.get("status") not in ("won", "lost"):
+            return
+        if logic.state not in self.__decided_from:
+            self.divergences.append({"t": round(self.clock.now, 3), "recorded": status.get("status"), "state": logic.state})
+            return
+        if status.get("status") == "won":
+            logic.room_won(status.get("level") or 1)
+        else:
+            logic.room_lost()
+
+
+if __name__ == "__main__":
+    # python -m utils.TrafficRecorder dump <log> ...                    prints the records
+    # python -m utils.TrafficRecorder replay [--speed N | --fast] <log> ...  replays them, oldest log ('.1') first
+    import argparse
+    import sys
+    import tempfile
+
+    from .storage import DATA_DIR_ENV
+
+    parser = argparse.ArgumentParser(prog="python -m utils.TrafficRecorder", description=TrafficRecorder.__doc__.split("\n")[0])
+    parser.add_argument("command", choices=("dump", "replay"))
+    parser.add_argument("logs", nargs="+")
+    parser.add_argument("--speed", type=float, default=1.0, help="times the recorded pace")
+    parser.add_argument("--fast", action="store_true", help="as fast as possible")
+    parser.add_argument("--verbose", action="store_true", help="show what the room logs while it's replayed")
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        for path in args.logs:
+            log = TrafficLog(path)
+            print(f"{path}: {log.mac}")
+            for record in log:
+                print(f"{record.time:12.3f} {'<-' if record.direction == TrafficRecorder.INBOUND else '->'} {record.topic} "
+                      f"{record.payload[:120]!r}")
+        sys.exit(0)
+
+    # The replayed room's spool and caches go to a directory of their own
+    os.environ.setdefault(DATA_DIR_ENV, tempfile.mkdtemp(prefix="room-replay-"))
+    replay = TrafficReplay(args.logs, None if args.fast else args.speed)
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        report = replay.run()
+    finally:
+        sys.stdout = out
+
+    print(f"REPLAY: {report['messages']} messages ({report['log_seconds']} s of traffic) in {report['seconds']} s, "
+          f"{report['rejected']} rejected, {report['invalid']} invalid, ended in '{report['final_state']}'")
+    print(f"REPLAY: Dispatch p50 {report['p50_ms']} ms, p99 {report['p99_ms']} ms, max {report['max_ms']} ms, "
+          f"{report['messages_per_s']} messages/s of processing")
+    print(f"REPLAY: Room statuses recorded {report['statuses_recorded']}")
+    print(f"REPLAY: Room statuses replayed {report['statuses_replayed']}")
+    for divergence in report["divergences"]:
+        print(f"REPLAY: Diverged at {divergence['t']} s, the room reported '{divergence['recorded']}' but the replayed "
+              f"room was in '{divergence['state']}'")
+    if not report["divergences"]:
+        print("REPLAY: No divergence from the recording")
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+from concurrent.futures import Future, InvalidStateError
+from enum import IntEnum
+from time import monotonic
+from typing import Callable, List
+
+from .lazy import lazy_import
+from .Telemetry import telemetry
+mixer = lazy_import("pygame.mixer")
+
+
+class VoicePriority(IntEnum):
+    """ Who wins when all voices are busy, a sound can only steal a voice from a sound with lower or equal priority """
+    AMBIENCE = 1
+    EFFECT = 2
+    ANNOUNCEMENT = 3
+
+
+class Voice(object):
+    """ Handle for a sound played through the VoicePool, use it to stop or query the sound.
+
+    'finished' is resolved when the mixer reports that the channel is done with the sound: True if it played to the end,
+    False if it was stopped, stolen or never got a voice. Cancel the future if you are no longer interested
+    """
+
+    def __init__(self, pool: "VoicePool", sound: mixer.Sound, priority: VoicePriority, tag: str = None):
+        self.sound = sound
+        self.priority = priority
+        self.tag = tag
+        self.channel: mixer.Channel = None
+        self.created = monotonic()
+        self.started: float = None
+        self.ended: float = None
+        self.stolen = False
+        self.stopped = False
+        self.finished = Future()
+
+        self.__pool = pool
+
+    def get_length(self) -> float:
+        return self.sound.get_length()
+
+    def stop(self):
+        """ Stops the sound, if it hasn't started yet it never will """
+        self.stopped = True
+        self.__pool.run(self.__pool.stop, self)
+
+    def is_playing(self) -> bool:
+        """ True while the sound is playing, False before it has started and after it has ended, stopped or been stolen """
+        return self.__pool.run(self.__pool.is_playing, self)
+
+    def add_done_callback(self, callback: Callable[[bool], None]):
+        """ Called with True when the sound has played to the end, False if it didn't, from the audio scheduler thread """
+        self.finished.add_done_callback(lambda f: None if f.cancelled() else callback(f.result()))
+
+    def _finish(self, played_to_end: bool):
+        self.ended = monotonic()
+        try:
+            self.finished.set_result(played_to_end)
+        except InvalidStateError:
+            # Cancelled by the owner of the handle
+            pass
+
+
+class VoicePool(object):
+    """ A pool of mixer channels that are handed out by priority.
+
+    Sounds mix on free channels, when all channels are busy the oldest sound with the lowest priority (not higher than the
+    new sound) is stolen. Not thread safe, every call is expected to come from the audio scheduler thread
+    """
+
+    def __init__(self, voices: int = 8, run: Callable = None):
+        """Creates the pool, call open once the mixer is initialised
+
+        Args:
+            voices (int, optional): Number of channels in the pool. Defaults to 8.
+            run (Callable, optional): Used by the Voice handles to run a pool method on the right thread. Defaults to calling it directly.
+        """
+        self.voices = voices
+        self.__channels = []
+        self.__owners: List[Voice] = [None] * voices
+        self.__active: List[Voice] = []
+        self.run = run if run is not None else (lambda fn, *args: fn(*args))
+
+        self.steals = 0
+        self.rejected = 0
+        self.peak_voices = 0
+        # From asking for the sound to the mixer playing it, what a player hears as lag
+        self.__trigger_ms = telemetry().histogram("audio.trigger_ms")
+
+    def open(self):
+        """ Reserves the channels in the mixer """
+        mixer.set_num_channels(self.voices)
+        self.__channels = [mixer.Channel(i) for i in range(self.voices)]
+
+    def create(self, sound: mixer.Sound, priority: VoicePriority, tag: str = None) -> Voice:
+        """ Creates the handle without playing it, use start to play it. Safe to call from any thread """
+        return Voice(self, sound, priority, tag)
+
+    def start(self, voice: Voice, volume: float = 1.0) -> bool:
+        """Plays the voice on a free channel or steals one
+
+        Args:
+            voice (Voice): The handle from create
+            volume (float, optional): The channel volume. Defaults to 1.0.
+
+        Returns:
+            bool: False if it was stopped before it started or no voice could be stolen
+        """
+        if voice.stopped:
+            voice._finish(False)
+            return False
+
+        index = self.__find_free()
+        if index is None:
+            index = self.__find_victim(voice.priority)
+            if index is None:
+                self.rejected += 1
+                print(f"AUDIO: No voice available for a sound with priority {voice.priority.name}")
+                voice._finish(False)
+                return False
+            self.__owners[index].stolen = True
+            self.steals += 1
+
+        channel = self.__channels[index]
+        channel.stop()
+        channel.set_volume(volume)
+        channel.play(voice.sound)
+
+        voice.channel = channel
+        voice.started = monotonic()
+        self.__trigger_ms.observe((voice.started - voice.created) * 1000)
+        self.__owners[index] = voice
+        self.__active.append(voice)
+
+        self.peak_voices = max(self.peak_voices, len(self.playing()))
+        return True
+
+    def stop(self, voice: Voice):
+        voice.stopped = True
+        if self.is_playing(voice):
+            voice.channel.stop()
+
+    def stop_tag(self, tag: str):
+        """ Stops every voice with the tag """
+        for voice in self.playing(tag):
+            self.stop(voice)
+
+    def stop_all(self):
+        for voice in self.playing():
+            self.stop(voice)
+
+    def check_finished(self) -> bool:
+        """Resolves 'finished' of every voice the mixer is done with, call it often (every scheduler tick)
+
+        Returns:
+            bool: True while there still are voices playing that have to be checked
+        """
+        for voice in [v for v in self.__active if not self.is_playing(v)]:
+            self.__active.remove(voice)
+            voice._finish(not (voice.stopped or voice.stolen))
+        return len(self.__active) > 0
+
+    def is_playing(self, voice: Voice) -> bool:
+        if voice.channel is None or voice.stolen:
+            return False
+        index = self.__channels.index(voice.channel)
+        return self.__owners[index] is voice and voice.channel.get_busy()
+
+    def playing(self, tag: str = None) -> List[Voice]:
+        """ The voices that are playing right now, optionally only the ones with the tag """
+        return [v for i, v in enumerate(self.__owners)
+                if v is not None and self.__channels[i].get_busy() and (tag is None or v.tag == tag)]
+
+    def stats(self) -> dict:
+        return {"voices": self.voices, "playing": len(self.playing()), "peak_voices": self.peak_voices,
+                "steals": self.steals, "rejected": self.rejected}
+
+    def __find_free(self) -> int:
+        for i, channel in enumerate(self.__channels):
+            if not channel.get_busy():
+                return i
+        return None
+
+    def __find_victim(self, priority: VoicePriority) -> int:
+        """ The oldest voice among the ones with the lowest priority, as long as it isn't higher than ours """
+        victim = None
+        for i, voice in enumerate(self.__owners):
+            if voice is None or voice.priority > priority:
+                continue
+            if victim is None or (voice.priority, voice.started) < (self.__owners[victim].priority, self.__owners[victim].started):
+                victim = i
+        return victim
@@ -0,0 +1,30 @@
+from importlib import import_module
+
+
+class LazyModule(object):
+    """ Stands in for a module and imports it the first time one of its attributes is used.
+
+    Keeps heavy libraries (pygame, paho, zeroconf ...) out of the import time of the utils
+    """
+
+    def __init__(self, name: str):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attribute: str):
+        if self.__module is None:
+            self.__module = import_module(self.__name)
+        return getattr(self.__module, attribute)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__module is not None else "not loaded"
+        return f"<lazy module '{self.__name}' ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """Returns a stand-in for the module that is imported on first use
+
+    Args:
+        name (str): The full module name, e.g. 'pygame.mixer'
+    """
+    return LazyModule(name)
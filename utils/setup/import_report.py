@@ -0,0 +1,47 @@
+""" Import time report for the room utils, run it from the room's root folder:
+
+`python3 utils/setup/import_report.py [module ...]`
+
+Every module is imported in a fresh interpreter with `python -X importtime`, the median of a few runs is reported
+together with the heaviest imports, so it's easy to spot when something heavy sneaks back into the import path
+"""
+import subprocess
+import sys
+from statistics import median
+
+RUNS = 5
+TOP = 10
+
+
+def import_times(module: str) -> dict:
+    """ Returns the cumulative import time in microseconds per imported package, from one fresh interpreter """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def report(module: str):
+    runs = [import_times(module) for _ in range(RUNS)]
+    total = median(run[module] for run in runs)
+    print(f"{module}: {total / 1000:.1f} ms (median of {RUNS} runs)")
+
+    heaviest = sorted(runs[0].items(), key=lambda item: item[1], reverse=True)
+    for name, cumulative in [item for item in heaviest if item[0] != module][:TOP]:
+        print(f"    {cumulative / 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    for module in sys.argv[1:] or ["utils.FSM", "utils.GameLogic", "utils.ServerCommunicator", "utils.AudioHandler"]:
+        try:
+            report(module)
+        except RuntimeError as e:
+            print(f"{module}: failed to import - {e}")
@@ -23,7 +23,7 @@ if [ "$os_version" == "bullseye" ]; then
     sudo python3 -m pip install -r requirements.txt
 elif [ "$os_version" == "bookworm" ]; then
     echo "This system is running Bookworm."
-    sudo apt-get install -y python3-paho-mqtt python3-netifaces python3-apscheduler python3-zeroconf python3-pygame python3-transitions
+    sudo apt-get install -y python3-paho-mqtt python3-netifaces python3-zeroconf python3-pygame python3-transitions
 else
     echo "Unknown version: $os_version"
     exit 1
@@ -37,18 +37,54 @@ git config --global user.email "mazdak.farzone@gmail.com"
 #sudo systemctl enable pigpiod
 #sudo systemctl start pigpiod
 
+echo "Transcoding audio assets to PCM ..."
+(cd ../.. && python3 -m utils.AssetCache)
+
+echo "Calibrating the audio buffer ..."
+(cd ../.. && python3 -m utils.AudioCalibration)
+
+# Extract the parent folder name dynamically
+parent_folder=$(basename "$(dirname "$(dirname "$(pwd)")")")
+
+echo "Setting up the MQTT multiplexer ..."
+# Holds the Pi's one connection to the server, the game and the shutdown/reboot logic attach to it
+sudo tee /etc/systemd/system/room-mqtt.service > /dev/null <<EOL
+[Unit]
+Description=Teamification Room MQTT Multiplexer
+After=network.target
+
+[Service]
+Type=simple
+User=uh
+Group=uh
+# The socket lives in /run/room-mqtt, only uh (the game) and root (the system handler) can reach it
+RuntimeDirectory=room-mqtt
+RuntimeDirectoryMode=0750
+UMask=0007
+WorkingDirectory=/home/uh/$parent_folder
+ExecStart=/usr/bin/python3 -m utils.MqttMux
+Restart=always
+
+[Install]
+WantedBy=default.target
+EOL
+sudo systemctl daemon-reload
+sudo systemctl enable room-mqtt.service
+sudo systemctl start room-mqtt.service
+
 echo "Setting up shutdown/reboot logic ..."
+# Only the modules the handler imports, not the game
+rm -rf $HOME/system-handler/utils
 mkdir -p $HOME/system-handler/utils
-cp ../constants.py ../ServerCommunicator.py $HOME/system-handler/utils
+for module in __init__ MqttMux Codec Messages TimerWheel Telemetry NetworkIdentity ReconnectBackoff constants lazy; do
+    cp ../$module.py $HOME/system-handler/utils/
+done
 cp systemhandler.py $HOME/system-handler/
 sudo cp system-condition.service /etc/systemd/system/
 sudo systemctl daemon-reload
 sudo systemctl enable system-condition.service
 sudo systemctl start system-condition.service
 
-# Extract the parent folder name dynamically
-parent_folder=$(basename "$(dirname "$(dirname "$(pwd)")")")
-
 echo "Setting up game autostart logic ..."
 mkdir -p $HOME/.config/autostart
 cat <<EOL > $HOME/.config/autostart/game.desktop
@@ -1,48 +1,76 @@
-# We need to have the utils subdir for the relative paths to work in e.g. Servercommunicator
-from utils.ServerCommunicator import ServerFinder, ServerCommunicator
+# We need to have the utils subdir for the relative paths to work in e.g. MqttMux
+from utils.MqttMux import MuxClient, MQTT_ERR_SUCCESS
+from utils.Codec import MsgpackCodec, codec_for
+from utils.Messages import ConfigMessage, MessageError, SetStatusMessage
+from utils.TimerWheel import shared_wheel, TimerHandle
 from utils.constants import Topics, RoomStatus
+from time import sleep
+import json
 import os
-from signal import pause
-from threading import Timer
 
 
 class SystemConditionLogic:
-    """Handles shutdown and reboot logic by connecting separately to the mqtt server\n
+    """Handles shutdown and reboot logic by listening to the room's set_status topic\n
     The MQTT server sends a REBOOT or a SHUTDOWN request and this service will handle it. This is done circumvent locks in the game making reboots/shutdowns hard to do.
-    \nThis service will connect to the MQTT server as a "spy" to avoid updating any health monitoring metrics in the server
+    \nThis service attaches to the room's MQTT multiplexer (utils/MqttMux.py) which holds the Pi's one connection to the server, so it
+    doesn't show up in the server's health monitoring and needs no server search or connection of its own
     """
 
+    retry_delay = 5
+    """ Seconds between the attempts to attach while the multiplexer isn't running """
+
     def __init__(self):
-        self.communicator = ServerCommunicator(
-            self.__server_connected, self.__server_lost, self.__server_config_recieved, self.__server_message_recieved, True)
-        self.finder = ServerFinder(self.__server_found)
-        self.finder.search()
+        self.client = MuxClient(client_id="system-handler")
+        self.client.on_connect = self.__server_connected
+        self.client.on_disconnect = self.__server_lost
+        self.client.on_message = self.__server_message_recieved
+        # Decodes json as well, whatever the room has negotiated arrives here
+        self.codec = codec_for(MsgpackCodec.content_type)
+        self.room: str = None
 
         # Shutdown / Reboot - delay
         self.delay_in_seconds = 3
-        self.timer: Timer = None
+        self.timer: TimerHandle = None
 
-    def __server_found(self, addr, port):
-        print("SHUTDOWN-LOGIC: Server found!, connecting ...")
-        self.communicator.connect(addr, port)
+    def run(self):
+        while True:
+            if self.client.socket() is None:
+                try:
+                    self.client.connect()
+                except OSError as e:
+                    print(f"SHUTDOWN-LOGIC: No multiplexer ({e}), trying again in {self.retry_delay} s")
+                    sleep(self.retry_delay)
+                    continue
+            self.client.loop(1.0)
 
-    def __server_connected(self):
+    def __server_connected(self, client: MuxClient, userdata, flags, rc):
+        if rc != MQTT_ERR_SUCCESS:
+            return
         print("SHUTDOWN-LOGIC: Connected!")
-        self.communicator.send_config_request()
+        mac = client.identity["mac"]
+        # The room's config requests are answered here too, one of our own covers the case that the room has its config already
+        client.subscribe("config/" + mac + "/recieve", qos=1)
+        message = {"mac": mac, "type": "room", "ip": client.identity["ip"], "hostname": client.identity["hostname"], "spy": True}
+        client.publish("config/" + mac + "/request", json.dumps(message), qos=0)
+        self.room = None
 
-    def __server_lost(self):
+    def __server_lost(self, client: MuxClient, userdata, rc):
         print("SHUTDOWN-LOGIC: Lost server")
 
-        # Search for it again ...
-        self.finder.search()
-
-    def __server_config_recieved(self, recieved: bool, config: dict):
-        if recieved:
-            print("SHUTDOWN-LOGIC: Now armed and active!")
-        else:
-            print("SHUTDOWN-LOGIC: Room removed, sending config request again!")
-            self.communicator.send_config_request()
+    def __server_config_recieved(self, config: ConfigMessage):
+        room = str(config.room)
+        if room == self.room:
+            return
+        if self.room is not None:
+            self.client.unsubscribe("room/" + self.room + "/" + Topics.SET_STATUS.value)
 
+        if room == 'removed':
+            print("SHUTDOWN-LOGIC: Room removed, waiting for a new config!")
+            self.room = None
+            return
+        self.room = room
+        self.client.subscribe("room/" + self.room + "/" + Topics.SET_STATUS.value, qos=1)
+        print("SHUTDOWN-LOGIC: Now armed and active!")
 
     def shutdown_system(self):
         """ Shut down the raspberry pi by running the shutdown script """
@@ -53,18 +81,24 @@ class SystemConditionLogic:
         # Is run as root from the systemd service, only way possible
         os.system("reboot")
 
-    def __server_message_recieved(self, topic: str, message: str):
-        if Topics.SET_STATUS.value in topic:
-            msg = message['access']
+    def __server_message_recieved(self, client: MuxClient, userdata, msg):
+        try:
+            if msg.topic.startswith("config/"):
+                self.__server_config_recieved(ConfigMessage.from_dict(self.codec.decode(msg.payload)))
+            elif msg.topic.endswith(Topics.SET_STATUS.value):
+                self.__set_status(SetStatusMessage.from_dict(self.codec.decode(msg.payload)))
+        except (MessageError, ValueError) as e:
+            print(f"SHUTDOWN-LOGIC: Ignoring a message on '{msg.topic}': {e}")
+
+    def __set_status(self, message: SetStatusMessage):
+        msg = message['access']
+
+        if msg == RoomStatus.REBOOT.value:
+            self.timer = shared_wheel().call_later(self.delay_in_seconds, self.reboot_system, name="reboot", offload=True)
+        elif msg == RoomStatus.SHUTDOWN.value:
+            self.timer = shared_wheel().call_later(self.delay_in_seconds, self.shutdown_system, name="shutdown", offload=True)
 
-            if msg == RoomStatus.REBOOT.value:
-                self.timer = Timer(self.delay_in_seconds, self.reboot_system)
-                self.timer.start()
-            elif msg == RoomStatus.SHUTDOWN.value:
-                self.timer = Timer(self.delay_in_seconds, self.shutdown_system)
-                self.timer.start()
-                
 
 if __name__ == "__main__":
     logic = SystemConditionLogic()
-    pause()
+    logic.run()
@@ -0,0 +1,41 @@
+import json
+import os
+import threading
+
+DATA_DIR_ENV = "ROOM_UTILS_DATA"
+""" Set the environment variable to keep the room's local files somewhere else """
+
+
+def data_path(*parts: str) -> str:
+    """Returns a path in the room's local data directory (~/.local/share/room-utils), creating the parent directories
+
+    Args:
+        parts (str): Path components below the data directory
+
+    Returns:
+        str: The absolute path
+    """
+    root = os.environ.get(DATA_DIR_ENV, os.path.join(os.path.expanduser("~"), ".local", "share", "room-utils"))
+    path = os.path.join(root, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def read_json(path: str, default=None):
+    """ Reads a json file, returns 'default' if it's missing or broken """
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path: str, data):
+    """ Writes the json file atomically, a power cut leaves either the old or the new file """
+    # A temporary file per thread, several writers (e.g. the simulator's rooms) can save the same file at once
+    tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
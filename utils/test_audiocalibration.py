@@ -0,0 +1,60 @@
+import pytest
+
+from utils.AudioCalibration import DEFAULT_BUFFER, AudioCalibration, save_profile, saved_buffer
+
+pytest.importorskip("pygame")
+
+
+@pytest.fixture(autouse=True)
+def dummy_driver(tmp_path, monkeypatch):
+    monkeypatch.setenv("SDL_AUDIODRIVER", "dummy")
+    monkeypatch.setenv("ROOM_UTILS_DATA", str(tmp_path))
+
+
+def stable_from(calibration: AudioCalibration, monkeypatch, stable: set):
+    """ Stands in for the measurement, only the buffer sizes in 'stable' play without underruns """
+    monkeypatch.setattr(calibration, "measure", lambda buffer: {"buffer": buffer, "latency_ms": 1.0, "worst_ms": 1.0,
+                                                                "underruns": 0 if buffer in stable else 3,
+                                                                "stable": buffer in stable})
+
+
+def test_measure_plays_the_clicks_with_the_dummy_driver():
+    result = AudioCalibration(trials=3).measure(512)
+
+    assert set(result) == {"buffer", "latency_ms", "worst_ms", "underruns", "stable"}
+    assert result["buffer"] == 512
+    assert 0 < result["latency_ms"] <= result["worst_ms"]
+    assert result["stable"] == (result["underruns"] == 0)
+
+
+def test_run_picks_a_buffer_size_that_was_measured():
+    profile = AudioCalibration([4096, 512], trials=3).run()
+
+    assert profile["buffer"] in (512, 4096)
+    assert [r["buffer"] for r in profile["results"]] == [512, 4096]
+    assert profile["driver"] == "dummy"
+
+
+def test_the_smallest_stable_buffer_is_picked(monkeypatch):
+    calibration = AudioCalibration([256, 512, 1024, 2048])
+    stable_from(calibration, monkeypatch, {1024, 2048})
+
+    assert calibration.run()["buffer"] == 1024
+
+
+def test_without_a_stable_buffer_the_default_is_used(monkeypatch):
+    calibration = AudioCalibration([256, 512])
+    stable_from(calibration, monkeypatch, set())
+
+    assert calibration.run()["buffer"] == DEFAULT_BUFFER
+
+
+def test_the_saved_buffer_only_applies_to_the_driver_it_was_made_with(monkeypatch):
+    assert saved_buffer() == DEFAULT_BUFFER
+
+    save_profile({"buffer": 512, "driver": "dummy"})
+    assert saved_buffer() == 512
+
+    monkeypatch.setenv("SDL_AUDIODRIVER", "alsa")
+    assert saved_buffer() == DEFAULT_BUFFER
+    assert saved_buffer(default=1024) == 1024
@@ -0,0 +1,71 @@
+import pytest
+
+from utils.Codec import JsonCodec, codec_for
+from utils.Messages import (ConfigMessage, DoorStatusMessage, MessageError, RoomStatusMessage, ScanResultMessage,
+                            SetStatusMessage)
+
+
+def test_fields_read_like_the_decoded_dict():
+    message = RoomStatusMessage.from_dict({"status": "won", "room": 3, "extra": "ignored"})
+
+    assert message["status"] == "won" and message.room == 3
+    assert "room" in message and "level" not in message
+    assert message.get("level", 0) == 0
+    assert message.to_dict() == {"status": "won", "room": 3}
+    with pytest.raises(KeyError):
+        message["extra"]
+
+
+@pytest.mark.parametrize("data", [None, [], "active", {}, {"info": 1}, {"info": True}])
+def test_missing_or_mistyped_fields_are_rejected(data):
+    with pytest.raises(MessageError):
+        DoorStatusMessage.from_dict(data)
+
+
+def test_message_errors_are_value_errors():
+    assert issubclass(MessageError, ValueError)
+
+
+def test_bool_only_passes_where_it_is_allowed():
+    assert ConfigMessage.from_dict({"room": "3", "points": [1], "isRoomSpy": True}).isRoomSpy is True
+    with pytest.raises(MessageError):
+        ScanResultMessage.from_dict({"access": "success", "members": True, "lang": "English"})
+
+
+def test_set_status_reasons():
+    assert SetStatusMessage.from_dict({"access": "reset"}).reason is None
+    assert SetStatusMessage.from_dict({"access": "stop", "reason": 1}).reason == 1
+
+    with pytest.raises(MessageError):
+        SetStatusMessage.from_dict({"access": "stop"})
+    with pytest.raises(MessageError):
+        SetStatusMessage.from_dict({"access": "stop", "reason": 99})
+
+
+def test_a_granted_scan_needs_members_and_a_known_language():
+    assert ScanResultMessage.from_dict({"access": "denied"}).members is None
+    assert ScanResultMessage.from_dict({"access": "success", "members": 4, "lang": "Swedish"}).members == 4
+
+    with pytest.raises(MessageError):
+        ScanResultMessage.from_dict({"access": "success", "lang": "Swedish"})
+    with pytest.raises(MessageError):
+        ScanResultMessage.from_dict({"access": "success", "members": 4, "lang": "Klingon"})
+
+
+def test_config_checks():
+    assert ConfigMessage.from_dict({"room": "removed"}).points is None
+    assert ConfigMessage.from_dict({"room": "3", "points": [1], "roomType": "competitive", "otherRoomNbr": 4})
+
+    with pytest.raises(MessageError):
+        ConfigMessage.from_dict({"room": "3"})
+    with pytest.raises(MessageError):
+        ConfigMessage.from_dict({"room": "3", "points": [1], "roomType": "solo", "otherRoomNbr": 4})
+    with pytest.raises(MessageError):
+        ConfigMessage.from_dict({"room": "3", "points": [1], "roomType": "cooperative"})
+
+
+def test_codecs_round_trip_and_unknown_types_fall_back_to_json():
+    message = {"status": "won", "room": "3", "level": 2}
+    for codec in (JsonCodec(), codec_for("application/json"), codec_for("application/x-unknown")):
+        assert codec.decode(codec.encode(message)) == message
+    assert codec_for("application/x-unknown").content_type == JsonCodec.content_type
@@ -0,0 +1,115 @@
+import pytest
+
+from utils.MusicDucker import DuckEnvelope, MusicDucker
+
+
+@pytest.fixture
+def volumes():
+    return []
+
+
+@pytest.fixture
+def ducker(clock, volumes):
+    return MusicDucker(DuckEnvelope(attack_seconds=0.1, release_seconds=0.5), set_volume=volumes.append, clock=clock)
+
+
+def ramp(ducker: MusicDucker, clock, step: float = 0.002, limit: int = 10000):
+    """ Ticks like the audio scheduler does until the ramp is done """
+    for _ in range(limit):
+        clock.now += step
+        if not ducker.tick():
+            return
+    raise AssertionError("ramp didn't finish")
+
+
+def test_envelope_shape_ends_on_the_target():
+    smooth = DuckEnvelope()
+    linear = DuckEnvelope(smooth=False)
+
+    assert smooth.shape(0.0) == 0.0 and smooth.shape(0.5) == 0.5 and smooth.shape(1.0) == 1.0
+    assert smooth.shape(0.1) < linear.shape(0.1)
+    assert linear.shape(0.25) == 0.25 and linear.shape(2.0) == 1.0
+
+
+def test_duck_ramps_down_and_release_comes_back(ducker, clock, volumes):
+    token = ducker.duck(0.5)
+    assert ducker.is_ramping()
+    ramp(ducker, clock)
+    assert volumes[-1] == 0.5
+
+    ducker.release(token)
+    ramp(ducker, clock)
+    assert volumes[-1] == 1.0
+    assert not ducker.is_ramping()
+
+
+def test_attack_and_release_take_the_envelope_times(ducker, clock):
+    token = ducker.duck(0.5)
+    clock.now = 0.05
+    assert ducker.tick()
+    clock.now = 0.1
+    assert not ducker.tick()
+
+    ducker.release(token)
+    clock.now = 0.4
+    assert ducker.tick()
+    clock.now = 0.6
+    assert not ducker.tick()
+
+
+def test_overlapping_ducks_hold_the_lowest_level_until_the_last_release(ducker, clock, volumes):
+    first = ducker.duck(0.5)
+    second = ducker.duck(0.3)
+    ramp(ducker, clock)
+    assert volumes[-1] == 0.3
+
+    ducker.release(second)
+    assert ducker.target_level() == 0.5
+    ramp(ducker, clock)
+    assert volumes[-1] == 0.5
+
+    ducker.release(first)
+    ramp(ducker, clock)
+    assert volumes[-1] == 1.0
+
+
+def test_releasing_twice_or_after_release_all_is_fine(ducker):
+    first = ducker.duck(0.5)
+    second = ducker.duck(0.2)
+
+    ducker.release(first)
+    ducker.release(first)
+    ducker.release_all()
+    ducker.release(second)
+
+    assert ducker.target_level() == 1.0
+    assert ducker.stats()["active"] == 0 and ducker.stats()["requests"] == 2
+
+
+def test_a_new_ramp_starts_where_the_volume_is(ducker, clock, volumes):
+    token = ducker.duck(0.0)
+    clock.now = 0.05
+    ducker.tick()
+    halfway = volumes[-1]
+    assert 0.0 < halfway < 1.0
+
+    ducker.release(token)
+    clock.now += 0.002
+    ducker.tick()
+    assert abs(volumes[-1] - halfway) < 0.01
+
+
+def test_base_level_scales_the_ducked_level(ducker, volumes):
+    ducker.set_base_level(0.8, ramp=False)
+    assert volumes == [0.8]
+
+    ducker.duck(0.5)
+    assert ducker.target_level() == pytest.approx(0.4)
+
+
+def test_unchanged_mixer_steps_are_not_sent(ducker, clock, volumes):
+    ducker.duck(0.99)
+    ramp(ducker, clock, step=0.0001)
+
+    assert ducker.stats()["ticks"] > 100
+    assert len(volumes) <= 3 and volumes[-1] == 0.99
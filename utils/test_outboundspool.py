@@ -0,0 +1,85 @@
+import pytest
+
+from utils.OutboundSpool import OutboundSpool
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "outbound.log")
+
+
+def topics(spool: OutboundSpool):
+    return [message.topic for message in spool.pending()]
+
+
+def test_unacked_messages_are_replayed_in_order_after_a_restart(path):
+    spool = OutboundSpool(path)
+    first = spool.append("room/3/room_status", b'{"status": "won"}', critical=True)
+    second = spool.append("room/3/room_status", b"\x00\xff", retain=True)
+    spool.append("room/3/room_status", b"acked")
+    spool.ack(3)
+    spool.close()
+
+    reopened = OutboundSpool(path)
+    assert reopened.pending() == [first, second]
+
+    # New messages carry on after the ones that were left
+    assert reopened.append("room/3/room_status", b"next").seq == 4
+
+
+def test_acking_everything_leaves_an_empty_file(path):
+    spool = OutboundSpool(path)
+    message = spool.append("a/b/c", b"x")
+    spool.ack(message.seq)
+    spool.ack(message.seq)
+
+    assert spool.pending() == [] and spool.stats()["file_bytes"] == 0
+
+
+def test_a_cut_off_last_line_keeps_everything_before_it(path):
+    spool = OutboundSpool(path)
+    spool.append("a/b/c", b"kept")
+    spool.close()
+    with open(path, "ab") as f:
+        f.write(b'{"seq": 2, "topic": "a/b/c", "payl')
+
+    assert topics(OutboundSpool(path)) == ["a/b/c"]
+
+
+def test_a_newer_message_replaces_a_waiting_one_with_the_same_key(path):
+    spool = OutboundSpool(path)
+    spool.append("room/3/ping", b"1", coalesce="ping")
+    spool.append("room/3/room_status", b"won", critical=True)
+    latest = spool.append("room/3/ping", b"2", coalesce="ping")
+
+    assert [m.payload for m in spool.pending()] == [b"won", latest.payload]
+    assert spool.coalesced == 1
+
+
+def test_a_full_spool_drops_the_oldest_non_critical_message_first(path):
+    spool = OutboundSpool(path, max_messages=3)
+    spool.append("won", b"", critical=True)
+    spool.append("ready-1", b"")
+    spool.append("ready-2", b"")
+    spool.append("ready-3", b"")
+
+    assert topics(spool) == ["won", "ready-2", "ready-3"]
+
+    spool.append("lost", b"", critical=True)
+    spool.append("reset", b"", critical=True)
+    assert topics(spool) == ["won", "lost", "reset"]
+
+    # Only critical messages left, then the oldest of those goes
+    spool.append("won-again", b"", critical=True)
+    assert topics(spool) == ["lost", "reset", "won-again"]
+    assert spool.dropped == 4
+
+
+def test_the_file_is_compacted_once_it_grows(path):
+    spool = OutboundSpool(path, compact_bytes=1024)
+    kept = spool.append("kept", b"")
+    for _ in range(50):
+        spool.ack(spool.append("gone", b"x" * 100).seq)
+
+    assert spool.stats()["file_bytes"] < 1024
+    assert OutboundSpool(path).pending() == [kept]
@@ -0,0 +1,48 @@
+from random import Random
+
+from utils.ReconnectBackoff import ReconnectBackoff
+
+
+def draws(backoff: ReconnectBackoff, n: int):
+    return [backoff.next() for _ in range(n)]
+
+
+def test_delays_stay_between_the_base_and_the_cap():
+    backoff = ReconnectBackoff(base=2.0, cap=30.0, rng=Random(1))
+
+    delays = draws(backoff, 1000)
+    assert all(2.0 <= d <= 30.0 for d in delays)
+    assert max(delays) == 30.0
+    assert backoff.attempts == 1000
+
+
+def test_each_delay_is_at_most_three_times_the_last():
+    backoff = ReconnectBackoff(base=1.0, cap=1000.0, rng=Random(2))
+
+    previous = 1.0
+    for delay in draws(backoff, 200):
+        assert 1.0 <= delay <= previous * 3
+        previous = delay
+
+
+def test_the_delays_grow_and_reset_starts_over():
+    backoff = ReconnectBackoff(base=2.0, cap=30.0, rng=Random(3))
+    first = backoff.next()
+    assert first <= 6.0
+
+    draws(backoff, 50)
+    backoff.reset()
+    assert backoff.attempts == 0
+    assert backoff.next() <= 6.0
+
+
+def test_the_same_seed_gives_the_same_delays_and_rooms_differ():
+    assert draws(ReconnectBackoff(rng=Random(7)), 10) == draws(ReconnectBackoff(rng=Random(7)), 10)
+    assert draws(ReconnectBackoff(rng=Random(7)), 10) != draws(ReconnectBackoff(rng=Random(8)), 10)
+
+
+def test_defaults():
+    backoff = ReconnectBackoff()
+
+    assert (backoff.base, backoff.cap) == (ReconnectBackoff.DEFAULT_BASE, ReconnectBackoff.DEFAULT_CAP)
+    assert ReconnectBackoff.DEFAULT_BASE <= backoff.next() <= ReconnectBackoff.DEFAULT_CAP
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from utils.NetworkIdentity import NetworkIdentity
+from utils.ServerCommunicator import ServerCommunicator
+from utils.TimerWheel import TimerWheel
+
+
+@pytest.fixture
+def communicator(clock, tmp_path, monkeypatch):
+    monkeypatch.setenv("ROOM_UTILS_DATA", str(tmp_path))
+    communicator = ServerCommunicator(lambda: None, lambda: None, lambda *args: None, lambda *args: None,
+                                      network=NetworkIdentity(mac="02:00:00:00:00:01"), wheel=TimerWheel(clock=clock),
+                                      record_traffic=False)
+    yield communicator
+    communicator.disconnect(True, exiting=True)
+    communicator.spool.close()
+
+
+def spooled(communicator: ServerCommunicator):
+    return [json.loads(message.payload)["status"] for message in communicator.spool.pending()]
+
+
+def test_every_result_but_only_the_latest_other_status_waits_for_the_broker(communicator):
+    communicator.send_room_status("ready")
+    communicator.send_room_status("won", 2)
+    communicator.send_room_status("ready")
+    communicator.send_room_status("lost")
+    communicator.send_room_status("ready")
+
+    assert spooled(communicator) == ["won", "lost", "ready"]
+    stats = communicator.spool.stats()
+    assert stats["critical"] == 2 and stats["coalesced"] == 2
+
+
+def test_pings_are_not_spooled(communicator):
+    communicator.send_ping()
+
+    assert communicator.spool.pending() == []
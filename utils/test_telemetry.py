@@ -0,0 +1,124 @@
+from threading import Thread
+
+from utils.Telemetry import Histogram, Telemetry, telemetry
+
+
+def test_metrics_are_created_once_by_name():
+    registry = Telemetry()
+
+    assert registry.counter("a") is registry.counter("a")
+    assert registry.histogram("h") is registry.histogram("h")
+    assert registry.names() == ["a", "h"]
+
+
+def test_histogram_buckets_and_take_starts_the_next_interval():
+    histogram = Histogram((1, 10))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value)
+
+    assert histogram.take() == [4, 56.5, [2, 1, 1]]
+    assert histogram.take() is None
+
+
+def test_batch_exports_totals_values_and_one_interval_of_histograms():
+    registry = Telemetry()
+    registry.counter("reconnects").inc(2)
+    registry.gauge("spool").set(3)
+    registry.histogram("rtt_ms", (1, 10)).observe(4)
+    registry.read_gauge("queue", lambda: 7)
+    registry.read_counter("broken", lambda: 1 / 0)
+
+    batch = registry.batch()
+    assert batch["c"] == {"reconnects": 2}
+    assert batch["g"] == {"spool": 3, "queue": 7}
+    assert batch["h"] == {"rtt_ms": [1, 4, [0, 1, 0]]} and batch["b"] == {"rtt_ms": (1, 10)}
+
+    registry.counter("reconnects").inc()
+    batch = registry.batch()
+    assert batch["c"] == {"reconnects": 3} and batch["h"] == {}
+    assert registry.batches == 2
+
+
+def test_bucket_bounds_are_sent_once_unless_asked_for_again():
+    registry = Telemetry()
+    registry.histogram("a", (1, 10)).observe(1)
+    assert registry.batch()["b"] == {"a": (1, 10)}
+
+    registry.histogram("a").observe(1)
+    registry.histogram("b", (5,)).observe(1)
+    assert registry.batch()["b"] == {"b": (5,)}
+
+    registry.histogram("a").observe(1)
+    assert "b" not in registry.batch()
+
+    # A new connection may be a new server, it gets every histogram's bounds with its first batch
+    registry.histogram("a").observe(1)
+    registry.histogram("b").observe(1)
+    assert registry.batch(all_bounds=True)["b"] == {"a": (1, 10), "b": (5,)}
+
+
+def test_rooms_with_their_own_registry_dont_see_each_others_metrics():
+    first, second = Telemetry(), Telemetry()
+    first.counter("messages").inc()
+
+    assert second.batch()["c"] == {}
+    assert first is not telemetry() and telemetry() is telemetry()
+
+
+def test_recording_from_several_threads_loses_nothing():
+    registry = Telemetry()
+
+    def record():
+        for _ in range(10000):
+            registry.counter("n").inc()
+            registry.histogram("h").observe(1)
+
+    threads = [Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    batch = registry.batch()
+    assert batch["c"]["n"] == 40000 and batch["h"]["h"][0] == 40000
+
+
+def test_a_reader_is_only_removed_by_its_owner():
+    registry = Telemetry()
+    old, new = (lambda: 1), (lambda: 2)
+    registry.read_counter("n", old)
+    registry.read_counter("n", new)
+
+    registry.remove_reader("n", old)
+    assert registry.batch()["c"] == {"n": 2}
+    registry.remove_reader("n", new)
+    assert registry.batch()["c"] == {} and registry.names() == []
+
+
+def test_a_reader_without_a_value_is_left_out():
+    registry = Telemetry()
+    registry.read_gauge("gone", lambda: None)
+
+    assert registry.batch()["g"] == {}
+
+
+def test_the_registry_doesnt_keep_a_communicator_alive(clock, tmp_path, monkeypatch):
+    import gc
+    import weakref
+
+    from utils.NetworkIdentity import NetworkIdentity
+    from utils.ServerCommunicator import ServerCommunicator
+    from utils.TimerWheel import TimerWheel
+
+    monkeypatch.setenv("ROOM_UTILS_DATA", str(tmp_path))
+    communicator = ServerCommunicator(lambda: None, lambda: None, lambda *args: None, lambda *args: None,
+                                      network=NetworkIdentity(mac="02:00:00:00:00:01"), wheel=TimerWheel(clock=clock),
+                                      record_traffic=False)
+    registry = communicator.telemetry
+    assert registry.batch()["c"]["mqtt.connect_attempts"] == 0
+
+    ref = weakref.ref(communicator)
+    del communicator
+    gc.collect()
+    assert ref() is None
+    assert registry.batch()["c"] == {} and registry.batch()["g"] == {}
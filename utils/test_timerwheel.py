@@ -0,0 +1,120 @@
+from threading import Event, current_thread
+
+import pytest
+
+from utils.TimerWheel import TimerWheel
+
+
+@pytest.fixture
+def wheel(clock):
+    return TimerWheel(clock=clock)
+
+
+def advance(wheel: TimerWheel, clock, seconds: float, step: float = 0.01):
+    """ Moves the clock forward and runs the wheel on the way, like its thread would """
+    end = clock.now + seconds
+    while clock.now < end:
+        clock.now = min(end, clock.now + step)
+        wheel.run_due()
+
+
+def test_timers_fire_in_the_order_they_are_due(wheel, clock):
+    fired = []
+    wheel.call_later(0.3, fired.append, "c")
+    wheel.call_later(0.1, fired.append, "a")
+    wheel.call_later(0.2, fired.append, "b")
+
+    advance(wheel, clock, 0.15)
+    assert fired == ["a"]
+    advance(wheel, clock, 0.2)
+    assert fired == ["a", "b", "c"]
+
+
+def test_a_timer_doesnt_fire_early(wheel, clock):
+    fired = []
+    handle = wheel.call_later(1.0, fired.append, "x")
+
+    advance(wheel, clock, 0.99)
+    assert fired == [] and handle.is_active()
+    assert handle.remaining() == pytest.approx(0.01)
+    advance(wheel, clock, 0.02)
+    assert fired == ["x"] and not handle.is_active()
+
+
+def test_a_cancelled_timer_doesnt_fire(wheel, clock):
+    fired = []
+    handle = wheel.call_later(0.1, fired.append, "x")
+    handle.cancel()
+
+    advance(wheel, clock, 1.0)
+    assert fired == [] and wheel.timers() == []
+    assert handle.remaining() == 0.0
+
+
+def test_call_every_repeats_without_drifting_until_cancelled(wheel, clock):
+    fired = []
+    handle = wheel.call_every(1.0, lambda: fired.append(clock.now), first_delay=0.5)
+
+    advance(wheel, clock, 3.6, step=0.3)
+    assert len(fired) == 4
+    assert handle.due == pytest.approx(4.5)
+
+    handle.cancel()
+    advance(wheel, clock, 3.0)
+    assert len(fired) == 4
+
+
+def test_far_timers_are_cascaded_down_and_fire_on_time(wheel, clock):
+    fired = []
+    for delay in (3.0, 200.0, 4000.0):
+        wheel.call_later(delay, lambda: fired.append(clock.now))
+    assert len(wheel.timers()) == 3
+
+    advance(wheel, clock, 4001.0, step=0.5)
+    assert [round(t) for t in fired] == [3, 200, 4000]
+    assert wheel.max_late <= 0.5
+
+
+def test_a_timer_added_from_a_callback_runs_later(wheel, clock):
+    fired = []
+    wheel.call_later(0.1, lambda: wheel.call_later(0.1, fired.append, "second"))
+
+    advance(wheel, clock, 0.15)
+    assert fired == []
+    advance(wheel, clock, 0.1)
+    assert fired == ["second"]
+
+
+def test_a_failing_callback_doesnt_stop_the_others(wheel, clock):
+    fired = []
+    wheel.call_later(0.1, lambda: 1 / 0, name="broken")
+    wheel.call_later(0.1, fired.append, "ok")
+
+    advance(wheel, clock, 0.2)
+    assert fired == ["ok"]
+
+
+def test_without_the_thread_offloaded_callbacks_run_on_the_caller(wheel, clock):
+    threads = []
+    wheel.call_later(0.1, lambda: threads.append(current_thread()), offload=True)
+
+    advance(wheel, clock, 0.2)
+    assert threads == [current_thread()]
+    assert wheel.stats()["threads"] == 0
+
+
+def test_the_thread_runs_offloaded_callbacks_on_its_worker():
+    wheel = TimerWheel().start()
+    done = Event()
+    names = []
+
+    def callback():
+        names.append(current_thread().name)
+        done.set()
+
+    try:
+        wheel.call_later(0.01, callback, offload=True)
+        assert done.wait(2.0)
+        assert names == ["TimerWheelWorker"]
+    finally:
+        wheel.stop()
@@ -0,0 +1,77 @@
+import pytest
+
+from utils.Messages import DoorStatusMessage
+from utils.TopicRouter import TopicKey, TopicRouter
+
+
+@pytest.fixture
+def router():
+    return TopicRouter()
+
+
+@pytest.fixture
+def handled():
+    return []
+
+
+def test_topic_key_parses_three_parts():
+    key = TopicKey.parse("door/3/door_status")
+
+    assert key == TopicKey("door", "3", "door_status")
+    assert key.topic() == "door/3/door_status"
+
+
+@pytest.mark.parametrize("topic", ["door/3", "door/3/door_status/x", "door//door_status", ""])
+def test_topic_key_rejects_other_shapes(topic):
+    assert TopicKey.parse(topic) is None
+
+
+def test_add_rejects_a_topic_that_cant_be_routed(router, handled):
+    with pytest.raises(ValueError):
+        router.add("room/#", lambda key, message: handled.append(message))
+
+
+def test_dispatch_hands_the_handler_the_key_and_decoded_message(router, handled):
+    router.add("door/3/door_status", lambda key, message: handled.append((key, message)))
+
+    assert router.dispatch("door/3/door_status", b'{"info": "active"}')
+    assert handled == [(TopicKey("door", "3", "door_status"), {"info": "active"})]
+
+
+def test_unrouted_topics_are_rejected_without_decoding(router, handled):
+    def decode(payload):
+        raise AssertionError("decoded a rejected message")
+
+    router = TopicRouter(decode)
+    router.add("door/3/door_status", lambda key, message: handled.append(message))
+
+    assert not router.dispatch("door/4/door_status", b'{"info": "active"}')
+    assert router.rejected == 1 and handled == []
+
+
+def test_typed_routes_validate_the_message(router, handled):
+    router.add("door/3/door_status", lambda key, message: handled.append(message), DoorStatusMessage)
+
+    assert router.dispatch("door/3/door_status", b'{"info": "active"}')
+    assert not router.dispatch("door/3/door_status", b'{"status": "active"}')
+    assert not router.dispatch("door/3/door_status", b'not json')
+
+    assert len(handled) == 1 and isinstance(handled[0], DoorStatusMessage) and handled[0]["info"] == "active"
+    assert router.stats() == {"routes": 1, "dispatched": 1, "rejected": 0, "invalid": 2}
+
+
+def test_add_replaces_and_remove_kind_drops_routes(router, handled):
+    router.add("room/3/set_status", lambda key, message: handled.append("old"))
+    router.add("room/3/set_status", lambda key, message: handled.append("new"))
+    router.add("room/4/room_status", lambda key, message: handled.append("other"))
+    router.add("door/3/door_status", lambda key, message: handled.append("door"))
+
+    router.dispatch("room/3/set_status", b'{}')
+    assert handled == ["new"]
+
+    router.remove_kind("room")
+    assert router.route("room/3/set_status") is None and router.route("room/4/room_status") is None
+    assert router.route("door/3/door_status") is not None
+
+    router.remove("door/3/door_status")
+    assert router.stats()["routes"] == 0
@@ -0,0 +1,112 @@
+import pytest
+
+from utils.TrafficRecorder import TrafficLog, TrafficRecorder
+
+MAC = "b8:27:eb:00:00:01"
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "traffic.rec")
+
+
+def read(path: str):
+    return [(r.direction, r.time, r.topic, r.payload) for r in TrafficLog(path)]
+
+
+def test_records_read_back_as_they_were_written(path, clock):
+    clock.step = 0.5
+    recorder = TrafficRecorder(path, MAC, clock=clock)
+    recorder.inbound("door/3/door_status", b'{"info": "active"}')
+    recorder.outbound("room/3/room_status", '{"status": "won"}')
+    recorder.outbound("room/3/room_status", b"\x81\xa6status")
+    recorder.close()
+
+    log = TrafficLog(path)
+    assert log.mac == MAC
+    assert read(path) == [(TrafficRecorder.INBOUND, 0.5, "door/3/door_status", b'{"info": "active"}'),
+                          (TrafficRecorder.OUTBOUND, 1.0, "room/3/room_status", b'{"status": "won"}'),
+                          (TrafficRecorder.OUTBOUND, 1.5, "room/3/room_status", b"\x81\xa6status")]
+    assert recorder.stats()["records"] == 3
+
+
+def test_a_reopened_log_is_appended_to(path):
+    TrafficRecorder(path, MAC).inbound("a/b/c", b"1")
+    TrafficRecorder(path, MAC).inbound("a/b/c", b"2")
+
+    assert [payload for _, _, _, payload in read(path)] == [b"1", b"2"]
+
+
+def test_a_full_log_is_rotated_and_the_new_one_starts_with_the_config(path, clock):
+    recorder = TrafficRecorder(path, MAC, max_bytes=300, clock=clock)
+    recorder.inbound(f"config/{MAC}/recieve", b'{"room": "3", "points": [1]}')
+    for i in range(5):
+        recorder.inbound("door/3/door_status", b'{"info": "%d"}' % i)
+    recorder.close()
+
+    assert recorder.rotations == 1
+    rotated, current = read(path + ".1"), read(path)
+    assert rotated[0][2] == current[0][2] == f"config/{MAC}/recieve"
+    assert [topic for _, _, topic, _ in rotated + current].count("door/3/door_status") == 5
+    assert recorder.stats()["records"] == len(rotated) + len(current)
+
+
+def test_a_config_that_starts_a_file_is_written_once(path, clock):
+    first, second = b'{"room": "3", "points": [1]}', b'{"room": "3", "points": [2]}'
+    recorder = TrafficRecorder(path, MAC, max_bytes=150, clock=clock)
+    recorder.inbound(f"config/{MAC}/recieve", first)
+    recorder.inbound("door/3/door_status", b'{"info": "Idle"}')
+    # Doesn't fit anymore, it rotates the log and is what the new one begins with
+    recorder.inbound(f"config/{MAC}/recieve", second)
+    recorder.close()
+
+    assert recorder.rotations == 1
+    assert [payload for _, _, _, payload in read(path + ".1")] == [first, b'{"info": "Idle"}']
+    assert [payload for _, _, _, payload in read(path)] == [second]
+    assert recorder.stats()["records"] == 3
+
+
+def test_a_record_cut_off_by_a_crash_ends_the_log(path):
+    recorder = TrafficRecorder(path, MAC)
+    recorder.inbound("a/b/c", b"kept")
+    recorder.inbound("a/b/c", b"cut off")
+    recorder.close()
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 3)
+
+    assert [payload for _, _, _, payload in read(path)] == [b"kept"]
+
+
+def test_a_file_that_isnt_a_traffic_log_is_refused(path):
+    with open(path, "wb") as f:
+        f.write(b"spool\n")
+
+    with pytest.raises(ValueError):
+        TrafficLog(path)
+
+
+def test_a_replay_runs_again_in_the_same_process(path, clock, tmp_path, monkeypatch):
+    from utils.TimerWheel import shared_wheel
+    from utils.TrafficRecorder import TrafficReplay
+
+    monkeypatch.setenv("ROOM_UTILS_DATA", str(tmp_path / "data"))
+    clock.step = 0.5
+    recorder = TrafficRecorder(path, MAC, clock=clock)
+    recorder.inbound(f"config/{MAC}/recieve", b'{"room": "3", "points": [100, 200, 300]}')
+    recorder.outbound("room/3/room_status", b'{"status": "ready"}')
+    recorder.inbound("door/3/tag_scan_result", b'{"access": "success", "members": 4, "lang": "English"}')
+    for info in (b"Door Opening (Starting)", b"Door Closed (Starting)", b"Game active"):
+        recorder.inbound("door/3/door_status", b'{"info": "%s"}' % info)
+    recorder.outbound("room/3/room_status", b'{"status": "won", "level": 2}')
+    recorder.close()
+
+    # The room's own timers are in use already, the replay doesn't need the shared wheel
+    shared_wheel()
+    first = TrafficReplay([path], speed=None).run()
+    second = TrafficReplay([path], speed=None).run()
+
+    for report in (first, second):
+        assert report["statuses_recorded"] == ["ready", "won"]
+        assert "won" in report["statuses_replayed"]
+        assert report["divergences"] == []
+    assert not (tmp_path / "data" / "traffic").exists()
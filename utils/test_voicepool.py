@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+
+import pytest
+
+import utils.VoicePool as voice_pool
+from utils.VoicePool import VoicePool, VoicePriority
+
+
+class FakeChannel(object):
+    """ A mixer channel that is busy from play until the sound ends or it's stopped """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.sound = None
+        self.volume = 1.0
+
+    def play(self, sound):
+        self.sound = sound
+
+    def stop(self):
+        self.sound = None
+
+    def end(self):
+        self.sound = None
+
+    def get_busy(self) -> bool:
+        return self.sound is not None
+
+    def set_volume(self, volume: float):
+        self.volume = volume
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    channels = {}
+    mixer = SimpleNamespace(set_num_channels=lambda n: None, Channel=lambda i: channels.setdefault(i, FakeChannel(i)))
+    monkeypatch.setattr(voice_pool, "mixer", mixer)
+    pool = VoicePool(voices=2)
+    pool.open()
+    return pool
+
+
+def play(pool: VoicePool, name: str, priority: VoicePriority = VoicePriority.EFFECT, tag: str = None):
+    voice = pool.create(name, priority, tag)
+    pool.start(voice)
+    return voice
+
+
+def test_sounds_mix_on_free_voices(pool):
+    first = play(pool, "a")
+    second = play(pool, "b")
+
+    assert pool.is_playing(first) and pool.is_playing(second)
+    assert first.channel is not second.channel
+    assert pool.stats()["peak_voices"] == 2
+
+
+def test_a_full_pool_steals_the_oldest_voice_with_the_lowest_priority(pool):
+    ambience = play(pool, "a", VoicePriority.AMBIENCE)
+    effect = play(pool, "b", VoicePriority.EFFECT)
+
+    announcement = play(pool, "c", VoicePriority.ANNOUNCEMENT)
+    pool.check_finished()
+
+    assert pool.is_playing(announcement) and pool.is_playing(effect)
+    assert ambience.stolen and ambience.finished.result() is False
+    assert pool.steals == 1
+
+
+def test_equal_priority_steals_the_oldest(pool):
+    first = play(pool, "a")
+    second = play(pool, "b")
+
+    third = play(pool, "c")
+
+    assert first.stolen and not second.stolen
+    assert pool.is_playing(third)
+
+
+def test_a_higher_priority_voice_is_never_stolen(pool):
+    play(pool, "a", VoicePriority.ANNOUNCEMENT)
+    play(pool, "b", VoicePriority.ANNOUNCEMENT)
+
+    effect = play(pool, "c", VoicePriority.EFFECT)
+
+    assert effect.finished.result() is False
+    assert pool.rejected == 1 and pool.steals == 0
+
+
+def test_finished_tells_played_to_the_end_from_stopped(pool):
+    ended = play(pool, "a")
+    stopped = play(pool, "b")
+
+    ended.channel.end()
+    pool.stop(stopped)
+    assert pool.check_finished() is False
+
+    assert ended.finished.result() is True
+    assert stopped.finished.result() is False
+
+
+def test_a_voice_stopped_before_it_starts_never_plays(pool):
+    voice = pool.create("a", VoicePriority.EFFECT)
+    voice.stopped = True
+
+    assert pool.start(voice) is False
+    assert voice.channel is None and voice.finished.result() is False
+
+
+def test_stop_tag_only_stops_that_tag(pool):
+    logic = play(pool, "a", tag="logic")
+    custom = play(pool, "b", tag="custom")
+
+    pool.stop_tag("logic")
+
+    assert not pool.is_playing(logic)
+    assert pool.playing() == [custom]